@@ -9,4 +9,6 @@ import routes
 import swagger_specs
 
 util.logger.setup()
+# refuse to serve on a database that was not migrated
+routes.db.check_schema()
 APP = webserver.setup(routes.BLUEPRINT, swagger_specs.CONFIG)
@@ -0,0 +1,266 @@
+"""
+Balances of payment addresses, fetched concurrently from block explorers.
+
+Each explorer gets a shared HTTP session, a bound on concurrent requests and a rate limit.
+Requests time out, and failures that may pass (connection errors, timeouts, 5xx and rate
+limit responses) are retried with exponential backoff.
+Both explorers answer for several addresses per request, so addresses are asked in batches.
+"""
+import abc
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+
+import requests
+import requests.adapters
+
+import util.logger
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.balances')
+DEBUG = bool(os.environ.get('PAKET_DEBUG'))
+ETHERSCAN_API_KEY = os.environ['PAKET_ETHERSCAN_API_KEY']
+BTC_API_URL = os.environ.get(
+    'PAKET_BTC_API_URL', "https://{}chain.api.btc.com/v3".format('t' if DEBUG else ''))
+ETH_API_URL = os.environ.get(
+    'PAKET_ETH_API_URL', "https://api{}.etherscan.io/api".format('-ropsten' if DEBUG else ''))
+BTC_RATE = float(os.environ.get('PAKET_BTC_RATE', 10))
+BTC_CONCURRENCY = int(os.environ.get('PAKET_BTC_CONCURRENCY', 8))
+BTC_BATCH_SIZE = int(os.environ.get('PAKET_BTC_BATCH_SIZE', 50))
+# etherscan allows 5 requests per second for an API key
+ETH_RATE = float(os.environ.get('PAKET_ETH_RATE', 5))
+ETH_CONCURRENCY = int(os.environ.get('PAKET_ETH_CONCURRENCY', 5))
+# etherscan balancemulti accepts up to 20 addresses
+ETH_BATCH_SIZE = int(os.environ.get('PAKET_ETH_BATCH_SIZE', 20))
+BALANCE_TIMEOUT = float(os.environ.get('PAKET_BALANCE_TIMEOUT', 10))
+BALANCE_RETRIES = int(os.environ.get('PAKET_BALANCE_RETRIES', 3))
+BALANCE_BACKOFF = float(os.environ.get('PAKET_BALANCE_BACKOFF', .5))
+BALANCE_WORKERS = int(os.environ.get('PAKET_BALANCE_WORKERS', 16))
+
+
+class BalanceError(Exception):
+    """Can't get balance for specified address"""
+
+
+class TransientError(BalanceError):
+    """Explorer failed in a way that may pass, worth retrying."""
+
+
+class RateLimiter:
+    """Spaces calls to at most rate per second."""
+
+    def __init__(self, rate, clock=time.monotonic):
+        self.interval = 1 / rate if rate else 0
+        self.clock = clock
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Wait for the next free slot."""
+        with self.lock:
+            now = self.clock()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Provider(abc.ABC):
+    """Block explorer API, with bounded concurrency, rate limit, timeouts and retries."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self, url, rate, concurrency, timeout=BALANCE_TIMEOUT, retries=BALANCE_RETRIES,
+            backoff=BALANCE_BACKOFF, batch_size=1):
+        assert batch_size > 0, 'batch_size must be positive'
+        self.url = url
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.rate_limiter = RateLimiter(rate)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+    # pylint: enable=too-many-arguments
+
+    def request(self, path='', params=None):
+        """
+        Make one request to the explorer.
+        :return: the JSON response
+        :raise TransientError: if the request failed in a way worth retrying
+        """
+        with self.semaphore:
+            self.rate_limiter.wait()
+            try:
+                response = self.session.get(self.url + path, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as exception:
+                raise TransientError("{} failed: {}".format(self.url, exception))
+        if response.status_code == 429 or response.status_code >= 500:
+            raise TransientError("{} failed: {} {}".format(self.url, response.status_code, response.reason))
+        # explorers report errors of the address in the JSON response
+        try:
+            return response.json()
+        except ValueError:
+            raise BalanceError("{} failed: {} {}".format(self.url, response.status_code, response.reason))
+
+    def retry(self, function, *args):
+        """Call a function, retrying it with exponential backoff while it raises TransientError."""
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args)
+            except TransientError as exception:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                LOGGER.warning("%s, retrying in %s seconds", exception, delay)
+                time.sleep(delay)
+        return None
+
+    @abc.abstractmethod
+    def fetch_balance(self, address):
+        """Fetch the balance of an address, without retries."""
+
+    def get_balance(self, address):
+        """Get the balance of an address."""
+        return self.retry(self.fetch_balance, address)
+
+    def fetch_balances(self, addresses):
+        """
+        Fetch the balances of a batch of at most batch_size addresses, without retries.
+        :return: dict of balances by address
+        """
+        return {address: self.fetch_balance(address) for address in addresses}
+
+    def get_balances(self, addresses):
+        """Get the balances of a batch of at most batch_size addresses."""
+        return self.retry(self.fetch_balances, addresses)
+
+    def batches(self, addresses):
+        """Split addresses into batches of at most batch_size addresses."""
+        addresses = list(addresses)
+        return [addresses[index:index + self.batch_size] for index in range(0, len(addresses), self.batch_size)]
+
+
+class BtcProvider(Provider):
+    """btc.com explorer."""
+
+    def fetch_balance(self, address):
+        """Fetch the balance of an address in satoshis."""
+        response = self.request("/address/{}".format(address))
+        if response['err_no'] == 0:
+            return response['data']['balance'] if response['data'] is not None else 0
+        raise BalanceError(response['err_msg'])
+
+    def fetch_balances(self, addresses):
+        """Fetch the balances of a batch of addresses in satoshis, with a single request."""
+        response = self.request("/address/{}".format(','.join(addresses)))
+        if response['err_no'] != 0:
+            raise BalanceError(response['err_msg'])
+        data = response['data']
+        # a single address is answered with an object, unknown addresses with null
+        if not isinstance(data, list):
+            data = [data]
+        if len(data) != len(addresses):
+            raise BalanceError("asked {} addresses, got {} balances".format(len(addresses), len(data)))
+        return {
+            address: address_data['balance'] if address_data is not None else 0
+            for address, address_data in zip(addresses, data)}
+
+
+class EthProvider(Provider):
+    """etherscan.io explorer."""
+
+    def __init__(self, url, rate, concurrency, api_key=ETHERSCAN_API_KEY, **kwargs):
+        super().__init__(url, rate, concurrency, **kwargs)
+        self.api_key = api_key
+
+    def fetch_balance(self, address):
+        """Fetch the balance of an address in wei."""
+        response = self.request(params={
+            'module': 'account',
+            'action': 'balance',
+            'address': address,
+            'tag': 'latest',
+            'apikey': self.api_key
+        })
+        if response['message'] == 'OK':
+            return int(response['result'])
+        if 'rate limit' in str(response['result']).lower():
+            raise TransientError(response['result'])
+        raise BalanceError(response['result'])
+
+    def fetch_balances(self, addresses):
+        """Fetch the balances of a batch of addresses in wei, with a single balancemulti request."""
+        response = self.request(params={
+            'module': 'account',
+            'action': 'balancemulti',
+            'address': ','.join(addresses),
+            'tag': 'latest',
+            'apikey': self.api_key
+        })
+        if response['message'] != 'OK':
+            if 'rate limit' in str(response['result']).lower():
+                raise TransientError(response['result'])
+            raise BalanceError(response['result'])
+        # etherscan may change the case of the addresses
+        addresses = {address.lower(): address for address in addresses}
+        return {
+            addresses[account['account'].lower()]: int(account['balance'])
+            for account in response['result'] if account['account'].lower() in addresses}
+
+
+PROVIDERS = {
+    'BTC': BtcProvider(BTC_API_URL, BTC_RATE, BTC_CONCURRENCY, batch_size=BTC_BATCH_SIZE),
+    'ETH': EthProvider(ETH_API_URL, ETH_RATE, ETH_CONCURRENCY, batch_size=ETH_BATCH_SIZE)}
+
+
+def get_provider(network, providers=None):
+    """Get the provider of a network, ethereum for any network but bitcoin."""
+    return (PROVIDERS if providers is None else providers)['BTC' if network == 'BTC' else 'ETH']
+
+
+def get_balance(address, network):
+    """Get balance of address in specified network"""
+    return get_provider(network).get_balance(address)
+
+
+def get_batch_balances(addresses, providers=None, workers=BALANCE_WORKERS):
+    """
+    Get balances of many addresses concurrently, asking each explorer for a batch of addresses per request.
+    A failed batch is reported as an error of each of its addresses.
+    :param addresses: iterable of (address, network) tuples
+    :param providers: dict of providers by network, PROVIDERS by default
+    :return: tuple of dict of balances by (address, network) and dict of errors by (address, network)
+    """
+    networks_addresses = collections.defaultdict(list)
+    for address, network in set(addresses):
+        networks_addresses[network].append(address)
+    batches = [
+        (network, batch) for network, network_addresses in networks_addresses.items()
+        for batch in get_provider(network, providers).batches(sorted(network_addresses))]
+    balances, errors = {}, {}
+    if not batches:
+        return balances, errors
+    with concurrent.futures.ThreadPoolExecutor(min(workers, len(batches))) as executor:
+        futures = {
+            executor.submit(get_provider(network, providers).get_balances, batch): (network, batch)
+            for network, batch in batches}
+        for future in concurrent.futures.as_completed(futures):
+            network, batch = futures[future]
+            # pylint: disable=broad-except
+            try:
+                batch_balances = future.result()
+            except Exception as exception:
+                batch_balances = {}
+                errors.update({(address, network): exception for address in batch})
+            # pylint: enable=broad-except
+            for address in batch:
+                if address in batch_balances:
+                    balances[(address, network)] = batch_balances[address]
+                elif (address, network) not in errors:
+                    errors[(address, network)] = BalanceError("no balance returned for {}".format(address))
+    return balances, errors
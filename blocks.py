@@ -0,0 +1,168 @@
+"""
+Matching of purchase payment addresses against transaction outputs streamed from block data,
+an alternative to asking block explorers about each payment address.
+
+Blocks are JSON objects, with values in satoshis or wei:
+    {"network": "BTC", "height": 1, "transactions": [{"txid": "...", "outputs": [{"address": "...", "value": 1}]}]}
+They are read from JSON lines files, or from a local node serving them at <url>/block/<height>.
+Each output address is looked up in an index of the open purchases, in constant time whatever their number.
+"""
+import collections
+import json
+import os
+import sys
+
+import requests
+
+import util.logger
+
+import db
+import routines
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.blocks')
+NODE_TIMEOUT = float(os.environ.get('PAKET_NODE_TIMEOUT', 10))
+
+
+class BlockSourceError(Exception):
+    """Can't read blocks from block source"""
+
+
+def normalize_address(address, network):
+    """Get the form of an address used for matching, ethereum addresses are case insensitive."""
+    return address if network == 'BTC' else address.lower()
+
+
+class PurchaseIndex:
+    """Open purchases by normalized payment address."""
+
+    def __init__(self, purchases):
+        self.purchases = {
+            normalize_address(purchase['payment_pubkey'], purchase['payment_currency']): purchase
+            for purchase in purchases}
+
+    def __len__(self):
+        return len(self.purchases)
+
+    def match(self, address, network):
+        """Get the open purchase paid to an address, None if there is none."""
+        purchase = self.purchases.get(normalize_address(address, network))
+        if purchase is not None and purchase['payment_currency'] == network:
+            return purchase
+        return None
+
+
+def iter_file_blocks(paths):
+    """
+    Read blocks from JSON lines files.
+    :param paths: files, or directories whose files are read in name order
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from iter_file_blocks(os.path.join(path, name) for name in sorted(os.listdir(path)))
+            continue
+        with open(path, encoding='utf-8') as blocks_file:
+            for line in blocks_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def iter_node_blocks(url, start_height, end_height=None, session=requests):
+    """
+    Read blocks from a local node, from start_height up to end_height or to the last block it has.
+    :raise BlockSourceError: if the node fails
+    """
+    height = start_height
+    while end_height is None or height <= end_height:
+        try:
+            response = session.get("{}/block/{}".format(url, height), timeout=NODE_TIMEOUT)
+        except requests.RequestException as exception:
+            raise BlockSourceError("can't get block {} from {}: {}".format(height, url, exception))
+        if response.status_code == 404 and end_height is None:
+            return
+        if response.status_code != 200:
+            raise BlockSourceError("can't get block {} from {}: {} {}".format(
+                height, url, response.status_code, response.reason))
+        yield response.json()
+        height += 1
+
+
+def iter_unread_blocks(blocks, read_heights, heights):
+    """
+    Skip blocks that were already read, at or below the height of the last block read of their network.
+    :param read_heights: dict of the height of the last block read by network, by previous runs
+    :param heights: dict updated with the height of the last block read by network
+    """
+    for block in blocks:
+        network, height = block['network'], block['height']
+        if read_heights.get(network) is not None and height <= read_heights[network]:
+            LOGGER.debug("skipping %s block %s, already read", network, height)
+            continue
+        heights[network] = max(height, heights.get(network, height))
+        yield block
+
+
+def iter_outputs(blocks):
+    """Get (network, txid, address, value) of every output of the blocks."""
+    for block in blocks:
+        for transaction in block['transactions']:
+            for output in transaction['outputs']:
+                if output.get('address'):
+                    yield block['network'], transaction['txid'], output['address'], int(output['value'])
+
+
+def find_payments(blocks, purchase_index):
+    """
+    Sum the values paid to open purchases in the blocks.
+    :return: tuple of dict of received values by payment address, and Counter of outputs and hits
+    """
+    payments = collections.defaultdict(int)
+    counters = collections.Counter()
+    for network, txid, address, value in iter_outputs(blocks):
+        counters['outputs'] += 1
+        purchase = purchase_index.match(address, network)
+        if purchase is not None:
+            LOGGER.info("%s %s paid to %s in %s", value, network, purchase['payment_pubkey'], txid)
+            payments[purchase['payment_pubkey']] += value
+            counters['hits'] += 1
+    return payments, counters
+
+
+def mark_paid_candidates(blocks, purchases=None):
+    """
+    Mark open purchases paid in the blocks as paid, when the totals paid to them reach the minimum payment.
+    Payments are added to the totals stored for each payment address, so payments read in different runs add up,
+    and blocks already read are skipped.
+    Funds are only sent after the explorers confirm the balance, so block data just nominates candidates.
+    :param purchases: open purchases, the unpaid purchases by default
+    :return: list of payment addresses marked as paid
+    """
+    purchase_index = PurchaseIndex(db.get_unpaid_purchases() if purchases is None else purchases)
+    LOGGER.info("matching block outputs against %s open purchases", len(purchase_index))
+    heights = {}
+    payments, counters = find_payments(iter_unread_blocks(blocks, db.get_block_heights(), heights), purchase_index)
+    LOGGER.info("%s outputs read, %s paid to open purchases", counters['outputs'], counters['hits'])
+    totals = db.add_block_payments(payments, heights)
+    paid = []
+    if not totals:
+        return paid
+    currency_prices = db.prices.get_prices(funding=True)
+    with db.PurchaseWriter() as purchase_writer:
+        for purchase in purchase_index.purchases.values():
+            if purchase['payment_pubkey'] in totals and routines.check_purchase_address(
+                    purchase, totals[purchase['payment_pubkey']], currency_prices, purchase_writer):
+                paid.append(purchase['payment_pubkey'])
+    return paid
+
+
+if __name__ == '__main__':
+    util.logger.setup()
+    try:
+        if sys.argv[1] == 'node':
+            mark_paid_candidates(iter_node_blocks(
+                sys.argv[2], int(sys.argv[3]), int(sys.argv[4]) if len(sys.argv) > 4 else None))
+        else:
+            mark_paid_candidates(iter_file_blocks(sys.argv[1:]))
+        sys.exit(0)
+    except IndexError:
+        pass
+    print(' Usage: python blocks.py [<blocks file or directory>...|node <url> <start height> [<end height>]]')
@@ -7,76 +7,648 @@ The search is fuzzy, to allow for minor misspells.
 details on the file:
 build.export.gov/build/idcplg?IdcService=DOWNLOAD_PUBLIC_FILE&RevisionSelectionMethod=Latest&dDocName=eg_main_040971
 """
+import array
+import bisect
+import collections
+import collections.abc
 import csv
+import json
+import mmap
+import multiprocessing
 import os.path
+import struct
+import tempfile
+import threading
 import time
 
 import fuzzywuzzy.fuzz
 import requests
+try:
+    import numpy
+    import rapidfuzz.fuzz
+    import rapidfuzz.process
+except ImportError:
+    numpy = rapidfuzz = None
 
 import util.logger
-import util.countly
+
+import telemetry
 
 LOGGER = util.logger.logging.getLogger('pkt.funder.csl')
+REFRESH_INTERVAL = int(os.environ.get('PAKET_CSL_REFRESH_INTERVAL', 24 * 60 * 60))
+REFRESH_CHECK_INTERVAL = int(os.environ.get('PAKET_CSL_REFRESH_CHECK_INTERVAL', 10 * 60))
+DOWNLOAD_TIMEOUT = 60
+SCORING_ENGINES = ('fuzzywuzzy', 'rapidfuzz')
+SCORING_ENGINE = os.environ.get('PAKET_CSL_SCORING_ENGINE', 'fuzzywuzzy')
+SCORING_WORKERS = int(os.environ.get('PAKET_CSL_SCORING_WORKERS', 1))
+SCREENING_CACHE_SIZE = int(os.environ.get('PAKET_CSL_SCREENING_CACHE_SIZE', 10000))
+assert SCORING_ENGINE in SCORING_ENGINES, "PAKET_CSL_SCORING_ENGINE must be one of {}".format(SCORING_ENGINES)
+assert SCORING_ENGINE != 'rapidfuzz' or rapidfuzz is not None, \
+    'rapidfuzz scoring engine requires the rapidfuzz and numpy packages'
 VALIDATION_SCORE_THRESHOLD = 0.83
 EXACT_MATCH_WEIGHT = 5
 FUZZY_MATCH_WEIGHT = .95
+MINIMAL_FUZZY_SCORE = .6
+NAME_ROWS = ('name', 'alt_names')
+ROW_FIELDS = NAME_ROWS + ('programs',)
+NGRAM_SIZE = 3
+# Shorter queries share too few n-grams to filter rows by, they are searched with a full scan.
+PRUNE_MIN_QUERY_LENGTH = 2 * NGRAM_SIZE
+# Guards the pruning bound against float rounding.
+BOUND_EPSILON = 1e-9
+# Snapshot header: magic, version, number of rows, followed by an (offset, length) pair per section.
+SNAPSHOT_MAGIC = b'CSL1'
+SNAPSHOT_HEADER = struct.Struct('=4sdI')
+SNAPSHOT_SECTION = struct.Struct('=QQ')
+SNAPSHOT_SECTIONS = ROW_FIELDS + ('search_strings', 'chars', 'char_counts', 'ngrams', 'postings')
+
+
+def file_identity(stat):
+    """Get what tells versions of a file apart without reading it: its inode, modification time and size."""
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def ngrams(text, size=NGRAM_SIZE):
+    """Get the set of character n-grams of a string."""
+    return {text[index:index + size] for index in range(len(text) - size + 1)}
+
+
+def fuzzy_score(search_query, search_string):
+    """
+    Score a lowercased query against a lowercased search string.
+    Score is based on partial fuzzy search plus a small factor for full search.
+    """
+    ratio = fuzzywuzzy.fuzz.ratio(search_query, search_string) / 100
+    partial_ratio = fuzzywuzzy.fuzz.partial_ratio(search_query, search_string) / 100
+    return min(1.0, FUZZY_MATCH_WEIGHT * partial_ratio + ratio / EXACT_MATCH_WEIGHT)
+
+
+def min_shared_ngrams(query_length, cutoff, size=NGRAM_SIZE):
+    """
+    Get the number of n-grams of a query a search string must share to score above cutoff.
+    To score above cutoff, partial_ratio must be above (cutoff - 1 / EXACT_MATCH_WEIGHT) / FUZZY_MATCH_WEIGHT,
+    so the best matching part of the search string keeps, in order, all but fewer than the query length times
+    one minus that of the query characters. Each query character it lacks spoils at most size n-grams of the query,
+    and each character inserted between kept ones at most size - 1.
+    Rows sharing no n-gram at all are never kept, even where this bound allows it.
+    """
+    partial_ratio = (cutoff - 1 / EXACT_MATCH_WEIGHT) / FUZZY_MATCH_WEIGHT - .005
+    differences = int(query_length * (1 - partial_ratio))
+    return max(1, query_length - size + 1 - (2 * size - 1) * differences)
+
+
+def fuzzy_score_bound(query_length, string_length, common):
+    """
+    Get an upper bound of fuzzy_score from the number of characters a query shares with a search string.
+    Both ratio and partial_ratio are at most twice the number of common characters
+    divided by the compared lengths, and fuzzywuzzy rounds them to whole percents.
+    """
+    if not common:
+        return 0.0
+    ratio = min(1.0, 2 * common / (query_length + string_length) + .005)
+    partial_ratio = min(1.0, 2 * common / (min(query_length, string_length) + common) + .005)
+    return min(1.0, FUZZY_MATCH_WEIGHT * partial_ratio + ratio / EXACT_MATCH_WEIGHT)
+
+
+def pack_arrays(arrays, typecode):
+    """Pack a list of arrays into bytes - their count, their offsets and their concatenated items."""
+    offsets = array.array('I', [0])
+    items = array.array(typecode)
+    for packed_array in arrays:
+        items.extend(packed_array)
+        offsets.append(len(items))
+    return struct.pack('=I', len(arrays)) + offsets.tobytes() + items.tobytes()
+
+
+def pack_strings(strings):
+    """Pack a list of strings into bytes - their count, their offsets and their concatenated UTF-8."""
+    return pack_arrays([array.array('B', string.encode('utf-8')) for string in strings], 'B')
+
+
+class PackedArrays(collections.abc.Sequence):
+    """Read only sequence of arrays packed by pack_arrays, viewed without copying."""
+
+    def __init__(self, buffer, typecode):
+        count = struct.unpack_from('=I', buffer)[0]
+        offsets_end = 4 + 4 * (count + 1)
+        self.offsets = buffer[4:offsets_end].cast('I')
+        self.items = buffer[offsets_end:].cast(typecode)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[item_index] for item_index in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('packed array index out of range')
+        return self.items[self.offsets[index]:self.offsets[index + 1]]
+
+
+class PackedStrings(PackedArrays):
+    """Read only sequence of strings packed by pack_strings, decoded on access."""
+
+    def __init__(self, buffer):
+        super().__init__(buffer, 'B')
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return super().__getitem__(index)
+        return str(super().__getitem__(index), 'utf-8')
+
+
+class SnapshotRows(collections.abc.Sequence):
+    """Read only sequence of CSL rows, backed by packed strings of each field."""
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.fields[ROW_FIELDS[0]])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[row_index] for row_index in range(*index.indices(len(self)))]
+        return {field: strings[index] for field, strings in self.fields.items()}
+
+
+class SnapshotNgrams(collections.abc.Mapping):
+    """Read only mapping of n-grams to row indexes, searched in sorted packed n-grams."""
+
+    def __init__(self, ngrams_buffer, postings_buffer):
+        self.ngrams = PackedStrings(ngrams_buffer)
+        self.postings = PackedArrays(postings_buffer, 'I')
+
+    def __len__(self):
+        return len(self.ngrams)
+
+    def __iter__(self):
+        return iter(self.ngrams)
+
+    def __getitem__(self, ngram):
+        position = bisect.bisect_left(self.ngrams, ngram)
+        if position == len(self.ngrams) or self.ngrams[position] != ngram:
+            raise KeyError(ngram)
+        return self.postings[position]
+
+
+class CSLIndex:
+    """
+    Immutable snapshot of the Individual rows of a CSL file.
+    The version is the modification time of the file the snapshot was built from.
+    Only the fields needed for screening are kept.
+    """
+
+    def __init__(self, rows, version, search_strings=None, char_counts=None, ngram_index=None):
+        self.rows = rows if isinstance(rows, SnapshotRows) else tuple(rows)
+        self.version = version
+        self.search_strings = search_strings or tuple(
+            ' '.join([row[row_name] for row_name in NAME_ROWS]).lower() for row in self.rows)
+        if char_counts is None:
+            # Per character, the number of times it appears in each search string (capped at 255).
+            char_counts = collections.defaultdict(lambda: array.array('B', bytes(len(self.rows))))
+            for row_index, string in enumerate(self.search_strings):
+                for char, count in collections.Counter(string).items():
+                    char_counts[char][row_index] = min(count, 255)
+            char_counts = dict(char_counts)
+        self.char_counts = char_counts
+        if ngram_index is None:
+            ngram_index = collections.defaultdict(list)
+            for row_index, string in enumerate(self.search_strings):
+                for ngram in ngrams(string):
+                    ngram_index[ngram].append(row_index)
+            ngram_index = {ngram: tuple(row_indexes) for ngram, row_indexes in ngram_index.items()}
+        self.ngram_index = ngram_index
+        # Search strings as a list for rapidfuzz, built on first use.
+        self.search_string_list = None
+        # Identity of the snapshot file holding this version, None if it was not saved nor mapped.
+        self.snapshot_identity = None
+
+    @classmethod
+    def from_file(cls, filename):
+        """Build a snapshot from a local CSL file."""
+        version = os.path.getmtime(filename)
+        with open(filename, encoding='utf-8') as csvfile:
+            reader = csv.DictReader(csvfile, delimiter=',')
+            rows = [
+                {field: dict_row[field] for field in ROW_FIELDS}
+                for dict_row in reader if dict_row['type'] == "Individual"]
+        return cls(rows, version)
+
+    @classmethod
+    def from_snapshot(cls, filename):
+        """
+        Map a compiled snapshot file.
+        Nothing is parsed or copied, so processes mapping the same file share its pages.
+        """
+        with open(filename, 'rb') as snapshot_file:
+            buffer = memoryview(mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ))
+            identity = file_identity(os.fstat(snapshot_file.fileno()))
+        magic, version, row_count = SNAPSHOT_HEADER.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("{} is not a CSL snapshot".format(filename))
+        sections = {}
+        for section_index, section in enumerate(SNAPSHOT_SECTIONS):
+            offset, length = SNAPSHOT_SECTION.unpack_from(
+                buffer, SNAPSHOT_HEADER.size + section_index * SNAPSHOT_SECTION.size)
+            sections[section] = buffer[offset:offset + length]
+        chars = PackedStrings(sections['chars'])
+        char_counts = {
+            char: sections['char_counts'][char_index * row_count:(char_index + 1) * row_count]
+            for char_index, char in enumerate(chars)}
+        index = cls(
+            SnapshotRows({field: PackedStrings(sections[field]) for field in ROW_FIELDS}), version,
+            search_strings=PackedStrings(sections['search_strings']), char_counts=char_counts,
+            ngram_index=SnapshotNgrams(sections['ngrams'], sections['postings']))
+        index.snapshot_identity = identity
+        return index
+
+    @staticmethod
+    def snapshot_identity(filename):
+        """Get the identity of a snapshot file, None if it is missing."""
+        try:
+            return file_identity(os.stat(filename))
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def snapshot_version(filename):
+        """Get the version of a compiled snapshot file, None if it is missing or invalid."""
+        try:
+            with open(filename, 'rb') as snapshot_file:
+                magic, version, _ = SNAPSHOT_HEADER.unpack(snapshot_file.read(SNAPSHOT_HEADER.size))
+        except (FileNotFoundError, struct.error):
+            return None
+        return version if magic == SNAPSHOT_MAGIC else None
+
+    def save_snapshot(self, filename):
+        """Write the index as a compiled snapshot file, replacing the existing one atomically."""
+        chars = sorted(self.char_counts)
+        ngram_keys = sorted(self.ngram_index)
+        sections = [pack_strings([row[field] for row in self.rows]) for field in ROW_FIELDS] + [
+            pack_strings(self.search_strings),
+            pack_strings(chars),
+            b''.join(bytes(self.char_counts[char]) for char in chars),
+            pack_strings(ngram_keys),
+            pack_arrays([self.ngram_index[ngram] for ngram in ngram_keys], 'I')]
+        offset = SNAPSHOT_HEADER.size + len(sections) * SNAPSHOT_SECTION.size
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.version, len(self.rows))
+        for section in sections:
+            header += SNAPSHOT_SECTION.pack(offset, len(section))
+            offset += len(section)
+        handle, temp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+        with os.fdopen(handle, 'wb') as snapshot_file:
+            snapshot_file.write(header)
+            for section in sections:
+                snapshot_file.write(section)
+        # replacing keeps the inode and modification time
+        self.snapshot_identity = file_identity(os.stat(temp_filename))
+        os.replace(temp_filename, filename)
+
+    def candidates(self, search_query, cutoff=MINIMAL_FUZZY_SCORE):
+        """
+        Get the indexes of the rows sharing enough n-grams with a lowercased query to score above cutoff,
+        those sharing most first, looked up in the n-gram index.
+        Scanning likely matches first raises the top score early, so more rows can be pruned.
+        :return: list of row indexes, None if the query is too short to filter rows by n-grams
+        """
+        if len(search_query) < PRUNE_MIN_QUERY_LENGTH:
+            return None
+        query_ngrams = collections.Counter(
+            search_query[index:index + NGRAM_SIZE] for index in range(len(search_query) - NGRAM_SIZE + 1))
+        shared = collections.Counter()
+        for ngram, count in query_ngrams.items():
+            for row_index in self.ngram_index.get(ngram, ()):
+                shared[row_index] += count
+        threshold = min_shared_ngrams(len(search_query), cutoff)
+        return [row_index for row_index, count in shared.most_common() if count >= threshold]
+
+    def common_chars(self, query_chars, row_index):
+        """
+        Get the number of characters a query shares with the search string of a row.
+        :param query_chars: Counter of the characters of the lowercased query
+        """
+        return sum(
+            min(self.char_counts[char][row_index], count)
+            for char, count in query_chars.items() if char in self.char_counts)
+
+    def top_match_vectorized(self, search_query):
+        """
+        Find the row best matching a lowercased query, scoring all names at once with rapidfuzz.
+        rapidfuzz tries every partial_ratio alignment, while fuzzywuzzy tries only those around
+        matching blocks, so scores are never lower than those of a fuzzywuzzy scan.
+        :return: top fuzzy score (0 if nothing scored above MINIMAL_FUZZY_SCORE) and programs of its row
+        """
+        assert rapidfuzz is not None, 'rapidfuzz scoring engine requires the rapidfuzz and numpy packages'
+        if not self.rows:
+            return 0.0, ''
+        if self.search_string_list is None:
+            self.search_string_list = list(self.search_strings)
+        partial_ratios, ratios = (
+            rapidfuzz.process.cdist(
+                [search_query], self.search_string_list, scorer=scorer, dtype=numpy.float64, workers=SCORING_WORKERS)[0]
+            for scorer in (rapidfuzz.fuzz.partial_ratio, rapidfuzz.fuzz.ratio))
+        # Round to whole percents and weigh exactly like fuzzy_score.
+        scores = numpy.minimum(1.0, (
+            FUZZY_MATCH_WEIGHT * (numpy.rint(partial_ratios) / 100) +
+            (numpy.rint(ratios) / 100) / EXACT_MATCH_WEIGHT))
+        top_index = int(scores.argmax())
+        if scores[top_index] <= MINIMAL_FUZZY_SCORE:
+            return 0.0, ''
+        return float(scores[top_index]), str(self.rows[top_index]['programs'])
+
+    def top_match(self, search_query, *search_rows, prune=True, engine=None):
+        """
+        Find the row best matching a search query.
+        When searching names, only rows sharing enough n-grams with the query to score above MINIMAL_FUZZY_SCORE
+        are scored, skipping those which can not beat the current top score. Rows sharing no n-gram may still
+        score a little above MINIMAL_FUZZY_SCORE, so low scores may be lower than those of a full scan.
+        :param search_query: words to look for.
+        :param search_rows: names of rows to search in
+        :param prune: search only candidate rows, a full scan is done if False
+        :param engine: scoring engine for names, defaults to SCORING_ENGINE
+        :return: top fuzzy score (0 if nothing scored above MINIMAL_FUZZY_SCORE) and programs of its row
+        """
+        search_query = search_query.lower()
+        if (engine or SCORING_ENGINE) == 'rapidfuzz' and search_rows == NAME_ROWS:
+            return self.top_match_vectorized(search_query)
+        row_indexes = None
+        if prune and search_rows == NAME_ROWS:
+            row_indexes = self.candidates(search_query)
+            query_chars = collections.Counter(search_query)
+        prune = row_indexes is not None
+        if not prune:
+            row_indexes = range(len(self.rows))
+
+        top_score = 0.0
+        top_index = None
+        for row_index in row_indexes:
+            if prune:
+                search_string = self.search_strings[row_index]
+                bound = fuzzy_score_bound(
+                    len(search_query), len(search_string), self.common_chars(query_chars, row_index)) + BOUND_EPSILON
+                if bound <= MINIMAL_FUZZY_SCORE or bound < top_score:
+                    continue
+            else:
+                row = self.rows[row_index]
+                search_string = ' '.join([row[row_name] for row_name in search_rows]).lower()
+            score = fuzzy_score(search_query, search_string)
+            # Ties go to the first row, as in a full scan.
+            if score > MINIMAL_FUZZY_SCORE and (
+                    score > top_score or (score == top_score and row_index < top_index)):
+                top_score = score
+                top_index = row_index
+        programs = str(self.rows[top_index]['programs']) if top_index is not None else ''
+        return top_score, programs
+
+
+class ScreeningCache:
+    """
+    LRU cache of top matches, keyed by index version, scoring engine and lowercased name.
+    Entries of an older version are never hit, and are dropped when a new index is swapped in.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Get a cached top match, None if missing."""
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache a top match, evicting the least recently used ones."""
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all cached top matches."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Get hit and miss counters."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+                'hit_rate': self.hits / lookups if lookups else 0.0}
 
 
 class CSLListChecker:
     """
     List checker.
+    All instances share a single index, which is reloaded only when a newer file shows up.
+    A new list is downloaded by a background thread, so screening never waits for it.
     """
-    all_rows = []
+    index = None
+    index_lock = threading.Lock()
+    download_lock = threading.Lock()
+    refresher = None
+    refresher_lock = threading.Lock()
     filename = "CSL.CSV"
+    snapshot_filename = "CSL.snapshot"
+    metadata_filename = "CSL.json"
+    # kept apart from the download metadata, which the refreshers of the web workers rewrite
+    screened_filename = "CSL.screened.json"
+    screening_cache = ScreeningCache(SCREENING_CACHE_SIZE)
     url = 'https://api.trade.gov/consolidated_screening_list/search.csv?api_key=OHZYuksFHSFao8jDXTkfiypO'
 
     def __init__(self):
-        self.download_file()
-        self.load_file()
+        if not os.path.exists(self.filename):
+            # There is nothing to screen against yet, so the first download has to block.
+            self.download_file()
+        self.start_refresher()
+        self.get_index()
+
+    @classmethod
+    def load_metadata(cls):
+        """Get the details of the last download - ETag, Last-Modified and the time it was checked."""
+        try:
+            with open(cls.metadata_filename, encoding='utf-8') as metadata_file:
+                return json.load(metadata_file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @classmethod
+    def save_metadata(cls, metadata):
+        """Store the details of the last download."""
+        with open(cls.metadata_filename, 'w', encoding='utf-8') as metadata_file:
+            json.dump(metadata, metadata_file)
+
+    @classmethod
+    def load_screened_version(cls):
+        """Get the index version all users were last screened against, None if they never were."""
+        try:
+            with open(cls.screened_filename, encoding='utf-8') as screened_file:
+                return json.load(screened_file).get('version')
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @classmethod
+    def save_screened_version(cls, version):
+        """Store the index version all users were screened against."""
+        with open(cls.screened_filename, 'w', encoding='utf-8') as screened_file:
+            json.dump({'version': version, 'screened': time.time()}, screened_file)
 
     @classmethod
     def download_file(cls):
         """
-        Download csv locally only if the local file is old
+        Download csv locally if the remote file changed since the last download.
+        The file is streamed into a temporary file, compiled into a snapshot, and only then replaces the local one,
+        so readers never see a partial file nor a file newer than the snapshot.
+        :return: True if a new file was downloaded
+        """
+        with cls.download_lock:
+            metadata = cls.load_metadata()
+            headers = {}
+            if os.path.exists(cls.filename):
+                if metadata.get('etag'):
+                    headers['If-None-Match'] = metadata['etag']
+                if metadata.get('last_modified'):
+                    headers['If-Modified-Since'] = metadata['last_modified']
+
+            # pylint: disable=broad-except
+            # Still testing.
+            try:
+                telemetry.send_event('download csl', 0)
+                with requests.get(cls.url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                    # Throw an error for bad status codes
+                    response.raise_for_status()
+                    if response.status_code == 304:
+                        LOGGER.info("remote file not modified since last download")
+                        cls.save_metadata(dict(metadata, checked=time.time()))
+                        return False
+                    handle, temp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cls.filename)))
+                    try:
+                        with os.fdopen(handle, 'wb') as temp_file:
+                            for block in response.iter_content(64 * 1024):
+                                temp_file.write(block)
+                        # replacing keeps the modification time, so the snapshot version matches the file
+                        cls.compile_snapshot(temp_filename)
+                        os.replace(temp_filename, cls.filename)
+                    except BaseException:
+                        os.remove(temp_filename)
+                        raise
+                    cls.save_metadata({
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                        'checked': time.time()})
+                telemetry.send_event('download csl', 1, end_session=1)
+            except Exception as exception:
+                LOGGER.warning("error loading %s, error: %s", cls.url, exception)
+                return False
+            # pylint: enable=broad-except
+            return True
+
+    @classmethod
+    def refresh(cls, force=False):
+        """
+        Download a new list if it was not checked for REFRESH_INTERVAL seconds, and swap it into the shared index.
+        Until then, the current index keeps serving.
+        :return: True if a new list was loaded
         """
         try:
-            creation_hours_ago = int(time.time() - os.path.getmtime(cls.filename)) / 3600
-            LOGGER.info("current file is from %d hours ago", creation_hours_ago)
-            if creation_hours_ago < 24:
-                LOGGER.info("no need to load new version")
-                return
+            checked = cls.load_metadata().get('checked') or os.path.getmtime(cls.filename)
         except FileNotFoundError:
-            LOGGER.info("Local file '%s' not found", cls.filename)
+            checked = 0
+        if not force and time.time() - checked < REFRESH_INTERVAL:
+            return False
+        if not cls.download_file():
+            return False
+        cls.load_file()
+        return True
 
-        # pylint: disable=broad-except
-        # Still testing.
-        try:
-            util.countly.send_countly_event('download csl', 0)
-            response = requests.get(cls.url)
-            # Throw an error for bad status codes
-            response.raise_for_status()
-            with open(cls.filename, 'wb') as handle:
-                for block in response.iter_content(1024):
-                    handle.write(block)
-            util.countly.send_countly_event('download csl', 1, end_session=1)
-        except Exception as exception:
-            LOGGER.warning("error loading %s, error: %s", cls.url, exception)
-        # pylint: enable=broad-except
+    @classmethod
+    def refresh_forever(cls):
+        """Keep refreshing the list."""
+        while True:
+            # pylint: disable=broad-except
+            try:
+                cls.refresh()
+            except Exception:
+                LOGGER.exception("error refreshing %s", cls.filename)
+            # pylint: enable=broad-except
+            time.sleep(REFRESH_CHECK_INTERVAL)
+
+    @classmethod
+    def start_refresher(cls):
+        """Start refreshing the list in a background thread, unless it is already running in this process."""
+        with cls.refresher_lock:
+            if cls.refresher is None or not cls.refresher.is_alive():
+                cls.refresher = threading.Thread(target=cls.refresh_forever, name='csl-refresher', daemon=True)
+                cls.refresher.start()
+
+    @classmethod
+    def compile_snapshot(cls, filename=None):
+        """
+        Compile a CSL file into a snapshot, for workers to map instead of parsing the file.
+        :param filename: file to compile, the local CSL file by default
+        :return: the index built from the file
+        """
+        index = CSLIndex.from_file(filename or cls.filename)
+        index.save_snapshot(cls.snapshot_filename)
+        LOGGER.info("compiled %d lines into %s (version %s)", len(index.rows), cls.snapshot_filename, index.version)
+        return index
 
     @classmethod
     def load_file(cls):
         """
-        Load a local CSL file.
-        if not existing, load a new file from web.
+        Load the compiled snapshot into the shared index, when it is newer than the current index.
+        Snapshots are compiled before the file they are compiled from replaces the local CSL file,
+        so screening never parses the file: the current index keeps serving until a newer snapshot shows up.
+        The header of a snapshot is only read when the snapshot file changed since the index was loaded.
+        The local file is compiled only when there is no index yet and the snapshot is missing or stale.
+        :return: the current index
         """
-        with open(cls.filename, encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile, delimiter=',')
-            for dict_row in reader:
-                if dict_row['type'] == "Individual":
-                    cls.all_rows.append(dict_row)
-        LOGGER.info("loaded %d lines", len(cls.all_rows))
-        LOGGER.info(cls.all_rows[1].keys())
+        identity = CSLIndex.snapshot_identity(cls.snapshot_filename)
+        if cls.index is not None and identity in (None, cls.index.snapshot_identity):
+            return cls.index
+        with cls.index_lock:
+            identity = CSLIndex.snapshot_identity(cls.snapshot_filename)
+            if cls.index is not None and identity in (None, cls.index.snapshot_identity):
+                return cls.index
+            snapshot_version = CSLIndex.snapshot_version(cls.snapshot_filename)
+            if cls.index is None and (snapshot_version is None or snapshot_version < os.path.getmtime(cls.filename)):
+                index = cls.compile_snapshot()
+            elif snapshot_version is not None and (cls.index is None or cls.index.version < snapshot_version):
+                index = CSLIndex.from_snapshot(cls.snapshot_filename)
+            else:
+                # The snapshot was rewritten without getting newer, e.g. by another worker compiling the same file.
+                cls.index.snapshot_identity = identity
+                return cls.index
+            LOGGER.info("loaded %d lines (version %s)", len(index.rows), index.version)
+            # Swapping a single reference is atomic, readers see either the old or the new index.
+            cls.index = index
+            cls.screening_cache.clear()
+        return cls.index
+
+    @classmethod
+    def get_index(cls):
+        """Get the shared index, keeping the current one if the local file is gone."""
+        try:
+            return cls.load_file()
+        except FileNotFoundError:
+            if cls.index is None:
+                raise
+            LOGGER.warning("local file '%s' not found, using index version %s", cls.filename, cls.index.version)
+            return cls.index
 
     @classmethod
     def score(cls, search_query, *search_rows):
@@ -86,26 +658,23 @@ class CSLListChecker:
         :param search_rows: names of rows to search in
         :return: score based on fuzzy search
         """
-        top_score = 0.0
-        programs = ''
-        search_query = search_query.lower()
-        for row in cls.all_rows:
-            search_string = ' '.join([row[row_name] for row_name in search_rows]).lower()
-            ratio = fuzzywuzzy.fuzz.ratio(search_query, search_string) / 100
-            partial_ratio = fuzzywuzzy.fuzz.partial_ratio(search_query, search_string) / 100
-
-            # score is based on partial fuzzy search plus a small factor for full search
-            fuzzy_score = min(1.0, FUZZY_MATCH_WEIGHT * partial_ratio + ratio / EXACT_MATCH_WEIGHT)
-            if fuzzy_score > .6 and fuzzy_score > top_score:
-                top_score = fuzzy_score
-                programs = str(row['programs'])
+        return cls.report(*cls.get_index().top_match(search_query, *search_rows))
+
+    @staticmethod
+    def report(top_score, programs):
+        """
+        Turn a top match into a risk score and report it to countly.
+        :param top_score: top fuzzy score
+        :param programs: programs of the top matching row
+        :return: risk score
+        """
         final_score = top_score ** 2
         if final_score > .95:
-            util.countly.send_countly_event('KYC_verify', 1, programs=programs, result='flagged')
+            telemetry.send_event('KYC_verify', 1, programs=programs, result='flagged')
         elif final_score > .85:
-            util.countly.send_countly_event('KYC_verify', 1, programs=programs, result='suspicious')
+            telemetry.send_event('KYC_verify', 1, programs=programs, result='suspicious')
         else:
-            util.countly.send_countly_event('KYC_verify', 1, result='pass', hour=17)
+            telemetry.send_event('KYC_verify', 1, result='pass', hour=17)
         return final_score
 
     @classmethod
@@ -115,9 +684,41 @@ class CSLListChecker:
         :param name: name to look for. Order should be "Family Name, Surname"
         :return: score based on fuzzy search
         """
-        return cls.score(name, 'name', 'alt_names')
+        index = cls.get_index()
+        key = (index.version, SCORING_ENGINE, name.lower())
+        top_match = cls.screening_cache.get(key)
+        if top_match is None:
+            top_match = index.top_match(name, *NAME_ROWS)
+            cls.screening_cache.put(key, top_match)
+        return cls.report(*top_match)
+
+    @staticmethod
+    def test_result(score):
+        """Return -1 for fail and 1 for pass."""
+        return -1 if score > VALIDATION_SCORE_THRESHOLD else 1
 
     @classmethod
     def basic_test(cls, name):
         """Return -1 for fail and 1 for pass."""
-        return -1 if cls.score_name(name) > VALIDATION_SCORE_THRESHOLD else 1
+        return cls.test_result(cls.score_name(name))
+
+
+def top_name_match(name):
+    """Find the top match of a name in the shared index - run by the batch workers."""
+    return CSLListChecker.get_index().top_match(name, *NAME_ROWS)
+
+
+def batch_basic_test(names, processes=None):
+    """
+    Run the basic test on many names with a process pool.
+    The index is built before the pool starts, so forked workers share it instead of loading their own.
+    Workers only search, reporting is done by the calling process.
+    :param names: names to test
+    :param processes: number of worker processes, defaults to the number of CPUs
+    :return: list of results, in the order of names
+    """
+    processes = processes or os.cpu_count()
+    CSLListChecker.get_index()
+    with multiprocessing.Pool(processes) as pool:
+        top_matches = pool.map(top_name_match, names, chunksize=max(1, len(names) // (processes * 4)))
+    return [CSLListChecker.test_result(CSLListChecker.report(*top_match)) for top_match in top_matches]
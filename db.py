@@ -1,6 +1,9 @@
 """PAKET database interface."""
+import collections
+import contextlib
 import logging
 import os
+import threading
 import time
 
 import pywallet.wallet
@@ -12,6 +15,7 @@ import util.db
 import util.conversion
 
 import csl_reader
+import db_pool
 import prices
 
 VERIFY_API_KEY = os.environ.get('PAKET_VERIFY_API_KEY')
@@ -26,13 +30,22 @@ DB_PORT = int(os.environ.get('PAKET_DB_PORT', 3306))
 DB_USER = os.environ.get('PAKET_DB_USER', 'root')
 DB_PASSWORD = os.environ.get('PAKET_DB_PASSWORD')
 DB_NAME = os.environ.get('PAKET_DB_NAME', 'paket')
-SQL_CONNECTION = util.db.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME)
+SQL_POOL = db_pool.custom_sql_connection(DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME)
+SQL_CONNECTION = SQL_POOL.connection
 HOURLY_FUND_LIMIT = int(os.environ.get('PAKET_HOURLY_FUND_LIMIT'))
 DAILY_FUND_LIMIT = int(os.environ.get('PAKET_DAILY_FUND_LIMIT'))
 EUR_XLM_STARTING_BALANCE = int(os.environ.get('PAKET_EUR_XLM_STARTING_BALANCE'))
 EUR_BUL_STARTING_BALANCE = int(os.environ.get('PAKET_EUR_BUL_STARTING_BALANCE'))
-XLM_STARTING_BALANCE = util.conversion.euro_cents_to_xlm_stroops(EUR_XLM_STARTING_BALANCE, prices.xlm_price())
-BUL_STARTING_BALANCE = util.conversion.euro_cents_to_bul_stroops(EUR_BUL_STARTING_BALANCE, prices.bul_price())
+# Spend buckets cover the longest fund limit period.
+SPEND_WINDOW = 24 * 60 * 60
+# Reservations not sent for this long are considered abandoned by crashed workers, and released on reconciliation.
+RESERVATION_TIMEOUT = 60 * 60
+USER_CACHE_SIZE = int(os.environ.get('PAKET_USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.environ.get('PAKET_USER_CACHE_TTL', 300))
+# Unknown users are cached shortly, since another process may create them.
+USER_CACHE_NEGATIVE_TTL = float(os.environ.get('PAKET_USER_CACHE_NEGATIVE_TTL', 5))
+# Number of purchase status writes PurchaseWriter accumulates before writing them.
+PURCHASE_FLUSH_SIZE = int(os.environ.get('PAKET_PURCHASE_FLUSH_SIZE', 100))
 MINIMUM_PAYMENT = int(os.environ.get('PAKET_MINIMUM_PAYMENT', 500))
 BASIC_MONTHLY_ALLOWANCE = int(os.environ.get('PAKET_BASIC_MONTHLY_ALLOWANCE', 5000))
 
@@ -42,6 +55,8 @@ PURCHASE_UNPAID = 0
 PURCHASE_PAID = 1
 PURCHASE_FUNDED = 2
 PURCHASE_PARTIALLY_FUNDED = 3
+# payout submitted, whether it was sent is unknown until it is reconciled
+PURCHASE_SENDING = 4
 
 
 class FundLimitReached(Exception):
@@ -72,6 +87,84 @@ class UserAlreadyExists(Exception):
     """User already exists."""
 
 
+class SchemaOutdated(Exception):
+    """Database schema is missing migrations the code relies on."""
+
+
+class UserCache:
+    """
+    LRU cache of users, keyed by ('pubkey', pubkey) and ('call_sign', lowercased call sign).
+    Unknown users are cached as None, for a shorter TTL.
+    """
+
+    def __init__(self, size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL, negative_ttl=USER_CACHE_NEGATIVE_TTL,
+                 clock=time.monotonic):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def get(self, key):
+        """
+        Get a cached user.
+        :return: tuple of found flag and the user, None for a cached unknown user
+        """
+        with self.lock:
+            try:
+                user, expires_at = self.entries[key]
+            except KeyError:
+                self.counters['misses'] += 1
+                return False, None
+            if self.clock() >= expires_at:
+                del self.entries[key]
+                self.counters['misses'] += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.counters['hits' if user is not None else 'negative_hits'] += 1
+            return True, None if user is None else dict(user)
+
+    def put(self, key, user):
+        """Cache a user under all its keys, or an unknown user under the key it was looked up by."""
+        with self.lock:
+            if user is None:
+                keys = [key]
+                expires_at = self.clock() + self.negative_ttl
+            else:
+                user = dict(user)
+                keys = [('pubkey', user['pubkey']), ('call_sign', user['call_sign'].lower())]
+                expires_at = self.clock() + self.ttl
+            for user_key in keys:
+                self.entries[user_key] = (user, expires_at)
+                self.entries.move_to_end(user_key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        """Drop cached entries."""
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        """Drop all cached users."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Get hit and miss counters."""
+        with self.lock:
+            lookups = sum(self.counters.values())
+            return dict(
+                self.counters, entries=len(self.entries),
+                hit_rate=(self.counters['hits'] + self.counters['negative_hits']) / lookups if lookups else 0.0)
+
+
+USER_CACHE = UserCache()
+
+
 def init_db():
     """Initialize the database."""
     with SQL_CONNECTION() as sql:
@@ -120,6 +213,149 @@ def init_db():
                 PRIMARY KEY (timestamp, user_pubkey),
                 FOREIGN KEY(user_pubkey) REFERENCES users(pubkey))''')
         LOGGER.debug('fundings table created')
+    migrate()
+
+
+def create_index(sql, table, name, columns):
+    """Create an index, unless a previous run of the migration already created it."""
+    sql.execute('''
+        SELECT COUNT(*) FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s''', (table, name))
+    # computed columns may be keyed by bytes, so take the only value
+    if list(sql.fetchall()[0].values())[0]:
+        LOGGER.debug("index %s already exists", name)
+        return
+    sql.execute("CREATE INDEX {} ON {} ({})".format(name, table, columns))
+    LOGGER.debug("index %s created", name)
+
+
+def migration_indexes(sql):
+    """Add indexes for the hot queries."""
+    create_index(sql, 'purchases', 'purchases_payment_pubkey', 'payment_pubkey, timestamp')
+    create_index(sql, 'purchases', 'purchases_user_pubkey', 'user_pubkey, timestamp')
+    create_index(sql, 'purchases', 'purchases_paid', 'paid, payment_pubkey')
+    create_index(sql, 'test_results', 'test_results_pubkey_name', 'pubkey, name, timestamp')
+    create_index(sql, 'internal_user_infos', 'internal_user_infos_pubkey', 'pubkey, timestamp')
+    create_index(sql, 'fundings', 'fundings_currency', 'currency, user_pubkey')
+
+
+def migration_current_purchases(sql):
+    """Add the current_purchases table, holding the latest status of each purchase."""
+    sql.execute('''
+        CREATE TABLE IF NOT EXISTS current_purchases(
+            payment_pubkey VARCHAR(56) PRIMARY KEY,
+            timestamp TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+            user_pubkey VARCHAR(56) NOT NULL,
+            payment_currency VARCHAR(3) NOT NULL,
+            requested_currency VARCHAR(3) NOT NULL DEFAULT 'BUL',
+            euro_cents INTEGER NOT NULL,
+            paid INTEGER DEFAULT 0,
+            INDEX current_purchases_paid (paid),
+            FOREIGN KEY(user_pubkey) REFERENCES users(pubkey))''')
+    sql.execute('''
+        INSERT INTO current_purchases (
+            payment_pubkey, timestamp, user_pubkey, payment_currency, requested_currency, euro_cents, paid)
+        SELECT payment_pubkey, timestamp, user_pubkey, payment_currency, requested_currency, euro_cents, paid
+        FROM purchases AS history
+        WHERE timestamp = (SELECT MAX(timestamp) FROM purchases WHERE payment_pubkey = history.payment_pubkey)
+        ON DUPLICATE KEY UPDATE payment_pubkey = current_purchases.payment_pubkey''')
+
+
+def migration_lower_call_signs(sql):
+    """Store all call signs in lower case, so prefix searches are range scans of the call_sign index."""
+    sql.execute('UPDATE users SET call_sign = LOWER(call_sign) WHERE call_sign <> BINARY LOWER(call_sign)')
+
+
+def migration_spend_buckets(sql):
+    """Add the spend_buckets table, holding the euro cents funded in each minute."""
+    sql.execute('''
+        CREATE TABLE IF NOT EXISTS spend_buckets(
+            minute BIGINT PRIMARY KEY,
+            euro_cents BIGINT NOT NULL DEFAULT 0)''')
+    fill_spend_buckets(sql)
+
+
+def migration_fund_reservations(sql):
+    """Add the fund_reservations table and the spend_lock row serializing reservations."""
+    sql.execute('''
+        CREATE TABLE IF NOT EXISTS fund_reservations(
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            timestamp TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+            minute BIGINT NOT NULL,
+            user_pubkey VARCHAR(56) NOT NULL,
+            euro_cents INTEGER NOT NULL)''')
+    sql.execute('CREATE TABLE IF NOT EXISTS spend_lock(id INTEGER PRIMARY KEY)')
+    sql.execute('INSERT INTO spend_lock (id) VALUES (1) ON DUPLICATE KEY UPDATE id = id')
+    rebuild_spend_buckets(sql)
+
+
+def migration_current_purchases_timestamp(sql):
+    """Index current purchases by status and time of change, for picking up new purchases incrementally."""
+    create_index(sql, 'current_purchases', 'current_purchases_paid_timestamp', 'paid, timestamp')
+
+
+def migration_fund_reservations_sent(sql):
+    """Flag reservations whose funds were sent, so reconciliation never releases them."""
+    sql.execute('''
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s''', ('fund_reservations', 'sent'))
+    # computed columns may be keyed by bytes, so take the only value
+    if not list(sql.fetchall()[0].values())[0]:
+        sql.execute('ALTER TABLE fund_reservations ADD COLUMN sent TINYINT NOT NULL DEFAULT 0')
+
+
+def migration_block_payments(sql):
+    """Add the totals paid to payment addresses in block data, and the height of the last block read per network."""
+    sql.execute('''
+        CREATE TABLE IF NOT EXISTS block_payments(
+            payment_pubkey VARCHAR(56) PRIMARY KEY,
+            amount DECIMAL(65) NOT NULL)''')
+    sql.execute('''
+        CREATE TABLE IF NOT EXISTS block_heights(
+            network VARCHAR(3) PRIMARY KEY,
+            height BIGINT NOT NULL)''')
+
+
+# Schema migrations by version, the first one is version 1.
+# Migrations must be safe to run again on a schema that already has them.
+MIGRATIONS = [
+    migration_indexes, migration_current_purchases, migration_lower_call_signs, migration_spend_buckets,
+    migration_fund_reservations, migration_current_purchases_timestamp, migration_fund_reservations_sent,
+    migration_block_payments]
+
+
+def get_schema_version():
+    """Get the version of the latest migration applied to the database."""
+    with SQL_CONNECTION() as sql:
+        sql.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations(
+                version INTEGER PRIMARY KEY,
+                timestamp TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6))''')
+        sql.execute('SELECT MAX(version) FROM schema_migrations')
+        return list(sql.fetchall()[0].values())[0] or 0
+
+
+def migrate():
+    """Upgrade the database in place by applying the migrations it does not have yet."""
+    version = get_schema_version()
+    for new_version, migration in enumerate(MIGRATIONS[version:], version + 1):
+        LOGGER.info("migrating database to version %s: %s", new_version, migration.__doc__)
+        with SQL_CONNECTION() as sql:
+            migration(sql)
+            sql.execute('INSERT INTO schema_migrations (version) VALUES (%s)', (new_version,))
+
+
+def check_schema():
+    """
+    Check that the database has all the migrations, before serving on it.
+    :raise SchemaOutdated: if migrations are missing, run `python routines.py migrate` first
+    """
+    version = get_schema_version()
+    if version < len(MIGRATIONS):
+        raise SchemaOutdated("database schema is version {}, version {} is required - run migrations first".format(
+            version, len(MIGRATIONS)))
+    if version > len(MIGRATIONS):
+        LOGGER.warning("database schema version %s is newer than this code (%s)", version, len(MIGRATIONS))
 
 
 def request_verification_code(user_pubkey):
@@ -166,8 +402,9 @@ def check_verification_code(user_pubkey, verification_code):
 
 def create_user(pubkey, call_sign):
     """Create a new user."""
+    # cached unknown users may have been created by another process meanwhile
     try:
-        get_user(pubkey=pubkey)
+        get_user(pubkey=pubkey, cached=False)
     except UnknownUser:
         pass
     else:
@@ -175,7 +412,7 @@ def create_user(pubkey, call_sign):
             "user with provided pubkey ({}) already exists".format(pubkey))
 
     try:
-        get_user(call_sign=call_sign)
+        get_user(call_sign=call_sign, cached=False)
     except UnknownUser:
         pass
     else:
@@ -184,30 +421,73 @@ def create_user(pubkey, call_sign):
 
     with SQL_CONNECTION() as sql:
         sql.execute("INSERT INTO users (pubkey, call_sign) VALUES (%s, %s)", (pubkey, call_sign.lower()))
+    USER_CACHE.invalidate(('pubkey', pubkey), ('call_sign', call_sign.lower()))
 
 
-def get_user(pubkey=None, call_sign=None):
-    """Get user pubkey, call_sign, and purchase allowance from either pubkey or call_sign."""
+def get_user(pubkey=None, call_sign=None, cached=True):
+    """
+    Get user pubkey, call_sign, and purchase allowance from either pubkey or call_sign.
+    :param cached: serve the user from USER_CACHE, reading through to the database on a miss
+    """
     assert bool(pubkey or call_sign) != bool(pubkey and call_sign), 'specify either pubkey or call_sign'
     condition = ('pubkey', pubkey) if pubkey else ('call_sign', call_sign.lower())
+    if cached:
+        found, user = USER_CACHE.get(condition)
+        if found:
+            if user is None:
+                raise UnknownUser("user with {} {} does not exists".format(*condition))
+            return user
     with SQL_CONNECTION() as sql:
         sql.execute("SELECT * FROM users WHERE {} = %s LIMIT 1".format(condition[0]), (condition[1],))
-        try:
-            return sql.fetchall()[0]
-        except IndexError:
-            raise UnknownUser("user with {} {} does not exists".format(*condition))
+        users = sql.fetchall()
+    USER_CACHE.put(condition, users[0] if users else None)
+    try:
+        return users[0]
+    except IndexError:
+        raise UnknownUser("user with {} {} does not exists".format(*condition))
 
 
-def get_callsings(call_sign_prefix=None):
-    """Get registered call signs which starts with specified string."""
+def get_callsings(call_sign_prefix=None, after_call_sign=None, limit=None):
+    """
+    Get registered call signs which starts with specified string, ordered by call sign.
+    :param call_sign_prefix: prefix of the call signs, case insensitive
+    :param after_call_sign: get call signs after this one, for paging through call signs
+    :param limit: maximal number of call signs to get, None for all
+    """
+    query = 'SELECT pubkey, call_sign FROM users WHERE call_sign > %s'
+    args = [(after_call_sign or '').lower()]
+    if call_sign_prefix:
+        # call signs are stored in lower case, so the prefix is a range scan of the call_sign index
+        query += " AND call_sign LIKE %s ESCAPE '!'"
+        args.append(''.join(
+            '!' + char if char in '!%_' else char for char in call_sign_prefix.lower()) + '%')
+    query += ' ORDER BY call_sign'
+    if limit is not None:
+        query += ' LIMIT %s'
+        args.append(int(limit))
     with SQL_CONNECTION() as sql:
-        if call_sign_prefix is not None and call_sign_prefix:
-            sql.execute("SELECT * FROM users WHERE call_sign LIKE %s", (call_sign_prefix.lower() + '%',))
-        else:
-            sql.execute('SELECT * FROM users')
+        sql.execute(query, args)
         return sql.fetchall()
 
 
+def iter_callsign_pages(call_sign_prefix=None, page_size=1000):
+    """Iterate over pages of all call signs which starts with specified string."""
+    after_call_sign = None
+    while True:
+        page = get_callsings(call_sign_prefix, after_call_sign, page_size)
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        after_call_sign = page[-1]['call_sign']
+
+
+def iter_callsigns(call_sign_prefix=None, page_size=1000):
+    """Iterate over all call signs which starts with specified string, reading them a page at a time."""
+    for page in iter_callsign_pages(call_sign_prefix, page_size):
+        yield from page
+
+
 def update_test(pubkey, test_name, result=None):
     """Update a test for a user."""
     with SQL_CONNECTION() as sql:
@@ -218,6 +498,20 @@ def update_test(pubkey, test_name, result=None):
             raise UnknownUser("no user with pubkey {}".format(pubkey))
 
 
+def update_tests(test_name, results):
+    """
+    Update a test for many users at once.
+    :param test_name: name of the test
+    :param results: dict of test results by user pubkey
+    """
+    with SQL_CONNECTION() as sql:
+        try:
+            sql.executemany("INSERT INTO test_results (pubkey, name, result) VALUES (%s, %s, %s)", [
+                (pubkey, test_name, result) for pubkey, result in results.items()])
+        except util.db.mysql.connector.IntegrityError:
+            raise UnknownUser("no user with one of the pubkeys {}".format(', '.join(results)))
+
+
 def get_test_result(pubkey, test_name):
     """Get the latest result of a test."""
     with SQL_CONNECTION() as sql:
@@ -242,6 +536,17 @@ def get_internal_user_infos(pubkey):
             return {}
 
 
+def get_full_names():
+    """Get full names of all users whose latest infos have all the basic details filled."""
+    with SQL_CONNECTION() as sql:
+        sql.execute('''
+            SELECT pubkey, full_name, phone_number, address FROM internal_user_infos AS infos
+            WHERE timestamp = (SELECT MAX(timestamp) FROM internal_user_infos WHERE pubkey = infos.pubkey)''')
+        return {
+            user_infos['pubkey']: user_infos['full_name'] for user_infos in sql.fetchall()
+            if all([user_infos[key] for key in ['full_name', 'phone_number', 'address']])}
+
+
 def get_user_infos(pubkey):
     """Get user infos, excluding sensitive data."""
     user_infos = get_internal_user_infos(pubkey)
@@ -318,16 +623,165 @@ def get_payment_address(user_pubkey, euro_cents, payment_currency, requested_cur
     return payment_pubkey
 
 
+def fill_spend_buckets(sql):
+    """Refill the spend buckets of the last SPEND_WINDOW seconds from the fundings, dropping older buckets."""
+    sql.execute('DELETE FROM spend_buckets')
+    sql.execute('''
+        INSERT INTO spend_buckets (minute, euro_cents)
+        SELECT FLOOR(UNIX_TIMESTAMP(timestamp) / 60) AS bucket, SUM(COALESCE(euro_cents, 0)) FROM fundings
+        WHERE timestamp >= FROM_UNIXTIME(UNIX_TIMESTAMP() - %s) GROUP BY bucket''', (SPEND_WINDOW + 60,))
+
+
+def rebuild_spend_buckets(sql):
+    """Rebuild the spend buckets from the fundings and the pending reservations."""
+    fill_spend_buckets(sql)
+    # reservations not sent for RESERVATION_TIMEOUT seconds were abandoned by their workers,
+    # sent ones were paid out and keep counting until their funding is recorded by hand
+    sql.execute('''
+        DELETE FROM fund_reservations
+        WHERE NOT sent AND timestamp < FROM_UNIXTIME(UNIX_TIMESTAMP() - %s)''', (RESERVATION_TIMEOUT,))
+    sql.execute('''
+        SELECT id, user_pubkey, euro_cents FROM fund_reservations
+        WHERE sent AND timestamp < FROM_UNIXTIME(UNIX_TIMESTAMP() - %s)''', (RESERVATION_TIMEOUT,))
+    for reservation in sql.fetchall():
+        LOGGER.error(
+            "funds of reservation %s (%s euro cents to %s) were sent but never recorded in fundings",
+            reservation['id'], reservation['euro_cents'], reservation['user_pubkey'])
+    sql.execute('''
+        INSERT INTO spend_buckets (minute, euro_cents)
+        SELECT minute, SUM(euro_cents) FROM fund_reservations GROUP BY minute
+        ON DUPLICATE KEY UPDATE euro_cents = spend_buckets.euro_cents + VALUES(euro_cents)''')
+
+
+def reconcile_spend_buckets():
+    """Reconcile the spend buckets with the fundings, e.g. after fundings were edited by hand."""
+    with SQL_CONNECTION() as sql:
+        sql.execute('INSERT INTO spend_lock (id) VALUES (1) ON DUPLICATE KEY UPDATE id = id')
+        rebuild_spend_buckets(sql)
+
+
+def sum_spend_buckets(sql, period):
+    """Sum the spend buckets of the last period seconds, in the caller's transaction."""
+    assert period <= SPEND_WINDOW, "spend buckets older than {} seconds are dropped".format(SPEND_WINDOW)
+    sql.execute('''
+        SELECT CAST(SUM(euro_cents) AS SIGNED) FROM spend_buckets
+        WHERE minute >= FLOOR((UNIX_TIMESTAMP() - %s) / 60)''', (period,))
+    return list(sql.fetchall()[0].values())[0] or 0
+
+
 def get_spent_euro(period):
-    """Get spent euro-cents amount for specified period of time."""
+    """
+    Get spent euro-cents amount for the last period seconds, summed from per-minute spend buckets.
+    Reserved funds count as spent. The bucket of the minute the period starts in is counted whole,
+    so the amount errs on the high side.
+    """
+    with SQL_CONNECTION() as sql:
+        return sum_spend_buckets(sql, period)
+
+
+def reserve_funds(user_pubkey, euro_cents):
+    """
+    Atomically check the fund limits and reserve funds, before sending them.
+    Reservations are serialized on the spend_lock row, so concurrent workers can not all pass the check.
+    :return: id of the reservation, to commit with commit_reservation or release with release_reservation
+    :raise FundLimitReached: if the reservation would exceed the hourly or daily fund limit
+    """
     with SQL_CONNECTION() as sql:
+        # inserting or updating the lock row locks it until the transaction ends
+        sql.execute('INSERT INTO spend_lock (id) VALUES (1) ON DUPLICATE KEY UPDATE id = id')
+        if sum_spend_buckets(sql, SPEND_WINDOW) + euro_cents > DAILY_FUND_LIMIT:
+            raise FundLimitReached('daily fund limit reached')
+        if sum_spend_buckets(sql, 60 * 60) + euro_cents > HOURLY_FUND_LIMIT:
+            raise FundLimitReached('hourly fund limit reached')
         sql.execute('''
-            SELECT CAST(SUM(euro_cents) AS SIGNED) euro_cents FROM fundings
-            WHERE timestamp > %s''', (period,))
+            INSERT INTO fund_reservations (minute, user_pubkey, euro_cents)
+            VALUES (FLOOR(UNIX_TIMESTAMP() / 60), %s, %s)''', (user_pubkey, euro_cents))
+        reservation_id = sql.lastrowid
+        sql.execute('''
+            INSERT INTO spend_buckets (minute, euro_cents)
+            SELECT minute, euro_cents FROM fund_reservations WHERE id = %s
+            ON DUPLICATE KEY UPDATE euro_cents = spend_buckets.euro_cents + VALUES(euro_cents)''', (reservation_id,))
+        return reservation_id
+
+
+def get_reservation(sql, reservation_id):
+    """Get a reservation, locking it until the caller's transaction ends."""
+    sql.execute('SELECT * FROM fund_reservations WHERE id = %s FOR UPDATE', (reservation_id,))
+    try:
+        return sql.fetchall()[0]
+    except IndexError:
+        raise KeyError("no fund reservation {}".format(reservation_id))
+
+
+def commit_reservation(reservation_id, currency, currency_amount, euro_cents=None):
+    """
+    Record the funding of a reservation, after the funds were sent.
+    :param euro_cents: the amount actually sent, if it differs from the reserved amount
+    """
+    with SQL_CONNECTION() as sql:
+        reservation = get_reservation(sql, reservation_id)
+        euro_cents = reservation['euro_cents'] if euro_cents is None else euro_cents
+        sql.execute('''
+            INSERT INTO fundings (user_pubkey, currency, currency_amount, euro_cents)
+            VALUES (%s, %s, %s, %s)''', (reservation['user_pubkey'], currency, currency_amount, euro_cents))
+        sql.execute('UPDATE spend_buckets SET euro_cents = euro_cents + %s WHERE minute = %s', (
+            euro_cents - reservation['euro_cents'], reservation['minute']))
+        sql.execute('DELETE FROM fund_reservations WHERE id = %s', (reservation_id,))
+
+
+def mark_reservation_sent(reservation_id):
+    """Flag a reservation as sent, so it is never released even if its funding is not recorded."""
+    with SQL_CONNECTION() as sql:
+        sql.execute('UPDATE fund_reservations SET sent = 1 WHERE id = %s', (reservation_id,))
+
+
+def release_reservation(reservation_id):
+    """Release reserved funds that were not sent."""
+    with SQL_CONNECTION() as sql:
+        reservation = get_reservation(sql, reservation_id)
+        sql.execute('UPDATE spend_buckets SET euro_cents = euro_cents - %s WHERE minute = %s', (
+            reservation['euro_cents'], reservation['minute']))
+        sql.execute('DELETE FROM fund_reservations WHERE id = %s', (reservation_id,))
+
+
+class FundReservation:
+    """Funds reserved by reserved_funds."""
+
+    def __init__(self, reservation_id):
+        self.reservation_id = reservation_id
+        self.sent = False
+
+    def mark_sent(self):
+        """Record that the funds were sent, right after sending them."""
+        # flagged first, so the reservation is kept even if the database fails
+        self.sent = True
+        mark_reservation_sent(self.reservation_id)
+
+    def commit(self, currency, currency_amount, euro_cents=None):
+        """Record the funding of the reservation, see commit_reservation."""
+        commit_reservation(self.reservation_id, currency, currency_amount, euro_cents)
+
+
+@contextlib.contextmanager
+def reserved_funds(user_pubkey, euro_cents):
+    """
+    Context manager reserving funds, releasing them if the block raises before they were marked as sent.
+    Sent funds are never released: if recording them fails, the reservation stays pending and keeps counting.
+    """
+    reservation = FundReservation(reserve_funds(user_pubkey, euro_cents))
+    try:
+        yield reservation
+    except Exception:
+        if reservation.sent:
+            LOGGER.critical(
+                "funds of reservation %s (%s euro cents to %s) were sent but not recorded, "
+                "the reservation is left pending", reservation.reservation_id, euro_cents, user_pubkey)
+            raise
         try:
-            return sql.fetchall()[0][b'euro_cents'] or 0
-        except TypeError:
-            return 0
+            release_reservation(reservation.reservation_id)
+        except KeyError:
+            pass
+        raise
 
 
 def get_hourly_spent_euro():
@@ -337,7 +791,21 @@ def get_hourly_spent_euro():
 
 def get_daily_spent_euro():
     """Get spent euro-cents amount for last 24 hours."""
-    return get_spent_euro(86400)
+    return get_spent_euro(SPEND_WINDOW)
+
+
+def xlm_starting_balance(xlm_price=None):
+    """
+    Get starting XLM balance in stroops at the current price.
+    :param xlm_price: XLM price in EUR to use, the cached funding price if not specified
+    """
+    return util.conversion.euro_cents_to_xlm_stroops(
+        EUR_XLM_STARTING_BALANCE, xlm_price or prices.xlm_price(funding=True))
+
+
+def bul_starting_balance():
+    """Get starting BUL balance in stroops at the current price."""
+    return util.conversion.euro_cents_to_bul_stroops(EUR_BUL_STARTING_BALANCE, prices.bul_price())
 
 
 def create_and_fund(user_pubkey):
@@ -350,38 +818,35 @@ def create_and_fund(user_pubkey):
         LOGGER.info("stellar account with pubkey %s already exists", user_pubkey)
         return
 
-    daily_spent_euro = get_daily_spent_euro()
-    if daily_spent_euro >= DAILY_FUND_LIMIT:
-        raise FundLimitReached('daily fund limit reached')
-
-    hourly_spent_euro = get_hourly_spent_euro()
-    if hourly_spent_euro >= HOURLY_FUND_LIMIT:
-        raise FundLimitReached('hourly fund limit reached')
-
-    starting_balance = util.conversion.stroops_to_units(XLM_STARTING_BALANCE)
-    funder_pubkey = paket_stellar.stellar_base.Keypair.from_seed(FUNDER_SEED).address().decode()
-    builder = paket_stellar.gen_builder(funder_pubkey)
-    builder.append_create_account_op(destination=user_pubkey, starting_balance=starting_balance)
-    envelope = builder.gen_te().xdr().decode()
-    paket_stellar.submit_transaction_envelope(envelope, seed=FUNDER_SEED)
-    euro_cents = util.conversion.xlm_to_euro_cents(XLM_STARTING_BALANCE, prices.xlm_price())
-    with SQL_CONNECTION() as sql:
-        sql.execute("""
-            INSERT INTO fundings (user_pubkey, currency, currency_amount, euro_cents)
-            VALUES (%s, %s, %s, %s)""", (user_pubkey, 'XLM', XLM_STARTING_BALANCE, euro_cents))
+    # the same price for the amount sent and the amount accounted
+    xlm_price = prices.xlm_price(funding=True)
+    xlm_amount = xlm_starting_balance(xlm_price)
+    euro_cents = util.conversion.xlm_to_euro_cents(xlm_amount, xlm_price)
+    with reserved_funds(user_pubkey, euro_cents) as reservation:
+        starting_balance = util.conversion.stroops_to_units(xlm_amount)
+        funder_pubkey = paket_stellar.stellar_base.Keypair.from_seed(FUNDER_SEED).address().decode()
+        builder = paket_stellar.gen_builder(funder_pubkey)
+        builder.append_create_account_op(destination=user_pubkey, starting_balance=starting_balance)
+        envelope = builder.gen_te().xdr().decode()
+        paket_stellar.submit_transaction_envelope(envelope, seed=FUNDER_SEED)
+        reservation.mark_sent()
+        reservation.commit('XLM', xlm_amount)
 
 
 def fund(user_pubkey):
-    """Fund account with starting BUL amount."""
-    funder_pubkey = paket_stellar.stellar_base.Keypair.from_seed(FUNDER_SEED).address().decode()
-    prepare_fund_transaction = paket_stellar.prepare_send_buls(
-        funder_pubkey, user_pubkey, BUL_STARTING_BALANCE)
-    paket_stellar.submit_transaction_envelope(prepare_fund_transaction, FUNDER_SEED)
-    euro_cents = util.conversion.bul_to_euro_cents(BUL_STARTING_BALANCE, prices.bul_price())
-    with SQL_CONNECTION() as sql:
-        sql.execute("""
-            INSERT INTO fundings (user_pubkey, currency, currency_amount, euro_cents)
-            VALUES (%s, %s, %s, %s)""", (user_pubkey, 'BUL', BUL_STARTING_BALANCE, euro_cents))
+    """
+    Fund account with starting BUL amount, return the amount in stroops.
+    :raise FundLimitReached: if funding would exceed the hourly or daily fund limit
+    """
+    bul_amount = bul_starting_balance()
+    euro_cents = util.conversion.bul_to_euro_cents(bul_amount, prices.bul_price())
+    with reserved_funds(user_pubkey, euro_cents) as reservation:
+        funder_pubkey = paket_stellar.stellar_base.Keypair.from_seed(FUNDER_SEED).address().decode()
+        prepare_fund_transaction = paket_stellar.prepare_send_buls(funder_pubkey, user_pubkey, bul_amount)
+        paket_stellar.submit_transaction_envelope(prepare_fund_transaction, FUNDER_SEED)
+        reservation.mark_sent()
+        reservation.commit('BUL', bul_amount)
+    return bul_amount
 
 
 def get_unfunded():
@@ -395,32 +860,151 @@ def get_unfunded():
         return sql.fetchall()
 
 
+def write_purchases(sql, purchases):
+    """
+    Add purchases info to the purchases history and update their current status, with multi-row inserts.
+    :param sql: cursor of the caller's transaction
+    :param purchases: list of (user_pubkey, payment_pubkey, payment_currency, euro_cents, requested_currency, paid)
+    """
+    placeholders = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(purchases))
+    values = [value for purchase in purchases for value in purchase]
+    sql.execute('''
+        INSERT INTO purchases (user_pubkey, payment_pubkey, payment_currency, euro_cents, requested_currency, paid)
+        VALUES {}'''.format(placeholders), values)
+    # rows are applied in order, so the last status of a purchase wins
+    sql.execute('''
+        INSERT INTO current_purchases (
+            user_pubkey, payment_pubkey, payment_currency, euro_cents, requested_currency, paid)
+        VALUES {}
+        ON DUPLICATE KEY UPDATE
+            timestamp = CURRENT_TIMESTAMP(6), user_pubkey = VALUES(user_pubkey),
+            payment_currency = VALUES(payment_currency), euro_cents = VALUES(euro_cents),
+            requested_currency = VALUES(requested_currency), paid = VALUES(paid)'''.format(placeholders), values)
+
+
 # pylint: disable=too-many-arguments
 def set_purchase(user_pubkey, payment_pubkey, payment_currency, euro_cents, requested_currency, paid=PURCHASE_UNPAID):
-    """Add purchase info."""
+    """Add purchase info to the purchases history and update the current status of the purchase."""
     with SQL_CONNECTION() as sql:
-        sql.execute('''
-            INSERT INTO purchases (user_pubkey, payment_pubkey, payment_currency, euro_cents, requested_currency, paid)
-            VALUES (%s, %s, %s, %s, %s, %s)''',
-                    (user_pubkey, payment_pubkey, payment_currency, euro_cents, requested_currency, paid))
+        write_purchases(sql, [(user_pubkey, payment_pubkey, payment_currency, euro_cents, requested_currency, paid)])
+
+
+class PurchaseWriter:
+    """
+    Accumulates purchase status writes and writes them together in one transaction.
+    Use as a context manager, to write the remaining purchases when done.
+    """
+
+    def __init__(self, flush_size=PURCHASE_FLUSH_SIZE):
+        assert flush_size > 0, 'flush size must be positive'
+        self.flush_size = flush_size
+        self.purchases = []
+
+    def set_purchase(
+            self, user_pubkey, payment_pubkey, payment_currency, euro_cents, requested_currency,
+            paid=PURCHASE_UNPAID, flush=False):
+        """
+        Add purchase info, like db.set_purchase, writing all accumulated purchases when there are flush_size of them.
+        :param flush: write all accumulated purchases now, e.g. after funds were sent for this one
+        """
+        self.purchases.append((user_pubkey, payment_pubkey, payment_currency, euro_cents, requested_currency, paid))
+        if flush or len(self.purchases) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Write all accumulated purchases in one transaction."""
+        if not self.purchases:
+            return
+        with SQL_CONNECTION() as sql:
+            write_purchases(sql, self.purchases)
+        LOGGER.debug("%s purchases written", len(self.purchases))
+        self.purchases = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.flush()
 # pylint: enable=too-many-arguments
 
 
 def get_purchases(paid_status=None):
-    """Get all purchases or purchases with specified paid status."""
-    if paid_status is not None:
-        sql_query = '''
-            SELECT payment_pubkey AS payment_address, purchases.* FROM purchases
-            HAVING
-                (SELECT paid FROM purchases WHERE payment_pubkey = payment_address ORDER BY timestamp DESC LIMIT 1) = %s
-            AND paid = %s'''
-    else:
-        sql_query = 'SELECT * FROM purchases'
+    """
+    Get the whole purchases history, or the purchases whose current status is the specified paid status.
+    :param paid_status: a paid status, or a list of them
+    """
     with SQL_CONNECTION() as sql:
-        sql.execute(sql_query, (paid_status, paid_status))
+        if paid_status is None:
+            sql.execute('SELECT * FROM purchases')
+        else:
+            paid_statuses = paid_status if isinstance(paid_status, (list, tuple)) else [paid_status]
+            sql.execute('''
+                SELECT payment_pubkey AS payment_address, current_purchases.* FROM current_purchases
+                WHERE paid IN ({})'''.format(', '.join(['%s'] * len(paid_statuses))), paid_statuses)
         return sql.fetchall()
 
 
+def get_purchases_since(paid_status, since):
+    """
+    Get the purchases whose current status is the specified paid status and was set after a time.
+    :param since: datetime of the last status change already seen
+    :return: list of purchases ordered by the time of their last status change
+    """
+    with SQL_CONNECTION() as sql:
+        sql.execute('''
+            SELECT payment_pubkey AS payment_address, current_purchases.* FROM current_purchases
+            WHERE paid = %s AND timestamp > %s ORDER BY timestamp''', (paid_status, since))
+        return sql.fetchall()
+
+
+def get_purchase_statuses(payment_pubkeys):
+    """
+    Get the current paid status of purchases.
+    :param payment_pubkeys: payment addresses of the purchases
+    :return: dict of paid statuses by payment address
+    """
+    if not payment_pubkeys:
+        return {}
+    payment_pubkeys = list(payment_pubkeys)
+    with SQL_CONNECTION() as sql:
+        sql.execute('SELECT payment_pubkey, paid FROM current_purchases WHERE payment_pubkey IN ({})'.format(
+            ', '.join(['%s'] * len(payment_pubkeys))), payment_pubkeys)
+        return {row['payment_pubkey']: row['paid'] for row in sql.fetchall()}
+
+
+def get_block_heights():
+    """Get the height of the last block read from block data, by network."""
+    with SQL_CONNECTION() as sql:
+        sql.execute('SELECT network, height FROM block_heights')
+        return {row['network']: row['height'] for row in sql.fetchall()}
+
+
+def add_block_payments(payments, heights):
+    """
+    Add payments read from block data to the totals paid to their addresses, and record the blocks as read,
+    in one transaction so blocks are never counted twice.
+    :param payments: dict of values paid by payment address
+    :param heights: dict of the height of the last block read, by network
+    :return: dict of the total values paid to the addresses of the payments
+    """
+    with SQL_CONNECTION() as sql:
+        if payments:
+            sql.execute('''
+                INSERT INTO block_payments (payment_pubkey, amount) VALUES {}
+                ON DUPLICATE KEY UPDATE amount = amount + VALUES(amount)'''.format(
+                    ', '.join(['(%s, %s)'] * len(payments))), [value for item in payments.items() for value in item])
+        if heights:
+            sql.execute('''
+                INSERT INTO block_heights (network, height) VALUES {}
+                ON DUPLICATE KEY UPDATE height = GREATEST(height, VALUES(height))'''.format(
+                    ', '.join(['(%s, %s)'] * len(heights))), [value for item in heights.items() for value in item])
+        if not payments:
+            return {}
+        sql.execute('SELECT payment_pubkey, amount FROM block_payments WHERE payment_pubkey IN ({})'.format(
+            ', '.join(['%s'] * len(payments))), list(payments))
+        return {row['payment_pubkey']: int(row['amount']) for row in sql.fetchall()}
+
+
 def get_failed_purchases():
     """Get all failed purchases."""
     return get_purchases(paid_status=PURCHASE_FAILED)
@@ -436,29 +1020,59 @@ def get_paid_purchases():
     return get_purchases(paid_status=PURCHASE_PAID)
 
 
+def get_sending_purchases():
+    """Get all purchases whose payouts may have been sent, to reconcile."""
+    return get_purchases(paid_status=PURCHASE_SENDING)
+
+
 def get_completed_purchases():
     """Get all completed purchases."""
-    return get_purchases(paid_status=PURCHASE_FUNDED) + get_purchases(paid_status=PURCHASE_PARTIALLY_FUNDED)
+    return get_purchases(paid_status=[PURCHASE_FUNDED, PURCHASE_PARTIALLY_FUNDED])
 
 
 def get_current_purchases():
     """Get current status for all purchases."""
     with SQL_CONNECTION() as sql:
         sql.execute('''
-            SELECT DISTINCT payment_pubkey AS payment_address, paid AS paid_status, purchases.* FROM purchases
-            HAVING ((
-                SELECT paid FROM purchases
-                WHERE payment_pubkey = payment_address
-                ORDER BY timestamp DESC LIMIT 1) = paid_status)''')
+            SELECT payment_pubkey AS payment_address, paid AS paid_status, current_purchases.*
+            FROM current_purchases''')
         return sql.fetchall()
 
 
-def get_users():
-    """Get list of users and their details - for debug only."""
+def get_users(after_call_sign=None, limit=None):
+    """
+    Get list of users and their details - for debug only.
+    The latest infos, basic test results and monthly expenses of all users are read in one query.
+    :param after_call_sign: get users with call signs after this one, for paging through users
+    :param limit: maximal number of users to get, None for all
+    :return: dict of user details by call sign, ordered by call sign
+    """
+    query = '''
+        SELECT
+            users.call_sign AS user_call_sign,
+            infos.*,
+            (SELECT result FROM test_results
+             WHERE pubkey = users.pubkey AND name = 'basic' ORDER BY timestamp DESC LIMIT 1) AS basic_result,
+            (SELECT CAST(SUM(euro_cents) AS SIGNED) FROM purchases
+             WHERE user_pubkey = users.pubkey AND timestamp > %s AND paid > %s) AS expenses
+        FROM users LEFT JOIN internal_user_infos AS infos ON infos.pubkey = users.pubkey AND infos.timestamp = (
+            SELECT MAX(timestamp) FROM internal_user_infos WHERE pubkey = users.pubkey)
+        WHERE users.call_sign > %s ORDER BY users.call_sign'''
+    args = [time.time() - (30 * 24 * 60 * 60), PURCHASE_FUNDED, (after_call_sign or '').lower()]
+    if limit is not None:
+        query += ' LIMIT %s'
+        args.append(int(limit))
     with SQL_CONNECTION() as sql:
-        sql.execute('SELECT * FROM users')
-        return {user['call_sign']: dict(
-            get_user_infos(user['pubkey']),
-            monthly_allowance=get_monthly_allowance(user['pubkey']),
-            monthly_expenses=get_monthly_expenses(user['pubkey'])
-        ) for user in sql.fetchall()}
+        sql.execute(query, args)
+        rows = sql.fetchall()
+    users = {}
+    for row in rows:
+        row = {key.decode('utf8') if isinstance(key, bytes) else key: val for key, val in row.items()}
+        call_sign, basic_result, expenses = row.pop('user_call_sign'), row.pop('basic_result'), row.pop('expenses')
+        # users without infos get no infos keys, like get_user_infos
+        user_infos = row if row['pubkey'] is not None else {}
+        users[call_sign] = dict(
+            user_infos,
+            monthly_allowance=BASIC_MONTHLY_ALLOWANCE if (basic_result or 0) > 0 else 0,
+            monthly_expenses=expenses or 0)
+    return users
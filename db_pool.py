@@ -0,0 +1,231 @@
+"""
+Pool of database connections, so requests reuse connections instead of connecting for every query.
+
+The pool keeps up to size idle connections, opens up to overflow more under load, and makes
+callers wait when all of them are in use. Connections are recycled after a maximal age and
+pinged before use when they were idle for a while.
+"""
+import collections
+import contextlib
+import os
+import threading
+import time
+
+import util.db
+import util.logger
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.db_pool')
+POOL_SIZE = int(os.environ.get('PAKET_DB_POOL_SIZE', 5))
+POOL_OVERFLOW = int(os.environ.get('PAKET_DB_POOL_OVERFLOW', 10))
+POOL_TIMEOUT = float(os.environ.get('PAKET_DB_POOL_TIMEOUT', 30))
+POOL_RECYCLE = float(os.environ.get('PAKET_DB_POOL_RECYCLE', 3600))
+# Connections idle for longer than POOL_PING_AFTER seconds are checked before use.
+POOL_PING_AFTER = float(os.environ.get('PAKET_DB_POOL_PING_AFTER', 30))
+
+
+class PoolExhausted(Exception):
+    """No database connection became available in time."""
+
+
+class PooledConnection:
+    """A database connection with its age and idle time."""
+
+    def __init__(self, connection, now):
+        self.connection = connection
+        self.created_at = now
+        self.returned_at = now
+
+    def close(self):
+        """Close the connection, ignoring errors of already broken connections."""
+        # pylint: disable=broad-except
+        try:
+            self.connection.close()
+        except Exception as exception:
+            LOGGER.debug("error closing connection: %s", exception)
+        # pylint: enable=broad-except
+
+
+class ConnectionPool:
+    """
+    Bounded pool of database connections.
+    Counts checkouts, waits, timeouts and connections created, recycled and found dead.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self, connect_function, size=POOL_SIZE, overflow=POOL_OVERFLOW, timeout=POOL_TIMEOUT,
+            recycle=POOL_RECYCLE, ping_after=POOL_PING_AFTER, clock=time.monotonic):
+        assert size > 0, 'pool size must be positive'
+        assert overflow >= 0, 'pool overflow can not be negative'
+        self.connect_function = connect_function
+        self.size = size
+        self.overflow = overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self.clock = clock
+        self.idle = collections.deque()
+        self.open_count = 0
+        self.in_use = 0
+        self.pid = os.getpid()
+        self.condition = threading.Condition()
+        self.counters = collections.Counter()
+        self.checkout_seconds_max = 0
+    # pylint: enable=too-many-arguments
+
+    def count(self, counter, amount=1):
+        """Increase a counter."""
+        with self.condition:
+            self.counters[counter] += amount
+
+    def reset_after_fork(self):
+        """Forget connections inherited from the parent process, they belong to its sockets."""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.idle.clear()
+            self.open_count = self.in_use = 0
+
+    def connect(self):
+        """Open a new connection."""
+        connection = PooledConnection(self.connect_function(), self.clock())
+        self.count('created')
+        return connection
+
+    def is_usable(self, pooled):
+        """Check that an idle connection is young enough and still alive."""
+        now = self.clock()
+        if now - pooled.created_at >= self.recycle:
+            self.count('recycled')
+            return False
+        if now - pooled.returned_at >= self.ping_after:
+            # pylint: disable=broad-except
+            try:
+                alive = pooled.connection.is_connected()
+            except Exception:
+                alive = False
+            # pylint: enable=broad-except
+            if not alive:
+                self.count('dead')
+                return False
+        return True
+
+    def checkout(self):
+        """
+        Take a connection from the pool, opening one if the pool is not full.
+        :return: a PooledConnection
+        :raise PoolExhausted: if no connection became available within the timeout
+        """
+        start = self.clock()
+        deadline = start + self.timeout
+        pooled = None
+        with self.condition:
+            self.reset_after_fork()
+            waited = False
+            while True:
+                if self.idle:
+                    pooled = self.idle.pop()
+                    self.in_use += 1
+                    break
+                if self.open_count < self.size + self.overflow:
+                    self.open_count += 1
+                    self.in_use += 1
+                    break
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    raise PoolExhausted("all {} database connections in use for {} seconds".format(
+                        self.open_count, self.timeout))
+                if not waited:
+                    self.counters['waits'] += 1
+                    waited = True
+                self.condition.wait(remaining)
+        try:
+            if pooled is not None and not self.is_usable(pooled):
+                pooled.close()
+                pooled = None
+            if pooled is None:
+                pooled = self.connect()
+        except Exception:
+            with self.condition:
+                self.open_count -= 1
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+        elapsed = self.clock() - start
+        with self.condition:
+            self.counters['checkouts'] += 1
+            self.counters['checkout_seconds'] += elapsed
+            self.checkout_seconds_max = max(self.checkout_seconds_max, elapsed)
+        return pooled
+
+    def checkin(self, pooled, discard=False):
+        """
+        Return a connection to the pool.
+        :param pooled: a PooledConnection from checkout
+        :param discard: close the connection instead of keeping it, e.g. after an error
+        """
+        with self.condition:
+            if self.pid != os.getpid():
+                return
+            self.in_use -= 1
+            keep = not discard and len(self.idle) < self.size
+            if keep:
+                pooled.returned_at = self.clock()
+                self.idle.append(pooled)
+            else:
+                self.open_count -= 1
+            self.condition.notify()
+        if not keep:
+            pooled.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager for querying the database, commits on success and rolls back on error."""
+        pooled = self.checkout()
+        discard = False
+        try:
+            cursor = pooled.connection.cursor(dictionary=True)
+            try:
+                yield cursor
+                pooled.connection.commit()
+            finally:
+                cursor.close()
+        except Exception:
+            # pylint: disable=broad-except
+            try:
+                pooled.connection.rollback()
+            except Exception as exception:
+                LOGGER.warning("rollback failed, discarding connection: %s", exception)
+                discard = True
+            # pylint: enable=broad-except
+            raise
+        finally:
+            self.checkin(pooled, discard)
+
+    def close(self):
+        """Close all idle connections."""
+        with self.condition:
+            idle = list(self.idle)
+            self.idle.clear()
+            self.open_count -= len(idle)
+        for pooled in idle:
+            pooled.close()
+
+    def stats(self):
+        """Get the counters and the current state of the pool."""
+        with self.condition:
+            return dict(
+                self.counters, open=self.open_count, idle=len(self.idle), in_use=self.in_use,
+                checkout_seconds_max=self.checkout_seconds_max)
+
+
+def custom_sql_connection(host, port, user, password, db_name, **kwargs):
+    """
+    Get a pool of MySQL connections.
+    Its connection method is a drop in replacement of the context manager from util.db.custom_sql_connection.
+    :param kwargs: arguments of ConnectionPool
+    """
+    def connect():
+        """Open a MySQL connection."""
+        return util.db.mysql.connector.connect(host=host, port=port, user=user, password=password, database=db_name)
+    return ConnectionPool(connect, **kwargs)
@@ -0,0 +1,252 @@
+"""
+Long running payment monitor, an incremental replacement of polling all unpaid purchases with `routines.py monitor`.
+
+Watched addresses keep their last seen balance and are re-checked with adaptive backoff: fresh addresses, and
+addresses whose balance just changed, are checked often, addresses that stay unchanged less and less often.
+New purchases are picked up by a cursor on the time of their last status change, and the whole watch list is
+periodically synced with the database, dropping purchases that are no longer unpaid.
+"""
+import collections
+import datetime
+import heapq
+import os
+import time
+
+import util.logger
+
+import db
+import routines
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.monitor')
+MONITOR_MIN_INTERVAL = float(os.environ.get('PAKET_MONITOR_MIN_INTERVAL', 30))
+MONITOR_MAX_INTERVAL = float(os.environ.get('PAKET_MONITOR_MAX_INTERVAL', 60 * 60))
+MONITOR_BACKOFF = float(os.environ.get('PAKET_MONITOR_BACKOFF', 2))
+MONITOR_POLL_INTERVAL = float(os.environ.get('PAKET_MONITOR_POLL_INTERVAL', 5))
+MONITOR_RESYNC_INTERVAL = float(os.environ.get('PAKET_MONITOR_RESYNC_INTERVAL', 10 * 60))
+MONITOR_STATS_INTERVAL = float(os.environ.get('PAKET_MONITOR_STATS_INTERVAL', 60))
+# purchases committed late may carry a timestamp older than the cursor, so the cursor looks back a bit
+MONITOR_CURSOR_OVERLAP = datetime.timedelta(seconds=float(os.environ.get('PAKET_MONITOR_CURSOR_OVERLAP', 60)))
+
+
+class WatchedAddress:
+    """Payment address of an unpaid purchase, with its last seen balance and check schedule."""
+
+    def __init__(self, purchase, next_check, interval):
+        self.purchase = purchase
+        self.balance = None
+        self.checked = None
+        self.next_check = next_check
+        self.interval = interval
+
+
+class WatchList:
+    """
+    Watched addresses, scheduled for checks with adaptive backoff.
+    Addresses are checked every min_interval while new or changing,
+    and the interval grows by backoff, up to max_interval, with every check finding the balance unchanged.
+    """
+
+    def __init__(self, min_interval=MONITOR_MIN_INTERVAL, max_interval=MONITOR_MAX_INTERVAL, backoff=MONITOR_BACKOFF):
+        assert 0 < min_interval <= max_interval, 'intervals must be positive and ordered'
+        assert backoff >= 1, 'backoff must not shorten intervals'
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.addresses = {}
+        # heap of (next_check, address), entries of rescheduled or removed addresses are skipped when popped
+        self.schedule = []
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __contains__(self, address):
+        return address in self.addresses
+
+    def add(self, purchase, now):
+        """
+        Watch the payment address of a purchase, checking it right away.
+        :return: True if the address was not watched yet
+        """
+        address = purchase['payment_pubkey']
+        if address in self.addresses:
+            self.addresses[address].purchase = purchase
+            return False
+        self.addresses[address] = WatchedAddress(purchase, now, self.min_interval)
+        heapq.heappush(self.schedule, (now, address))
+        return True
+
+    def remove(self, address):
+        """Stop watching an address."""
+        self.addresses.pop(address, None)
+
+    def reschedule(self, watched, next_check):
+        """Schedule the next check of a watched address."""
+        watched.next_check = next_check
+        heapq.heappush(self.schedule, (next_check, watched.purchase['payment_pubkey']))
+
+    def is_current(self, next_check, address):
+        """Check if a schedule entry is the current one of a watched address."""
+        return address in self.addresses and self.addresses[address].next_check == next_check
+
+    def due(self, now):
+        """Get the watched addresses due for a check."""
+        due = []
+        while self.schedule and self.schedule[0][0] <= now:
+            next_check, address = heapq.heappop(self.schedule)
+            if self.is_current(next_check, address):
+                due.append(self.addresses[address])
+        return due
+
+    def next_check(self):
+        """Get the time of the next scheduled check, None if nothing is watched."""
+        while self.schedule and not self.is_current(*self.schedule[0]):
+            heapq.heappop(self.schedule)
+        return self.schedule[0][0] if self.schedule else None
+
+    def checked(self, address, balance, now):
+        """
+        Record the balance of a watched address and schedule its next check.
+        :return: True if the balance changed since the previous check
+        """
+        watched = self.addresses[address]
+        changed = watched.balance is not None and balance != watched.balance
+        if watched.balance is None or changed:
+            watched.interval = self.min_interval
+        else:
+            watched.interval = min(watched.interval * self.backoff, self.max_interval)
+        watched.balance, watched.checked = balance, now
+        self.reschedule(watched, now + watched.interval)
+        return changed
+
+    def failed(self, address, now):
+        """Schedule the next check of a watched address whose balance could not be fetched, keeping its interval."""
+        watched = self.addresses[address]
+        self.reschedule(watched, now + watched.interval)
+
+
+class PaymentMonitor:
+    """Watches the payment addresses of unpaid purchases and marks purchases as paid once their balance suffices."""
+
+    def __init__(self, watch_list=None, clock=time.time, resync_interval=MONITOR_RESYNC_INTERVAL):
+        self.watch_list = WatchList() if watch_list is None else watch_list
+        self.clock = clock
+        self.resync_interval = resync_interval
+        self.synced = None
+        self.cursor = None
+        self.counters = collections.Counter()
+
+    def refresh_purchases(self):
+        """Watch new unpaid purchases, syncing the whole watch list with the database when due."""
+        now = self.clock()
+        if self.cursor is None or self.synced is None or now - self.synced >= self.resync_interval:
+            purchases = db.get_unpaid_purchases()
+            unpaid = {purchase['payment_pubkey'] for purchase in purchases}
+            for address in [address for address in self.watch_list.addresses if address not in unpaid]:
+                self.watch_list.remove(address)
+                self.counters['dropped'] += 1
+            self.synced = now
+            self.counters['syncs'] += 1
+        else:
+            purchases = db.get_purchases_since(db.PURCHASE_UNPAID, self.cursor - MONITOR_CURSOR_OVERLAP)
+        for purchase in purchases:
+            if self.watch_list.add(purchase, now):
+                self.counters['added'] += 1
+            # while nothing is unpaid there is no cursor, and the cheap full query is repeated
+            if self.cursor is None or purchase['timestamp'] > self.cursor:
+                self.cursor = purchase['timestamp']
+
+    def check_due(self):
+        """
+        Check balances of the watched addresses due for a check, in batches.
+        :return: number of addresses checked
+        """
+        now = self.clock()
+        due = self.watch_list.due(now)
+        if not due:
+            return 0
+        address_balances, errors = routines.get_balances(
+            {(watched.purchase['payment_pubkey'], watched.purchase['payment_currency']) for watched in due})
+        with_balance = []
+        for watched in due:
+            purchase = watched.purchase
+            address = (purchase['payment_pubkey'], purchase['payment_currency'])
+            if address not in address_balances:
+                LOGGER.error("can't get balance of %s address %s: %s", address[1], address[0], errors.get(address))
+                self.watch_list.failed(address[0], now)
+                self.counters['errors'] += 1
+                continue
+            balance = address_balances[address]
+            self.counters['checks'] += 1
+            if self.watch_list.checked(address[0], balance, now):
+                self.counters['balance_changes'] += 1
+            if balance != 0:
+                with_balance.append((purchase, balance))
+        if not with_balance:
+            return len(due)
+        # the watch list may be stale, purchases paid by another process since must not be written over
+        statuses = db.get_purchase_statuses(purchase['payment_pubkey'] for purchase, _ in with_balance)
+        # prices are only needed once some balance shows up
+        currency_prices = db.prices.get_prices(funding=True)
+        with db.PurchaseWriter() as purchase_writer:
+            for purchase, balance in with_balance:
+                if statuses.get(purchase['payment_pubkey']) != db.PURCHASE_UNPAID:
+                    LOGGER.info("purchase with address %s is no longer unpaid", purchase['payment_pubkey'])
+                    self.watch_list.remove(purchase['payment_pubkey'])
+                    self.counters['dropped'] += 1
+                    continue
+                if routines.check_purchase_address(purchase, balance, currency_prices, purchase_writer):
+                    self.watch_list.remove(purchase['payment_pubkey'])
+                    self.counters['paid'] += 1
+        return len(due)
+
+    def poll(self):
+        """
+        Pick up new purchases and check the addresses due for a check.
+        :return: number of addresses checked
+        """
+        self.counters['polls'] += 1
+        self.refresh_purchases()
+        return self.check_due()
+
+    def sleep_time(self):
+        """Get the time to sleep until the next check, polling for new purchases at least every poll interval."""
+        next_check = self.watch_list.next_check()
+        if next_check is None:
+            return MONITOR_POLL_INTERVAL
+        return max(0, min(MONITOR_POLL_INTERVAL, next_check - self.clock()))
+
+    def stats(self):
+        """Get progress counters of the monitor."""
+        stats = dict(self.counters)
+        stats['watched'] = len(self.watch_list)
+        stats['cursor'] = str(self.cursor)
+        return stats
+
+    def run(self, iterations=None, sleep=time.sleep):
+        """
+        Monitor payments until interrupted.
+        :param iterations: number of polls to run, None to run forever
+        """
+        LOGGER.info("monitoring payments")
+        stats_time = self.clock()
+        while iterations is None or iterations > 0:
+            # pylint: disable=broad-except
+            try:
+                self.poll()
+            except Exception:
+                self.counters['poll_errors'] += 1
+                LOGGER.exception("monitor poll failed")
+            # pylint: enable=broad-except
+            if self.clock() - stats_time >= MONITOR_STATS_INTERVAL:
+                stats_time = self.clock()
+                LOGGER.info("monitor stats: %s", self.stats())
+            if iterations is not None:
+                iterations -= 1
+                if iterations == 0:
+                    break
+            sleep(self.sleep_time())
+
+
+if __name__ == '__main__':
+    util.logger.setup()
+    PaymentMonitor().run()
@@ -0,0 +1,306 @@
+"""
+Pipelined payouts of paid purchases.
+
+Destination accounts are checked concurrently, then the transactions are submitted through channel accounts:
+each transaction takes its sequence number from a channel account, while its operation pays from the source
+account. Each channel has one transaction in flight at a time, so its sequence numbers never arrive out of order,
+and with several channels several transactions are in flight at once instead of one Horizon round trip after the
+other. Purchases are marked as sending before their transactions are submitted, and every confirmation is
+written to the purchase status right away. Transactions rejected for a bad sequence number were not applied,
+so they are rebuilt with the reloaded sequence number of their channel and submitted again.
+Channel accounts are required, their seeds are set in PAKET_PAYOUT_CHANNEL_SEEDS.
+"""
+import collections
+import concurrent.futures
+import os
+import queue
+import threading
+
+import paket_stellar
+import util.conversion
+import util.logger
+
+import db
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.payouts')
+PAYOUT_WORKERS = int(os.environ.get('PAKET_PAYOUT_WORKERS', 8))
+# seeds of the channel accounts, separated by commas
+PAYOUT_CHANNEL_SEEDS = [seed for seed in os.environ.get('PAKET_PAYOUT_CHANNEL_SEEDS', '').split(',') if seed]
+PAYOUT_ATTEMPTS = int(os.environ.get('PAKET_PAYOUT_ATTEMPTS', 3))
+
+
+class PayoutError(Exception):
+    """Purchase can't be paid out"""
+
+
+class Payout:
+    """Transaction paying out a purchase, from preparation to confirmation."""
+
+    def __init__(self, purchase, euro_cents, success_status):
+        self.purchase = purchase
+        self.euro_cents = euro_cents
+        self.success_status = success_status
+        self.amount = None
+        self.create_account = False
+        self.sequence = None
+        self.envelope = None
+        self.error = None
+
+
+def get_address(seed):
+    """Get the address of the Stellar account of a seed."""
+    return paket_stellar.stellar_base.Keypair.from_seed(seed).address().decode()
+
+
+def get_account(pubkey, accept_untrusted=False):
+    """Get the Stellar account of a pubkey."""
+    return paket_stellar.get_bul_account(pubkey, accept_untrusted=accept_untrusted)
+
+
+def get_sequence(pubkey):
+    """Get the current sequence number of a Stellar account."""
+    return int(get_account(pubkey, accept_untrusted=True)['sequence'])
+
+
+def build_envelope(payout, source, channel, sequence):
+    """
+    Build the envelope of a payout from the source account, signed by the channel.
+    :param channel: channel account whose sequence number the transaction uses
+    :param sequence: sequence number of the channel account the transaction follows
+    """
+    builder = paket_stellar.gen_builder(channel.pubkey)
+    builder.sequence = sequence
+    amount = util.conversion.stroops_to_units(payout.amount)
+    destination = payout.purchase['user_pubkey']
+    if payout.create_account:
+        builder.append_create_account_op(destination=destination, starting_balance=amount, source=source)
+    elif payout.purchase['requested_currency'] == 'BUL':
+        builder.append_payment_op(
+            destination, amount, asset_code='BUL', asset_issuer=paket_stellar.ISSUER, source=source)
+    else:
+        builder.append_payment_op(destination, amount, source=source)
+    envelope = builder.gen_te()
+    envelope.sign(paket_stellar.stellar_base.Keypair.from_seed(channel.seed))
+    return envelope.xdr().decode()
+
+
+def submit_envelope(envelope, seed):
+    """Sign and submit an envelope, waiting for its confirmation."""
+    return paket_stellar.submit_transaction_envelope(envelope, seed)
+
+
+def is_bad_sequence(exception):
+    """Check if a transaction was rejected for its sequence number, and so was not applied."""
+    return 'tx_bad_seq' in str(exception)
+
+
+def is_rejected(exception):
+    """
+    Check if Horizon answered that a transaction failed, and so its payment was not applied.
+    Other errors, like timeouts, leave it unknown whether the transaction was applied.
+    """
+    return isinstance(exception, paket_stellar.StellarTransactionFailed) and 'tx_' in str(exception)
+
+
+class Channel:
+    """Account whose sequence numbers transactions use, one transaction at a time."""
+
+    def __init__(self, pubkey, seed):
+        self.pubkey = pubkey
+        self.seed = seed
+        self.sequence = None
+
+    def next_sequence(self):
+        """Get the sequence number the next transaction follows, loading the account sequence if unknown."""
+        if self.sequence is None:
+            self.sequence = get_sequence(self.pubkey)
+        return self.sequence
+
+    def confirmed(self):
+        """Count a transaction confirmed."""
+        self.sequence += 1
+
+    def reset(self):
+        """Forget the sequence number, to load it again from Horizon."""
+        self.sequence = None
+
+
+class PayoutPipeline:
+    """
+    Pays out purchases from the source account of a seed, with a transaction in flight on each channel account.
+    Channel accounts are those of PAYOUT_CHANNEL_SEEDS by default, and a payout is submitted up to attempts times
+    while it is rejected for its sequence number.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self, seed, source=None, channel_seeds=None, workers=PAYOUT_WORKERS, attempts=PAYOUT_ATTEMPTS):
+        assert workers > 0 and attempts > 0, 'workers and attempts must be positive'
+        self.seed = seed
+        self.source = paket_stellar.ISSUER if source is None else source
+        channel_seeds = PAYOUT_CHANNEL_SEEDS if channel_seeds is None else channel_seeds
+        assert channel_seeds, 'payouts need channel accounts, set PAKET_PAYOUT_CHANNEL_SEEDS'
+        self.channels = [Channel(get_address(channel_seed), channel_seed) for channel_seed in channel_seeds]
+        self.workers = workers
+        self.attempts = attempts
+        self.counters = collections.Counter()
+        self.counters_lock = threading.Lock()
+    # pylint: enable=too-many-arguments
+
+    def count(self, counter):
+        """Increment a counter, from any channel thread."""
+        with self.counters_lock:
+            self.counters[counter] += 1
+
+    @staticmethod
+    def prepare(payout, currency_prices):
+        """
+        Compute the amount of a payout and check its destination account.
+        :return: True if the payout can be sent, otherwise its error is set
+        """
+        user_pubkey = payout.purchase['user_pubkey']
+        if payout.purchase['requested_currency'] == 'BUL':
+            payout.amount = util.conversion.euro_cents_to_bul_stroops(payout.euro_cents, currency_prices['BUL'])
+            try:
+                account = get_account(user_pubkey)
+            except (paket_stellar.TrustError, paket_stellar.StellarAccountNotExists) as exc:
+                payout.error = exc
+                return False
+            if account['bul_balance'] + payout.amount > account['bul_limit']:
+                payout.error = PayoutError(
+                    "account {} need to set higher limit for BUL. balance: {} limit: {} amount to fund: {}".format(
+                        user_pubkey, account['bul_balance'], account['bul_limit'], payout.amount))
+                return False
+            return True
+        payout.amount = util.conversion.euro_cents_to_xlm_stroops(payout.euro_cents, currency_prices['XLM'])
+        try:
+            get_account(user_pubkey, accept_untrusted=True)
+        except paket_stellar.StellarAccountNotExists:
+            LOGGER.info("account %s does not exist and will be created", user_pubkey)
+            payout.create_account = True
+        return True
+
+    @staticmethod
+    def set_status(payout, paid):
+        """Write the status of the purchase of a payout."""
+        purchase = payout.purchase
+        db.set_purchase(
+            purchase['user_pubkey'], purchase['payment_pubkey'], purchase['payment_currency'], payout.euro_cents,
+            purchase['requested_currency'], paid=paid)
+
+    def release(self, payout, exception):
+        """Mark the purchase of a payout that was not sent as paid again, for the next run to pay it out."""
+        payout.error = exception
+        self.count('errors')
+        LOGGER.error("payout of purchase with address %s failed: %s", payout.purchase['payment_pubkey'], exception)
+        # pylint: disable=broad-except
+        try:
+            self.set_status(payout, db.PURCHASE_PAID)
+        except Exception as status_exception:
+            LOGGER.critical("purchase with address %s left sending, but was not sent: %s",
+                            payout.purchase['payment_pubkey'], status_exception)
+        # pylint: enable=broad-except
+
+    def sent_unknown(self, payout, exception):
+        """Leave the purchase of a payout that may have been sent as sending, so it is never paid out again."""
+        payout.error = exception
+        self.count('unknown')
+        LOGGER.critical(
+            "payout of purchase with address %s in transaction %s may have been sent, "
+            "its purchase is left sending to be reconciled: %s",
+            payout.purchase['payment_pubkey'], payout.sequence, exception)
+
+    def submit(self, payout, channel):
+        """
+        Submit a payout through a channel, submitting it again while it is rejected for its sequence number.
+        The purchase is marked as sending before its transaction is submitted, and marked as paid again only
+        if the transaction was rejected. When the outcome is unknown, or the funded status can't be written,
+        it stays sending, so the payout is never sent twice.
+        """
+        # pylint: disable=broad-except
+        try:
+            self.set_status(payout, db.PURCHASE_SENDING)
+        except Exception as exception:
+            payout.error = exception
+            self.count('errors')
+            LOGGER.error("purchase with address %s not marked as sending, not paid out: %s",
+                         payout.purchase['payment_pubkey'], exception)
+            return
+        for _ in range(self.attempts):
+            try:
+                sequence = channel.next_sequence()
+                payout.sequence = sequence + 1
+                payout.envelope = build_envelope(payout, self.source, channel, sequence)
+            except Exception as exception:
+                channel.reset()
+                self.release(payout, exception)
+                return
+            try:
+                submit_envelope(payout.envelope, self.seed)
+            except Exception as exception:
+                # the transaction may have used the sequence number or not, so it is loaded again
+                channel.reset()
+                if is_bad_sequence(exception):
+                    self.count('bad_sequence')
+                    continue
+                if is_rejected(exception):
+                    self.release(payout, exception)
+                else:
+                    self.sent_unknown(payout, exception)
+                return
+            channel.confirmed()
+            try:
+                self.set_status(payout, payout.success_status)
+            except Exception as exception:
+                self.sent_unknown(payout, exception)
+                return
+            self.count('confirmed')
+            LOGGER.info("%s funded with %s %s in transaction %s", payout.purchase['user_pubkey'], payout.amount,
+                        payout.purchase['requested_currency'], payout.sequence)
+            return
+        # pylint: enable=broad-except
+        self.release(payout, PayoutError("kept a bad sequence number after {} attempts".format(self.attempts)))
+
+    def submit_all(self, payouts):
+        """Submit payouts in order, each channel taking the next payout once its transaction is confirmed."""
+        pending = queue.Queue()
+        for payout in payouts:
+            pending.put(payout)
+
+        def submit_through(channel):
+            """Submit pending payouts through a channel, one at a time, until none are left."""
+            while True:
+                try:
+                    payout = pending.get_nowait()
+                except queue.Empty:
+                    return
+                self.submit(payout, channel)
+
+        with concurrent.futures.ThreadPoolExecutor(len(self.channels)) as executor:
+            for future in [executor.submit(submit_through, channel) for channel in self.channels]:
+                future.result()
+
+    def run(self, fundings, currency_prices):
+        """
+        Pay out purchases.
+        Purchases that can't be paid out are marked as failed, purchases whose transactions fail stay paid.
+        :param fundings: list of (purchase, euro cents to fund, status of the funded purchase)
+        :return: Counter of confirmed, failed, errored and possibly sent payouts
+        """
+        payouts = [Payout(*funding) for funding in fundings]
+        if not payouts:
+            return self.counters
+        with concurrent.futures.ThreadPoolExecutor(min(self.workers, len(payouts))) as executor:
+            ready = list(executor.map(lambda payout: self.prepare(payout, currency_prices), payouts))
+        with db.PurchaseWriter() as purchase_writer:
+            for payout in (payout for payout, is_ready in zip(payouts, ready) if not is_ready):
+                LOGGER.error(str(payout.error))
+                purchase = payout.purchase
+                purchase_writer.set_purchase(
+                    purchase['user_pubkey'], purchase['payment_pubkey'], purchase['payment_currency'],
+                    payout.euro_cents, purchase['requested_currency'], paid=db.PURCHASE_FAILED)
+                self.counters['failed'] += 1
+                LOGGER.error("purchase with address %s marked as unsuccessful", purchase['payment_pubkey'])
+        self.submit_all([payout for payout, is_ready in zip(payouts, ready) if is_ready])
+        LOGGER.info("payouts: %s", dict(self.counters))
+        return self.counters
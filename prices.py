@@ -1,45 +1,251 @@
 """Prices of currencies."""
 import os
+import threading
+import time
 
 import requests
 
+import util.logger
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.prices')
 BUL_PRICE = os.environ['PAKET_BUL_PRICE']
-MARKET_URL_FORMAT = 'https://api.coinmarketcap.com/v2/ticker/{}/?convert={}'
+MARKET_URL_FORMAT = os.environ.get(
+    'PAKET_MARKET_URL_FORMAT', 'https://api.coinmarketcap.com/v2/ticker/{}/?convert={}')
+MARKET_LIST_URL_FORMAT = os.environ.get(
+    'PAKET_MARKET_LIST_URL_FORMAT', 'https://api.coinmarketcap.com/v2/ticker/?convert={}&limit={}')
+# Length of the ticker list, must be long enough to include all CURRENCY_IDS.
+MARKET_LIST_LIMIT = 100
+MARKET_TIMEOUT = 10
+# Prices younger than PRICE_TTL seconds are served without asking the market.
+PRICE_TTL = float(os.environ.get('PAKET_PRICE_TTL', 60))
+# Funding decisions refuse prices older than PRICE_MAX_STALENESS seconds.
+PRICE_MAX_STALENESS = float(os.environ.get('PAKET_PRICE_MAX_STALENESS', 15 * 60))
 
 # currencies ids on coinmarketcap.com
 BTC_ID = 1
 ETH_ID = 1027
 XLM_ID = 512
+CURRENCY_IDS = {'BTC': BTC_ID, 'ETH': ETH_ID, 'XLM': XLM_ID}
+
+
+class StalePrice(Exception):
+    """Price is too old to base funding on, and can not be refreshed."""
 
 
-def get_currency_price(id_, convert='EUR'):
+def fetch_currency_price(id_, convert='EUR'):
     """
-    Get crypto currency price in specified fiat currency.
-    Crypto currency specifies as id from coinmarketcap.com
+    Get crypto currency price in specified fiat currency from coinmarketcap.com.
     :param id_: Currency id on coinmarketcap.com
     :param convert: Name of fiat currency
     :return: Amount of specified fiat currency by one unit of specified crypto currency
     """
     url = MARKET_URL_FORMAT.format(id_, convert)
-    response = requests.get(url)
+    response = requests.get(url, timeout=MARKET_TIMEOUT)
+    response.raise_for_status()
     price = response.json()['data']['quotes'][convert]['price']
     # we need to cast to string because API returns price as float number
     return str(price)
 
 
-def btc_price():
+def fetch_currency_prices(ids, convert='EUR'):
+    """
+    Get prices of several crypto currencies in one request to coinmarketcap.com.
+    Currencies missing from the ticker list are fetched one by one.
+    :param ids: Currency ids on coinmarketcap.com
+    :param convert: Name of fiat currency
+    :return: dict of prices by currency id
+    """
+    url = MARKET_LIST_URL_FORMAT.format(convert, MARKET_LIST_LIMIT)
+    response = requests.get(url, timeout=MARKET_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()['data']
+    tickers = {int(ticker['id']): ticker for ticker in (data.values() if isinstance(data, dict) else data)}
+    return {
+        id_: str(tickers[id_]['quotes'][convert]['price']) if id_ in tickers else fetch_currency_price(id_, convert)
+        for id_ in ids}
+
+
+class PriceRequest:
+    """An upstream request shared by all callers waiting for the same price."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.price = None
+        self.exception = None
+
+
+class PriceCache:
+    """
+    Prices cached for a TTL.
+    A stale price is served while a background refresh is running, unless it is older
+    than the maximal staleness the caller accepts. Concurrent callers share one upstream request.
+    """
+
+    def __init__(self, fetch_function, fetch_many_function=None, ttl=PRICE_TTL, clock=time.monotonic):
+        self.fetch_function = fetch_function
+        self.fetch_many_function = fetch_many_function
+        self.ttl = ttl
+        self.clock = clock
+        self.prices = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def single_flight(self, key, function):
+        """Call a function, or join the call already in flight for the same key."""
+        with self.lock:
+            price_request = self.requests.get(key)
+            in_flight = price_request is not None
+            if not in_flight:
+                price_request = self.requests[key] = PriceRequest()
+        if in_flight:
+            price_request.done.wait()
+        else:
+            try:
+                price_request.price = function()
+            # pylint: disable=broad-except
+            except Exception as exception:
+                price_request.exception = exception
+            # pylint: enable=broad-except
+            finally:
+                with self.lock:
+                    del self.requests[key]
+                price_request.done.set()
+        if price_request.exception is not None:
+            raise price_request.exception
+        return price_request.price
+
+    def refresh(self, *key):
+        """Fetch a price, sharing the upstream request with concurrent callers."""
+        def fetch():
+            """Fetch and cache the price."""
+            price = self.fetch_function(*key)
+            with self.lock:
+                self.prices[key] = (price, self.clock())
+            return price
+        return self.single_flight(key, fetch)
+
+    @staticmethod
+    def many_key(ids, convert):
+        """Get the in flight key of a request for several prices."""
+        return ('many', convert) + tuple(ids)
+
+    def refresh_many(self, ids, convert):
+        """Fetch several prices in one upstream request, shared with concurrent callers."""
+        def fetch():
+            """Fetch and cache the prices."""
+            prices = self.fetch_many_function(ids, convert)
+            fetched_at = self.clock()
+            with self.lock:
+                for id_, price in prices.items():
+                    self.prices[(id_, convert)] = (price, fetched_at)
+            return prices
+        return self.single_flight(self.many_key(ids, convert), fetch)
+
+    def refresh_in_background(self, key, refresh_function, *args):
+        """Run a refresh function in a background thread, unless its key is already in flight."""
+        with self.lock:
+            if key in self.requests:
+                return
+
+        def refresh():
+            """Refresh and log failures."""
+            # pylint: disable=broad-except
+            try:
+                refresh_function(*args)
+            except Exception as exception:
+                LOGGER.warning("error refreshing prices %s: %s", args, exception)
+            # pylint: enable=broad-except
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def get(self, *key, max_staleness=None):
+        """
+        Get a cached price.
+        :param key: arguments of the fetch function
+        :param max_staleness: maximal age in seconds of a price to use, None for any age
+        :return: the price
+        :raise StalePrice: if the cached price is too old and can not be refreshed
+        """
+        with self.lock:
+            cached = self.prices.get(key)
+        if cached is None:
+            return self.refresh(*key)
+        price, fetched_at = cached
+        age = self.clock() - fetched_at
+        if age < self.ttl:
+            return price
+        if max_staleness is None or age <= max_staleness:
+            self.refresh_in_background(key, self.refresh, *key)
+            return price
+        try:
+            return self.refresh(*key)
+        except Exception as exception:
+            raise StalePrice("price {} is {:.0f} seconds old and can not be refreshed: {}".format(
+                key, age, exception))
+
+    def get_many(self, ids, convert, max_staleness=None):
+        """
+        Get several cached prices, all read at once, refreshing them together in one upstream request.
+        :param ids: ids of the currencies
+        :param convert: name of fiat currency
+        :param max_staleness: maximal age in seconds of a price to use, None for any age
+        :return: dict of prices by id
+        :raise StalePrice: if a cached price is too old and can not be refreshed
+        """
+        with self.lock:
+            cached = {id_: self.prices.get((id_, convert)) for id_ in ids}
+        if any(price is None for price in cached.values()):
+            return self.refresh_many(ids, convert)
+        oldest = self.clock() - min(fetched_at for _, fetched_at in cached.values())
+        if oldest >= self.ttl:
+            if max_staleness is not None and oldest > max_staleness:
+                try:
+                    return self.refresh_many(ids, convert)
+                except Exception as exception:
+                    raise StalePrice("prices {} are {:.0f} seconds old and can not be refreshed: {}".format(
+                        ids, oldest, exception))
+            self.refresh_in_background(self.many_key(ids, convert), self.refresh_many, ids, convert)
+        return {id_: price for id_, (price, _) in cached.items()}
+
+
+PRICES = PriceCache(fetch_currency_price, fetch_currency_prices)
+
+
+def get_currency_price(id_, convert='EUR', funding=False):
+    """
+    Get crypto currency price in specified fiat currency.
+    Crypto currency specifies as id from coinmarketcap.com
+    :param id_: Currency id on coinmarketcap.com
+    :param convert: Name of fiat currency
+    :param funding: price is used for funding, refuse prices older than PRICE_MAX_STALENESS
+    :return: Amount of specified fiat currency by one unit of specified crypto currency
+    """
+    return PRICES.get(id_, convert, max_staleness=PRICE_MAX_STALENESS if funding else None)
+
+
+def get_prices(funding=False):
+    """
+    Get a consistent snapshot of all prices in EUR, fetching them in one request if needed.
+    :param funding: prices are used for funding, refuse prices older than PRICE_MAX_STALENESS
+    :return: dict of prices by currency code
+    """
+    prices = PRICES.get_many(
+        sorted(CURRENCY_IDS.values()), 'EUR', max_staleness=PRICE_MAX_STALENESS if funding else None)
+    return dict({code: prices[id_] for code, id_ in CURRENCY_IDS.items()}, BUL=bul_price())
+
+
+def btc_price(funding=False):
     """Get BTC price in EUR."""
-    return get_currency_price(BTC_ID)
+    return get_currency_price(BTC_ID, funding=funding)
 
 
-def eth_price():
+def eth_price(funding=False):
     """Get ETH price in EUR."""
-    return get_currency_price(ETH_ID)
+    return get_currency_price(ETH_ID, funding=funding)
 
 
-def xlm_price():
+def xlm_price(funding=False):
     """Get XLM price in EUR."""
-    return get_currency_price(XLM_ID)
+    return get_currency_price(XLM_ID, funding=funding)
 
 
 def bul_price():
@@ -1,4 +1,5 @@
 """Routes for Funding Server API."""
+import json
 import os
 
 import flasgger
@@ -15,6 +16,8 @@ LOGGER = util.logger.logging.getLogger('pkt.funding.routes')
 VERSION = swagger_specs.VERSION
 PORT = os.environ.get('PAKET_FUNDER_PORT', 8002)
 BLUEPRINT = flask.Blueprint('funding', __name__)
+USERS_PAGE_SIZE = int(os.environ.get('PAKET_USERS_PAGE_SIZE', 1000))
+CALLSIGNS_PAGE_SIZE = int(os.environ.get('PAKET_CALLSIGNS_PAGE_SIZE', 100))
 
 
 def check_call_sign(key, value):
@@ -32,6 +35,7 @@ def check_call_sign(key, value):
 # Input validators and fixers.
 webserver.validation.KWARGS_CHECKERS_AND_FIXERS['_cents'] = webserver.validation.check_and_fix_natural
 webserver.validation.KWARGS_CHECKERS_AND_FIXERS['call_sign'] = check_call_sign
+webserver.validation.KWARGS_CHECKERS_AND_FIXERS['limit'] = webserver.validation.check_and_fix_natural
 webserver.validation.CUSTOM_EXCEPTION_STATUSES[db.authy.AuthyException] = 403
 webserver.validation.CUSTOM_EXCEPTION_STATUSES[db.authy.AuthyFormatException] = 403
 webserver.validation.CUSTOM_EXCEPTION_STATUSES[db.FundLimitReached] = 403
@@ -40,6 +44,7 @@ webserver.validation.CUSTOM_EXCEPTION_STATUSES[db.InvalidVerificationCode] = 403
 webserver.validation.CUSTOM_EXCEPTION_STATUSES[db.InvalidPhoneNumber] = 403
 webserver.validation.CUSTOM_EXCEPTION_STATUSES[db.UnknownUser] = 404
 webserver.validation.CUSTOM_EXCEPTION_STATUSES[db.UserAlreadyExists] = 403
+webserver.validation.CUSTOM_EXCEPTION_STATUSES[db.prices.StalePrice] = 503
 
 
 # Internal error codes.
@@ -54,6 +59,7 @@ webserver.validation.INTERNAL_ERROR_CODES[db.InvalidPhoneNumber] = 303
 webserver.validation.INTERNAL_ERROR_CODES[db.PhoneNumberAlreadyInUse] = 304
 webserver.validation.INTERNAL_ERROR_CODES[db.InvalidVerificationCode] = 310
 webserver.validation.INTERNAL_ERROR_CODES[db.FundLimitReached] = 320
+webserver.validation.INTERNAL_ERROR_CODES[db.prices.StalePrice] = 330
 
 
 @BLUEPRINT.route("/v{}/create_user".format(VERSION), methods=['POST'])
@@ -80,11 +86,37 @@ def get_user_handler(pubkey=None, call_sign=None):
 @BLUEPRINT.route("/v{}/callsigns".format(VERSION), methods=['POST'])
 @flasgger.swag_from(swagger_specs.CALLSIGNS)
 @webserver.validation.call
-def callsigns_handler(call_sign_prefix=None):
+def callsigns_handler(call_sign_prefix=None, after_call_sign=None, limit=None):
     """
     Get registered callsigns which started with specified string.
+    All of them are returned, unless a page is requested with limit or after_call_sign.
+    To get the next page, pass the returned next_after_call_sign as after_call_sign, it is None on the last page.
     """
-    return {'status': 200, 'callsigns': db.get_callsings(call_sign_prefix)}
+    if limit is None and after_call_sign is None:
+        return {'status': 200, 'callsigns': db.get_callsings(call_sign_prefix), 'next_after_call_sign': None}
+    limit = min(int(limit or CALLSIGNS_PAGE_SIZE), CALLSIGNS_PAGE_SIZE)
+    callsigns = db.get_callsings(call_sign_prefix, after_call_sign, limit)
+    return {
+        'status': 200, 'callsigns': callsigns,
+        'next_after_call_sign': callsigns[-1]['call_sign'] if len(callsigns) == limit else None}
+
+
+@BLUEPRINT.route("/v{}/callsigns/stream".format(VERSION), methods=['POST'])
+@flasgger.swag_from(swagger_specs.CALLSIGNS_STREAM)
+@webserver.validation.call
+def callsigns_stream_handler(call_sign_prefix=None):
+    """
+    Get all registered callsigns which started with specified string, streamed a page at a time.
+    """
+    def generate():
+        """Generate the JSON response, a page of call signs per chunk."""
+        yield '{"status": 200, "callsigns": ['
+        separator = ''
+        for page in db.iter_callsign_pages(call_sign_prefix):
+            yield separator + ', '.join(json.dumps(callsign) for callsign in page)
+            separator = ', '
+        yield ']}'
+    return flask.Response(flask.stream_with_context(generate()), mimetype='application/json')
 
 
 @BLUEPRINT.route("/v{}/user_infos".format(VERSION), methods=['POST'])
@@ -156,8 +188,20 @@ def ratio_handler(currency):
 @BLUEPRINT.route("/v{}/debug/users".format(VERSION), methods=['GET'])
 @flasgger.swag_from(swagger_specs.USERS)
 @webserver.validation.call
-def users_handler():
+def users_handler(after_call_sign=None, limit=USERS_PAGE_SIZE):
+    """
+    List user details, a page at a time.
+    To get the next page, pass the returned last_call_sign as after_call_sign.
+    """
+    users = db.get_users(after_call_sign, min(int(limit), USERS_PAGE_SIZE))
+    return {'status': 200, 'users': users, 'last_call_sign': list(users)[-1] if users else None}
+
+
+@BLUEPRINT.route("/v{}/debug/stats".format(VERSION), methods=['GET'])
+@flasgger.swag_from(swagger_specs.STATS)
+@webserver.validation.call
+def stats_handler():
     """
-    List all user details.
+    Get user cache and database pool counters.
     """
-    return {'status': 200, 'users': db.get_users()}
+    return {'status': 200, 'user_cache': db.USER_CACHE.stats(), 'sql_pool': db.SQL_POOL.stats()}
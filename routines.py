@@ -1,54 +1,62 @@
 """Routines for processing users purchases"""
+import collections
 import os
 import sys
-
-import requests
+import time
 
 import paket_stellar
 import util.logger
 
+import balances
+import csl_reader
 import db
+import payouts
 import simulation
 
 LOGGER = util.logger.logging.getLogger('pkt.funder.routines')
-DEBUG = bool(os.environ.get('PAKET_DEBUG'))
 FUNDER_SEED = os.environ['PAKET_FUNDER_SEED']
-ETHERSCAN_API_KEY = os.environ['PAKET_ETHERSCAN_API_KEY']
+# payouts go through the payout pipeline unless PAKET_PAYOUT_PIPELINE is set to 0
+PAYOUT_PIPELINE = os.environ.get('PAKET_PAYOUT_PIPELINE', '1') != '0'
 
 
-class BalanceError(Exception):
-    """Can't get balance for specified address"""
+# balances moved to the balances module, kept here for callers of routines
+BalanceError = balances.BalanceError
 
 
 def get_btc_balance(address):
     """Get bitcoin address balance"""
-    url = 'https://{testnet}chain.api.btc.com/v3/address/{address}'.format(
-        address=address, testnet='t' if DEBUG else '')
-    response = requests.get(url).json()
-    if response['err_no'] == 0:
-        return response['data']['balance'] if response['data'] is not None else 0
-    raise BalanceError(response['err_msg'])
+    return balances.PROVIDERS['BTC'].get_balance(address)
 
 
 def get_eth_balance(address):
     """Get ethereum address balance"""
-    params = {
-        'module': 'account',
-        'action': 'balance',
-        'address': address,
-        'tag': 'latest',
-        'apikey': ETHERSCAN_API_KEY
-    }
-    url = "https://api{testnet}.etherscan.io/api".format(testnet='-ropsten' if DEBUG else '')
-    response = requests.get(url, params=params).json()
-    if response['message'] == 'OK':
-        return int(response['result'])
-    raise BalanceError(response['result'])
+    return balances.PROVIDERS['ETH'].get_balance(address)
 
 
 def get_balance(address, network):
     """Get balance of address in specified network"""
-    return get_btc_balance(address) if network == 'BTC' else get_eth_balance(address)
+    return balances.get_balance(address, network)
+
+
+def get_balances(addresses):
+    """
+    Get balances of many addresses, asking explorers for a batch of addresses per request.
+    :param addresses: iterable of (address, network) tuples
+    :return: tuple of dict of balances by (address, network) and dict of errors by (address, network)
+    """
+    return balances.get_batch_balances(addresses)
+
+
+def get_purchases_balances(purchases):
+    """
+    Get balances of purchases payment addresses concurrently, in batches.
+    :return: dict of balances by payment address, without the addresses whose balance could not be fetched
+    """
+    address_balances, errors = get_balances(
+        {(purchase['payment_pubkey'], purchase['payment_currency']) for purchase in purchases})
+    for (address, network), exception in errors.items():
+        LOGGER.error("can't get balance of %s address %s: %s", network, address, exception)
+    return {address: balance for (address, _), balance in address_balances.items()}
 
 
 def fund_account(user_pubkey, amount, asset_code):
@@ -71,39 +79,66 @@ def add_trust(user_pubkey, user_seed):
     paket_stellar.submit_transaction_envelope(prepared_transaction, seed=user_seed)
 
 
-def send_requested_bul(purchase, euro_cents_to_fund, success_purchase_status=db.PURCHASE_FUNDED):
-    """Send amount of BUL requested in purchase."""
-    fund_amount = db.util.conversion.euro_cents_to_bul_stroops(
-        euro_cents_to_fund, db.prices.bul_price())
+def get_euro_cents_balance(balance, payment_currency, currency_prices):
+    """Convert balance of BTC or ETH address to EUR cents, using prices from db.prices.get_prices."""
+    if payment_currency.upper() == 'BTC':
+        return db.util.conversion.btc_to_euro_cents(balance, currency_prices['BTC'])
+    return db.util.conversion.eth_to_euro_cents(balance, currency_prices['ETH'])
+
+
+def set_purchase_status(purchase, euro_cents, paid, purchase_writer=None, flush=False):
+    """
+    Add purchase info with a new status.
+    :param purchase_writer: db.PurchaseWriter to write with, the purchase is written at once if not specified
+    :param flush: write the purchase and all purchases accumulated by the writer at once
+    """
+    args = (
+        purchase['user_pubkey'], purchase['payment_pubkey'], purchase['payment_currency'],
+        euro_cents, purchase['requested_currency'])
+    if purchase_writer is None:
+        db.set_purchase(*args, paid=paid)
+    else:
+        purchase_writer.set_purchase(*args, paid=paid, flush=flush)
+
+
+def send_requested_bul(
+        purchase, euro_cents_to_fund, success_purchase_status=db.PURCHASE_FUNDED, currency_prices=None,
+        purchase_writer=None):
+    """
+    Send amount of BUL requested in purchase.
+    The status of a funded purchase is written at once, so it is never funded twice.
+    """
+    currency_prices = currency_prices or db.prices.get_prices(funding=True)
+    fund_amount = db.util.conversion.euro_cents_to_bul_stroops(euro_cents_to_fund, currency_prices['BUL'])
     try:
         account = paket_stellar.get_bul_account(purchase['user_pubkey'])
         if account['bul_balance'] + fund_amount <= account['bul_limit']:
             fund_account(purchase['user_pubkey'], fund_amount, 'BUL')
             LOGGER.info("%s funded with %s BUL", purchase['user_pubkey'], fund_amount)
-            db.set_purchase(
-                purchase['user_pubkey'], purchase['payment_pubkey'], purchase['payment_currency'],
-                euro_cents_to_fund, purchase['requested_currency'], paid=success_purchase_status)
+            set_purchase_status(
+                purchase, euro_cents_to_fund, success_purchase_status, purchase_writer, flush=True)
             LOGGER.info("purchase for account %s marked as funded", purchase['user_pubkey'])
         else:
             LOGGER.error("account %s need to set higher limit for BUL."
                          " balance: %s limit: %s amount to fund: %s", purchase['user_pubkey'],
                          account['bul_balance'], account['bul_limit'], fund_amount)
-            db.set_purchase(
-                purchase['user_pubkey'], purchase['payment_pubkey'], purchase['payment_currency'],
-                euro_cents_to_fund, purchase['requested_currency'], paid=db.PURCHASE_FAILED)
+            set_purchase_status(purchase, euro_cents_to_fund, db.PURCHASE_FAILED, purchase_writer)
             LOGGER.error("purchase with address %s marked as unsuccessful", purchase['payment_pubkey'])
     except (paket_stellar.TrustError, paket_stellar.StellarAccountNotExists) as exc:
         LOGGER.error(str(exc))
-        db.set_purchase(
-            purchase['user_pubkey'], purchase['payment_pubkey'], purchase['payment_currency'],
-            euro_cents_to_fund, purchase['requested_currency'], paid=db.PURCHASE_FAILED)
+        set_purchase_status(purchase, euro_cents_to_fund, db.PURCHASE_FAILED, purchase_writer)
         LOGGER.error("purchase with address %s marked as unsuccessful", purchase['payment_pubkey'])
 
 
-def send_requested_xlm(purchase, euro_cents_to_fund, success_purchase_status=db.PURCHASE_FUNDED):
-    """Send amount of XLM requested in purchase."""
-    fund_amount = db.util.conversion.euro_cents_to_xlm_stroops(
-        euro_cents_to_fund, db.prices.xlm_price())
+def send_requested_xlm(
+        purchase, euro_cents_to_fund, success_purchase_status=db.PURCHASE_FUNDED, currency_prices=None,
+        purchase_writer=None):
+    """
+    Send amount of XLM requested in purchase.
+    The status of a funded purchase is written at once, so it is never funded twice.
+    """
+    currency_prices = currency_prices or db.prices.get_prices(funding=True)
+    fund_amount = db.util.conversion.euro_cents_to_xlm_stroops(euro_cents_to_fund, currency_prices['XLM'])
     try:
         paket_stellar.get_bul_account(purchase['user_pubkey'], accept_untrusted=True)
         fund_account(purchase['user_pubkey'], fund_amount, 'XLM')
@@ -111,9 +146,7 @@ def send_requested_xlm(purchase, euro_cents_to_fund, success_purchase_status=db.
     except paket_stellar.StellarAccountNotExists:
         LOGGER.info("account %s does not exist and will be created", purchase['user_pubkey'])
         create_new_account(purchase['user_pubkey'], fund_amount)
-    db.set_purchase(
-        purchase['user_pubkey'], purchase['payment_pubkey'], purchase['payment_currency'],
-        euro_cents_to_fund, purchase['requested_currency'], paid=success_purchase_status)
+    set_purchase_status(purchase, euro_cents_to_fund, success_purchase_status, purchase_writer, flush=True)
     LOGGER.info("purchase with address %s marked as funded", purchase['payment_pubkey'])
 
 
@@ -121,83 +154,138 @@ def check_purchases_addresses():
     """Check purchases addresses and set paid status correspondingly to balance"""
     purchases = db.get_unpaid_purchases()
     LOGGER.info("%s purchases to check", len(purchases))
-    for purchase in purchases:
-        LOGGER.info("checking address %s", purchase['payment_pubkey'])
-        balance = get_balance(purchase['payment_pubkey'], purchase['payment_currency'])
-        LOGGER.info(
-            "address %s has %s %s on balance", purchase['payment_pubkey'],
-            balance, purchase['payment_currency'])
-        if balance == 0:
-            continue
-
-        payment_currency = purchase['payment_currency'].upper()
-        if payment_currency == 'BTC':
-            euro_cents_balance = db.util.conversion.btc_to_euro_cents(balance, db.prices.btc_price())
-        else:
-            euro_cents_balance = db.util.conversion.eth_to_euro_cents(balance, db.prices.eth_price())
-        LOGGER.info("%s %s = %s EUR cents", balance, purchase['payment_currency'], euro_cents_balance)
-        if euro_cents_balance >= db.MINIMUM_PAYMENT:
-            db.set_purchase(
-                purchase['user_pubkey'], purchase['payment_pubkey'], purchase['payment_currency'],
-                euro_cents_balance, purchase['requested_currency'], paid=db.PURCHASE_PAID)
-            LOGGER.info("purchase with address %s marked as paid", purchase['payment_pubkey'])
-        else:
-            LOGGER.info("purchase with address %s has balance less than minimum allowed for funding "
-                        "and will not be marked as paid", purchase['payment_pubkey'])
+    if not purchases:
+        return
+    # one snapshot of prices for the whole run, fetched in a single request
+    currency_prices = db.prices.get_prices(funding=True)
+    purchases_balances = get_purchases_balances(purchases)
+    with db.PurchaseWriter() as purchase_writer:
+        for purchase in purchases:
+            if purchase['payment_pubkey'] in purchases_balances:
+                check_purchase_address(
+                    purchase, purchases_balances[purchase['payment_pubkey']], currency_prices, purchase_writer)
+
+
+def check_purchase_address(purchase, balance, currency_prices, purchase_writer=None):
+    """
+    Set paid status of purchase correspondingly to balance of its address.
+    :return: True if the purchase was marked as paid
+    """
+    LOGGER.info(
+        "address %s has %s %s on balance", purchase['payment_pubkey'],
+        balance, purchase['payment_currency'])
+    if balance == 0:
+        return False
+
+    euro_cents_balance = get_euro_cents_balance(balance, purchase['payment_currency'], currency_prices)
+    LOGGER.info("%s %s = %s EUR cents", balance, purchase['payment_currency'], euro_cents_balance)
+    if euro_cents_balance >= db.MINIMUM_PAYMENT:
+        set_purchase_status(purchase, euro_cents_balance, db.PURCHASE_PAID, purchase_writer)
+        LOGGER.info("purchase with address %s marked as paid", purchase['payment_pubkey'])
+        return True
+    LOGGER.info("purchase with address %s has balance less than minimum allowed for funding "
+                "and will not be marked as paid", purchase['payment_pubkey'])
+    return False
 
 
 def send_requested_currency():
     """Check purchases addresses with paid status and send requested currency to user account."""
+    # fails right away without channel accounts
+    pipeline = payouts.PayoutPipeline(FUNDER_SEED) if PAYOUT_PIPELINE else None
+    sending = db.get_sending_purchases()
+    if sending:
+        LOGGER.warning("%s purchases may have been paid out and need to be reconciled: %s", len(sending), ', '.join(
+            purchase['payment_pubkey'] for purchase in sending))
     purchases = db.get_paid_purchases()
     LOGGER.info("%s paid purchases", len(purchases))
+    if not purchases:
+        return
+    # one snapshot of prices for the whole run, fetched in a single request
+    currency_prices = db.prices.get_prices(funding=True)
+    purchases_balances = get_purchases_balances(purchases)
+    if pipeline is not None:
+        send_requested_currency_pipelined(pipeline, purchases, purchases_balances, currency_prices)
+        return
+    # failures are accumulated, funded purchases are written at once
+    with db.PurchaseWriter() as purchase_writer:
+        for purchase in purchases:
+            if purchase['payment_pubkey'] in purchases_balances:
+                send_purchase_currency(
+                    purchase, purchases_balances[purchase['payment_pubkey']], currency_prices, purchase_writer)
+
+
+def send_requested_currency_pipelined(pipeline, purchases, purchases_balances, currency_prices):
+    """Send currency requested in paid purchases with several payout transactions in flight."""
+    fundings = []
+    # purchases of the same user funded in this run are not in the monthly expenses yet
+    planned_euro_cents = collections.defaultdict(int)
     for purchase in purchases:
-        LOGGER.info(
-            "processing purchase for account %s with payment address %s",
-            purchase['user_pubkey'], purchase['payment_pubkey'])
-        balance = get_balance(purchase['payment_pubkey'], purchase['payment_currency'])
-
-        payment_currency = purchase['payment_currency'].upper()
-        if balance == 0:
-            LOGGER.error(
-                "address %s has empty balance and should not be marked as paid", purchase['payment_pubkey'])
-            continue
-        else:
-            LOGGER.info(
-                "address %s has %s %s on balance", purchase['payment_pubkey'], balance, payment_currency)
-
-        if payment_currency == 'BTC':
-            euro_cents_balance = db.util.conversion.btc_to_euro_cents(balance, db.prices.btc_price())
-        else:
-            euro_cents_balance = db.util.conversion.eth_to_euro_cents(balance, db.prices.eth_price())
-        LOGGER.info("%s %s = %s EUR cents", balance, payment_currency, euro_cents_balance)
-        monthly_allowance = db.get_monthly_allowance(purchase['user_pubkey'])
-        monthly_expenses = db.get_monthly_expenses(purchase['user_pubkey'])
-        remaining_monthly_allowance = monthly_allowance - monthly_expenses
-        LOGGER.info("monthly allowance is %s EUR cents", monthly_allowance)
-        LOGGER.info("monthly expenses is %s EUR cents", monthly_expenses)
-
-        if remaining_monthly_allowance <= 0:
-            LOGGER.warning(
-                "account %s have exhausted monthly allowance and will not be funded", purchase['user_pubkey'])
+        if purchase['payment_pubkey'] not in purchases_balances:
             continue
-        elif remaining_monthly_allowance < euro_cents_balance:
-            euro_cents_to_fund = remaining_monthly_allowance
-            purchase_status = db.PURCHASE_PARTIALLY_FUNDED
-            LOGGER.warning(
-                "account %s purchased %s EUR cents but remaining allowance is %s EUR cents",
-                purchase['user_pubkey'], euro_cents_balance, remaining_monthly_allowance)
-            LOGGER.warning(
-                "%s EUR cents will be funded to account, %s EUR cents remaining",
-                euro_cents_to_fund, euro_cents_balance - euro_cents_to_fund)
-        else:
-            euro_cents_to_fund = euro_cents_balance
-            purchase_status = db.PURCHASE_FUNDED
-            LOGGER.info("account %s performed purchase within allowed limits", purchase['user_pubkey'])
-
-        if purchase['requested_currency'] == 'BUL':
-            send_requested_bul(purchase, euro_cents_to_fund, success_purchase_status=purchase_status)
-        else:
-            send_requested_xlm(purchase, euro_cents_to_fund, success_purchase_status=purchase_status)
+        funding = get_purchase_funding(
+            purchase, purchases_balances[purchase['payment_pubkey']], currency_prices,
+            planned_euro_cents[purchase['user_pubkey']])
+        if funding is not None:
+            planned_euro_cents[purchase['user_pubkey']] += funding[0]
+            fundings.append((purchase,) + funding)
+    pipeline.run(fundings, currency_prices)
+
+
+def send_purchase_currency(purchase, balance, currency_prices, purchase_writer=None):
+    """Send currency requested in a paid purchase, within the monthly allowance of the user."""
+    funding = get_purchase_funding(purchase, balance, currency_prices)
+    if funding is None:
+        return
+    euro_cents_to_fund, purchase_status = funding
+    send_function = send_requested_bul if purchase['requested_currency'] == 'BUL' else send_requested_xlm
+    send_function(
+        purchase, euro_cents_to_fund, success_purchase_status=purchase_status, currency_prices=currency_prices,
+        purchase_writer=purchase_writer)
+
+
+def get_purchase_funding(purchase, balance, currency_prices, planned_euro_cents=0):
+    """
+    Get the amount to fund for a paid purchase, within the monthly allowance of the user.
+    :param planned_euro_cents: euro cents already planned for the user but not in the monthly expenses yet
+    :return: tuple of euro cents to fund and status of the funded purchase, None if nothing is to be funded
+    """
+    LOGGER.info(
+        "processing purchase for account %s with payment address %s",
+        purchase['user_pubkey'], purchase['payment_pubkey'])
+
+    payment_currency = purchase['payment_currency'].upper()
+    if balance == 0:
+        LOGGER.error(
+            "address %s has empty balance and should not be marked as paid", purchase['payment_pubkey'])
+        return None
+    LOGGER.info("address %s has %s %s on balance", purchase['payment_pubkey'], balance, payment_currency)
+
+    euro_cents_balance = get_euro_cents_balance(balance, payment_currency, currency_prices)
+    LOGGER.info("%s %s = %s EUR cents", balance, payment_currency, euro_cents_balance)
+    monthly_allowance = db.get_monthly_allowance(purchase['user_pubkey'])
+    monthly_expenses = db.get_monthly_expenses(purchase['user_pubkey']) + planned_euro_cents
+    remaining_monthly_allowance = monthly_allowance - monthly_expenses
+    LOGGER.info("monthly allowance is %s EUR cents", monthly_allowance)
+    LOGGER.info("monthly expenses is %s EUR cents", monthly_expenses)
+
+    if remaining_monthly_allowance <= 0:
+        LOGGER.warning(
+            "account %s have exhausted monthly allowance and will not be funded", purchase['user_pubkey'])
+        return None
+    if remaining_monthly_allowance < euro_cents_balance:
+        euro_cents_to_fund = remaining_monthly_allowance
+        purchase_status = db.PURCHASE_PARTIALLY_FUNDED
+        LOGGER.warning(
+            "account %s purchased %s EUR cents but remaining allowance is %s EUR cents",
+            purchase['user_pubkey'], euro_cents_balance, remaining_monthly_allowance)
+        LOGGER.warning(
+            "%s EUR cents will be funded to account, %s EUR cents remaining",
+            euro_cents_to_fund, euro_cents_balance - euro_cents_to_fund)
+    else:
+        euro_cents_to_fund = euro_cents_balance
+        purchase_status = db.PURCHASE_FUNDED
+        LOGGER.info("account %s performed purchase within allowed limits", purchase['user_pubkey'])
+    return euro_cents_to_fund, purchase_status
 
 
 def fund_new_accounts():
@@ -207,33 +295,56 @@ def fund_new_accounts():
         LOGGER.info('there is no new users with unfunded accounts')
         return
 
-    daily_spent = db.get_daily_spent_euro()
-    hourly_spent = db.get_hourly_spent_euro()
-    remaining_funds = min(
-        db.HOURLY_FUND_LIMIT - hourly_spent if db.HOURLY_FUND_LIMIT > hourly_spent else 0,
-        db.DAILY_FUND_LIMIT - daily_spent if db.DAILY_FUND_LIMIT > daily_spent else 0)
-
-    if remaining_funds == 0:
-        LOGGER.warning('unable to fund, fund limit reached')
-        LOGGER.warning("hourly spent amount: %s; daily spent amount: %s", hourly_spent, daily_spent)
-
+    # fund checks and reserves the fund limits atomically, so concurrent workers can not overspend
     for index, user in enumerate(unfunded_users):
-        funded_users_amount = index
-        if funded_users_amount * db.EUR_BUL_STARTING_BALANCE >= remaining_funds:
-            LOGGER.warning(
-                "fund limit reached; %s accounts funded, %s accounts remaining",
-                funded_users_amount, len(unfunded_users) - funded_users_amount)
-            break
         # pylint:disable=broad-except
         try:
-            db.fund(user['pubkey'])
-            LOGGER.info("user %s (%s) funded with %s BUL",
-                        user['pubkey'], user['call_sign'], db.BUL_STARTING_BALANCE)
+            bul_amount = db.fund(user['pubkey'])
+            LOGGER.info("user %s (%s) funded with %s BUL", user['pubkey'], user['call_sign'], bul_amount)
+        except db.FundLimitReached as exc:
+            LOGGER.warning(
+                "%s; %s accounts funded, %s accounts remaining", exc, index, len(unfunded_users) - index)
+            LOGGER.warning(
+                "hourly spent amount: %s; daily spent amount: %s",
+                db.get_hourly_spent_euro(), db.get_daily_spent_euro())
+            break
         except Exception as exc:
             LOGGER.warning(str(exc))
         # pylint:enable=broad-except
 
 
+def screen_users():
+    """Run the basic test again for all users with filled details, e.g. after the CSL was refreshed."""
+    full_names = db.get_full_names()
+    if not full_names:
+        LOGGER.info('there is no users to screen')
+        return
+
+    start = time.time()
+    pubkeys = list(full_names)
+    results = csl_reader.batch_basic_test([full_names[pubkey] for pubkey in pubkeys])
+    db.update_tests('basic', dict(zip(pubkeys, results)))
+    elapsed = time.time() - start
+    LOGGER.info(
+        "%s users screened in %.1f seconds (%.1f names/sec), %s failed",
+        len(pubkeys), elapsed, len(pubkeys) / elapsed if elapsed else 0, results.count(-1))
+
+
+def refresh_screening_list():
+    """
+    Download the screening list if it changed, and screen all users against any list they were not screened against.
+    The new list may have been downloaded by the refresher of a web worker, so the version is checked either way.
+    """
+    csl_reader.CSLListChecker.refresh(force=True)
+    version = csl_reader.CSLListChecker.get_index().version
+    screened_version = csl_reader.CSLListChecker.load_screened_version()
+    if screened_version is not None and screened_version >= version:
+        LOGGER.info("users were already screened against list version %s", version)
+        return
+    screen_users()
+    csl_reader.CSLListChecker.save_screened_version(version)
+
+
 if __name__ == '__main__':
     util.logger.setup()
     try:
@@ -243,6 +354,14 @@ if __name__ == '__main__':
             send_requested_currency()
         elif sys.argv[1] == 'fund':
             fund_new_accounts()
+        elif sys.argv[1] == 'screen':
+            screen_users()
+        elif sys.argv[1] == 'refresh_csl':
+            refresh_screening_list()
+        elif sys.argv[1] == 'migrate':
+            db.migrate()
+        elif sys.argv[1] == 'reconcile_spend':
+            db.reconcile_spend_buckets()
         elif sys.argv[1] == 'simulate_launcher':
             simulation.simulation_routine('launcher')
         elif sys.argv[1] == 'simulate_courier':
@@ -252,4 +371,5 @@ if __name__ == '__main__':
         sys.exit(0)
     except IndexError:
         pass
-    print(' Usage: python routines.py [monitor|pay|fund|simulate_launcher|simulate_courier|simulate_recipient]')
+    print(' Usage: python routines.py [monitor|pay|fund|screen|refresh_csl|migrate|reconcile_spend|'
+          'simulate_launcher|simulate_courier|simulate_recipient]')
@@ -85,10 +85,18 @@ GET_USER = {
         '404': {'description': 'user not found'}}}
 
 CALLSIGNS = {
+    'parameters': [
+        {'name': 'call_sign_prefix', 'in': 'formData', 'required': False, 'type': 'string'},
+        {'name': 'after_call_sign', 'in': 'formData', 'required': False, 'type': 'string'},
+        {'name': 'limit', 'in': 'formData', 'required': False, 'type': 'integer'}],
+    'responses': {
+        '200': {'description': 'registered call_signs, and the after_call_sign of the next page if there is one'}}}
+
+CALLSIGNS_STREAM = {
     'parameters': [
         {'name': 'call_sign_prefix', 'in': 'formData', 'required': False, 'type': 'string'}],
     'responses': {
-        '200': {'description': 'registered call_signs'}}}
+        '200': {'description': 'all registered call_signs'}}}
 
 USER_INFOS = {
     'parameters': [
@@ -151,4 +159,11 @@ RATIO = {
         '200': 'Euro cents price by one unit of specified currency'}
 }
 
-USERS = {'tags': ['debug'], 'responses': {'200': {'description': 'dict of users'}}}
+USERS = {
+    'tags': ['debug'],
+    'parameters': [
+        {'name': 'after_call_sign', 'in': 'query', 'required': False, 'type': 'string'},
+        {'name': 'limit', 'in': 'query', 'required': False, 'type': 'integer'}],
+    'responses': {'200': {'description': 'dict of users, and the last call sign of the page'}}}
+
+STATS = {'tags': ['debug'], 'responses': {'200': {'description': 'user cache and database pool counters'}}}
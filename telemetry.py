@@ -0,0 +1,136 @@
+"""
+Countly telemetry, sent by a background thread so callers never wait for the analytics server.
+
+Events are queued in a bounded queue and sent in batches, either when a batch fills up or
+when the flush interval passes. When the queue is full, new events are dropped and counted.
+"""
+import atexit
+import collections
+import os
+import queue
+import threading
+import time
+
+import util.countly
+import util.logger
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.telemetry')
+QUEUE_SIZE = int(os.environ.get('PAKET_TELEMETRY_QUEUE_SIZE', 10000))
+BATCH_SIZE = int(os.environ.get('PAKET_TELEMETRY_BATCH_SIZE', 50))
+FLUSH_INTERVAL = float(os.environ.get('PAKET_TELEMETRY_FLUSH_INTERVAL', 5))
+EXIT_FLUSH_TIMEOUT = 10
+
+
+class Dispatcher:
+    """
+    Bounded queue of events, sent by a background thread.
+    Counts queued, sent, failed and dropped events.
+    """
+
+    def __init__(self, send_function, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.send_function = send_function
+        self.events = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.counters = collections.Counter()
+        self.counters_lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+        self.thread_lock = threading.Lock()
+
+    def count(self, counter, amount=1):
+        """Increase a counter."""
+        with self.counters_lock:
+            self.counters[counter] += amount
+
+    def stats(self):
+        """Get the counters and the current queue length."""
+        with self.counters_lock:
+            return dict(self.counters, queued_now=self.events.qsize())
+
+    def start(self):
+        """Start the sending thread, unless it is already running in this process."""
+        if self.thread is not None and self.thread_pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.thread_lock:
+            # A forked process inherits the thread object but not the thread.
+            if self.thread is None or self.thread_pid != os.getpid() or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='telemetry', daemon=True)
+                self.thread_pid = os.getpid()
+                self.thread.start()
+
+    def send_event(self, *args, **kwargs):
+        """Queue an event, dropping it if the queue is full."""
+        self.start()
+        try:
+            self.events.put_nowait((args, kwargs))
+            self.count('queued')
+        except queue.Full:
+            self.count('dropped')
+
+    def next_batch(self, timeout=None):
+        """
+        Wait for an event, then collect more until the batch is full or the flush interval passes.
+        :param timeout: seconds to wait for the first event, None to wait forever
+        :return: list of events, empty if none arrived in time
+        """
+        try:
+            batch = [self.events.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.events.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def send_batch(self, batch):
+        """Send a batch of events."""
+        for args, kwargs in batch:
+            # pylint: disable=broad-except
+            try:
+                self.send_function(*args, **kwargs)
+                self.count('sent')
+            except Exception as exception:
+                self.count('failed')
+                LOGGER.warning("error sending event %s: %s", args, exception)
+            # pylint: enable=broad-except
+
+    def run(self):
+        """Keep sending batches."""
+        while True:
+            self.send_batch(self.next_batch())
+
+    def flush(self, timeout=None):
+        """
+        Send all queued events from the calling thread, e.g. before the process exits.
+        :param timeout: maximal seconds to spend, None for no limit
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                break
+            self.send_batch(batch)
+        stats = self.stats()
+        if stats.get('dropped') or stats.get('failed'):
+            LOGGER.warning("telemetry stats: %s", stats)
+
+
+DISPATCHER = Dispatcher(util.countly.send_countly_event)
+atexit.register(DISPATCHER.flush, EXIT_FLUSH_TIMEOUT)
+
+
+def send_event(*args, **kwargs):
+    """Queue a countly event, takes the same arguments as util.countly.send_countly_event."""
+    DISPATCHER.send_event(*args, **kwargs)
@@ -12,9 +12,11 @@ def init_db():
         "refusing to clear a db with a name that does not start with 'test' ({})".format(db.DB_NAME)
     LOGGER.info('clearing database')
     db.util.db.clear_tables(db.SQL_CONNECTION, db.DB_NAME)
+    db.USER_CACHE.clear()
     try:
         LOGGER.info('creating tables...')
         db.init_db()
     except db.util.db.mysql.connector.ProgrammingError:
         LOGGER.info('tables already exists')
+        db.migrate()
     db.util.db.clear_tables(db.SQL_CONNECTION, db.DB_NAME)
@@ -0,0 +1,161 @@
+"""Tests for balances module"""
+import http.server
+import json
+import threading
+import time
+import unittest
+import urllib.parse
+
+import util.logger
+
+import balances
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.test')
+
+
+class StubExplorerHandler(http.server.BaseHTTPRequestHandler):
+    """Answer like btc.com (/address/<address>) or etherscan (?address=<address>), counting concurrent requests."""
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    request_times = []
+    # number of 500 responses to send before answering
+    failures = 0
+    delay = 0
+
+    def do_GET(self):
+        """Answer with a balance equal to the length of the address."""
+        with self.lock:
+            type(self).in_flight += 1
+            type(self).max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.request_times.append(time.monotonic())
+            fail = self.failures > 0
+            type(self).failures -= 1
+        try:
+            time.sleep(self.delay)
+            if fail:
+                self.send_response(500)
+                self.end_headers()
+                return
+            url = urllib.parse.urlparse(self.path)
+            if url.path.startswith('/address/'):
+                addresses = url.path[len('/address/'):].split(',')
+                data = [
+                    None if address.startswith('unknown') else {'address': address, 'balance': len(address)}
+                    for address in addresses]
+                body = {'err_no': 0, 'data': data if len(data) > 1 else data[0]}
+            else:
+                query = urllib.parse.parse_qs(url.query)
+                addresses = query['address'][0].split(',')
+                if query['action'][0] == 'balancemulti':
+                    body = {'message': 'OK', 'result': [
+                        {'account': address.upper(), 'balance': str(len(address))} for address in addresses]}
+                else:
+                    body = {'message': 'OK', 'result': str(len(addresses[0]))}
+            body = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with self.lock:
+                type(self).in_flight -= 1
+
+    def log_message(self, *args):
+        """Keep the test output clean."""
+
+
+class ThreadingHTTPServer(http.server.HTTPServer):
+    """HTTP server answering requests concurrently."""
+
+    def process_request(self, request, client_address):
+        threading.Thread(
+            target=self.process_request_thread, args=(request, client_address), daemon=True).start()
+
+    def process_request_thread(self, request, client_address):
+        """Handle a request in its own thread."""
+        # pylint: disable=broad-except
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+        # pylint: enable=broad-except
+
+
+class BalancesTest(unittest.TestCase):
+    """Test fetching balances from a local stub explorer."""
+
+    def setUp(self):
+        StubExplorerHandler.in_flight = StubExplorerHandler.max_in_flight = 0
+        StubExplorerHandler.request_times = []
+        StubExplorerHandler.failures = 0
+        StubExplorerHandler.delay = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubExplorerHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def providers(self, **kwargs):
+        """Get stub providers of both networks."""
+        return {
+            'BTC': balances.BtcProvider(self.url, **kwargs),
+            'ETH': balances.EthProvider(self.url, api_key='key', **kwargs)}
+
+    def test_batch_balances(self):
+        """Test getting balances of both networks with a request per batch of addresses"""
+        providers = self.providers(rate=0, concurrency=4, batch_size=3)
+        addresses = [("address_{}".format(index), network) for index in range(10) for network in ('BTC', 'ETH')]
+        addresses.append(('unknown_address', 'BTC'))
+        address_balances, errors = balances.get_batch_balances(addresses, providers)
+        self.assertEqual(errors, {})
+        self.assertEqual(address_balances, {
+            address: 0 if address[0].startswith('unknown') else len(address[0]) for address in addresses})
+        self.assertEqual(len(StubExplorerHandler.request_times), 4 + 4, 'addresses not asked in batches')
+
+    def test_batch_errors(self):
+        """Test that a failed batch is reported for each of its addresses"""
+        StubExplorerHandler.failures = 1
+        providers = self.providers(rate=0, concurrency=1, batch_size=5, retries=0)
+        addresses = [("address_{}".format(index), 'ETH') for index in range(10)]
+        address_balances, errors = balances.get_batch_balances(addresses, providers, workers=1)
+        self.assertEqual(len(address_balances), 5)
+        self.assertEqual(len(errors), 5)
+        self.assertFalse(set(address_balances) & set(errors))
+
+    def test_concurrency_limit(self):
+        """Test that concurrent requests to a provider are bounded"""
+        StubExplorerHandler.delay = .05
+        provider = self.providers(rate=0, concurrency=3)['BTC']
+        addresses = [("address_{}".format(index), 'BTC') for index in range(12)]
+        balances.get_batch_balances(addresses, {'BTC': provider}, workers=12)
+        self.assertEqual(StubExplorerHandler.max_in_flight, 3, 'concurrency not bounded or not used')
+
+    def test_rate_limit(self):
+        """Test that requests to a provider are spaced by its rate"""
+        provider = self.providers(rate=20, concurrency=5)['ETH']
+        addresses = [("address_{}".format(index), 'ETH') for index in range(6)]
+        balances.get_batch_balances(addresses, {'ETH': provider})
+        times = sorted(StubExplorerHandler.request_times)
+        self.assertGreaterEqual(times[-1] - times[0], 5 / 20 * .9, 'requests not rate limited')
+
+    def test_retry(self):
+        """Test that server errors are retried with backoff, and reported once retries run out"""
+        StubExplorerHandler.failures = 2
+        provider = self.providers(rate=0, concurrency=1, retries=2, backoff=.01)['BTC']
+        self.assertEqual(provider.get_balance('address'), len('address'), 'server errors not retried')
+        StubExplorerHandler.failures = 3
+        with self.assertRaises(balances.TransientError):
+            provider.get_balance('address')
+
+    def test_timeout(self):
+        """Test that slow explorers time out"""
+        StubExplorerHandler.delay = .5
+        provider = self.providers(rate=0, concurrency=1, timeout=.05, retries=0)['ETH']
+        address_balances, errors = balances.get_batch_balances([('address', 'ETH')], {'ETH': provider})
+        self.assertEqual(address_balances, {})
+        self.assertIsInstance(errors[('address', 'ETH')], balances.TransientError)
@@ -0,0 +1,82 @@
+"""Tests for blocks module"""
+import json
+import os
+import tempfile
+import unittest
+
+import util.logger
+
+import blocks
+import db
+import tests
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.test')
+
+
+def block(network, height, outputs):
+    """Get a block with a transaction per output."""
+    return {'network': network, 'height': height, 'transactions': [
+        {'txid': "{}_{}".format(height, index), 'outputs': [{'address': address, 'value': value}]}
+        for index, (address, value) in enumerate(outputs)]}
+
+
+class MatchTest(unittest.TestCase):
+    """Test matching block outputs against open purchases."""
+
+    def setUp(self):
+        self.purchases = [
+            {'payment_pubkey': 'btc_address', 'payment_currency': 'BTC'},
+            {'payment_pubkey': '0xEthAddress', 'payment_currency': 'ETH'}]
+        self.blocks = [
+            block('BTC', 1, [('btc_address', 100), ('other_address', 5), ('btc_address', 20)]),
+            block('ETH', 7, [('0xethaddress', 3), ('0xother', 4)]),
+            block('ETH', 8, [('btc_address', 1)])]
+
+    def test_find_payments(self):
+        """Test that payments to open purchases are summed by payment address"""
+        index = blocks.PurchaseIndex(self.purchases)
+        payments, counters = blocks.find_payments(self.blocks, index)
+        self.assertEqual(payments, {'btc_address': 120, '0xEthAddress': 3})
+        self.assertEqual((counters['outputs'], counters['hits']), (6, 3))
+
+    def test_file_blocks(self):
+        """Test reading blocks from a directory of JSON lines files"""
+        with tempfile.TemporaryDirectory() as directory:
+            for name, file_blocks in (('1.jsonl', self.blocks[:2]), ('2.jsonl', self.blocks[2:])):
+                with open(os.path.join(directory, name), 'w') as blocks_file:
+                    blocks_file.write('\n'.join(json.dumps(file_block) for file_block in file_blocks))
+            self.assertEqual(list(blocks.iter_file_blocks([directory])), self.blocks)
+
+
+class MarkPaidCandidatesTest(unittest.TestCase):
+    """Test marking purchases paid from block data."""
+
+    def setUp(self):
+        tests.init_db()
+        self.pubkey = 'pubkey'
+        db.create_user(self.pubkey, 'call_sign')
+        db.update_test(self.pubkey, 'basic', 1)
+
+    def test_mark_paid_candidates(self):
+        """Test that purchases paid enough in the blocks are marked as paid"""
+        paid_address = db.get_payment_address(self.pubkey, db.MINIMUM_PAYMENT + 100, 'ETH', 'BUL')
+        half_paid_address = db.get_payment_address(self.pubkey, db.MINIMUM_PAYMENT + 100, 'ETH', 'BUL')
+        full_payment = db.util.conversion.eth_to_wei(
+            str((db.MINIMUM_PAYMENT + 100) / 100 / float(db.prices.eth_price())))
+        paid = blocks.mark_paid_candidates([block('ETH', 1, [
+            (paid_address.upper(), full_payment // 2), (paid_address, full_payment - full_payment // 2),
+            (half_paid_address, full_payment // 4)])])
+        self.assertEqual(paid, [paid_address])
+        self.assertEqual([purchase['payment_pubkey'] for purchase in db.get_paid_purchases()], [paid_address])
+
+    def test_payments_add_up(self):
+        """Test that payments read in different runs add up, and blocks read again are not counted twice"""
+        address = db.get_payment_address(self.pubkey, db.MINIMUM_PAYMENT + 100, 'ETH', 'BUL')
+        full_payment = db.util.conversion.eth_to_wei(
+            str((db.MINIMUM_PAYMENT + 100) / 100 / float(db.prices.eth_price())))
+        first_block = block('ETH', 1, [(address, full_payment // 2)])
+        self.assertEqual(blocks.mark_paid_candidates([first_block]), [])
+        self.assertEqual(blocks.mark_paid_candidates([first_block]), [], 'block read again counted twice')
+        self.assertEqual(db.get_block_heights(), {'ETH': 1})
+        paid = blocks.mark_paid_candidates([block('ETH', 2, [(address, full_payment - full_payment // 2)])])
+        self.assertEqual(paid, [address], 'payments of different runs not added up')
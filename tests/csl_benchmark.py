@@ -0,0 +1,52 @@
+"""Benchmark CSL name search - per query time against list size."""
+import time
+
+import util.logger
+
+import csl_reader
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.benchmark')
+NAMES = [
+    'usama bin laden', 'Jose Maria', 'sison, Jose Maria', 'ABDUL GHANI', 'vekselberg Victor',
+    'Sherlock Holmes', 'Kapitoshka Vodyanovych', 'oren Gampel', 'israel levin', 'Ori Levi']
+LIST_SIZES = (500, 1000, 2000, 4000, None)
+
+
+def time_queries(index, **kwargs):
+    """Get average seconds per query."""
+    start = time.perf_counter()
+    for name in NAMES:
+        index.top_match(name, *csl_reader.NAME_ROWS, **kwargs)
+    return (time.perf_counter() - start) / len(NAMES)
+
+
+def candidate_share(index):
+    """Get the average share of the rows scored by the pruned search."""
+    return sum(
+        len(index.candidates(name.lower()) or index.rows) for name in NAMES) / len(NAMES) / max(1, len(index.rows))
+
+
+def benchmark():
+    """
+    Compare the pruned search with a full scan on growing prefixes of the list,
+    and the scoring engines on the full list.
+    """
+    full_index = csl_reader.CSLListChecker().index
+    for size in LIST_SIZES:
+        index = csl_reader.CSLIndex(full_index.rows[:size], full_index.version)
+        LOGGER.info(
+            "%d rows: pruned %.2f ms/query (%.1f%% of rows are candidates), full scan %.2f ms/query",
+            len(index.rows), time_queries(index, engine='fuzzywuzzy') * 1000, candidate_share(index) * 100,
+            time_queries(index, prune=False, engine='fuzzywuzzy') * 1000)
+    if csl_reader.rapidfuzz is None:
+        LOGGER.warning('rapidfuzz is not installed, skipping engine comparison')
+        return
+    LOGGER.info(
+        "%d rows: fuzzywuzzy loop %.2f ms/query, rapidfuzz %.2f ms/query", len(full_index.rows),
+        time_queries(full_index, prune=False, engine='fuzzywuzzy') * 1000,
+        time_queries(full_index, engine='rapidfuzz') * 1000)
+
+
+if __name__ == '__main__':
+    util.logger.setup()
+    benchmark()
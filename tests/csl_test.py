@@ -1,4 +1,9 @@
 """Tests for csl_reader module"""
+import http.server
+import itertools
+import os
+import tempfile
+import threading
 import unittest
 
 import util.logger
@@ -9,6 +14,27 @@ import csl_reader
 LOGGER = util.logger.logging.getLogger('pkt.funder.test')
 
 
+# Individual rows of listed names, for comparing scoring engines.
+SCREENING_ROWS = [
+    {'name': 'BIN LADEN, Usama', 'alt_names': 'BIN LADIN, Osama; BIN MUHAMMAD, Usama', 'programs': 'SDGT'},
+    {'name': 'MAZIOTIS, Nikolaos', 'alt_names': '', 'programs': 'SDGT'},
+    {'name': 'SISON, Jose Maria', 'alt_names': 'LIWANAG, Armando', 'programs': 'SDGT'},
+    {'name': 'VEKSELBERG, Viktor Feliksovich', 'alt_names': '', 'programs': 'UKRAINE-EO13661'},
+    {'name': 'ANAYA MARTINEZ, Emilio', 'alt_names': '', 'programs': 'SDNTK'}]
+
+
+def assert_same_screening(test_case, index, name):
+    """
+    Assert that the pruned search of a name finds the same match as a full scan when it fails screening.
+    Below the screening threshold, the pruned search may miss matches of rows sharing no n-gram with the name.
+    """
+    pruned = index.top_match(name, *csl_reader.NAME_ROWS, engine='fuzzywuzzy')
+    full_scan = index.top_match(name, *csl_reader.NAME_ROWS, prune=False, engine='fuzzywuzzy')
+    test_case.assertLessEqual(pruned[0], full_scan[0], "pruned search for {} scored higher".format(name))
+    if full_scan[0] > csl_reader.VALIDATION_SCORE_THRESHOLD:
+        test_case.assertEqual(pruned, full_scan, "pruned search for {} differs from full scan".format(name))
+
+
 class ClsReaderTest(unittest.TestCase):
     """Tests for csl_reader module"""
 
@@ -70,6 +96,45 @@ class ClsReaderTest(unittest.TestCase):
             score = self.csl.score_name(name)
             LOGGER.info("name: %s   score:%.2f", name, score)
 
+    def test_pruned_search(self):
+        """Test that the pruned search finds the same matches above the screening threshold as a full scan"""
+        index = self.csl.get_index()
+        for name in self.names + ['Youssef Ben Abdul Baki', 'Sherlock Holmes']:
+            with self.subTest(name=name):
+                assert_same_screening(self, index, name)
+
+    @unittest.skipIf(csl_reader.rapidfuzz is None, 'rapidfuzz is not installed')
+    def test_vectorized_search(self):
+        """Test that the rapidfuzz engine never scores lower than fuzzywuzzy"""
+        index = self.csl.get_index()
+        for name in self.names + ['Youssef Ben Abdul Baki', 'Sherlock Holmes']:
+            with self.subTest(name=name):
+                vectorized_score, _ = index.top_match(name, *csl_reader.NAME_ROWS, engine='rapidfuzz')
+                score, _ = index.top_match(name, *csl_reader.NAME_ROWS, engine='fuzzywuzzy')
+                self.assertGreaterEqual(
+                    vectorized_score, score, "rapidfuzz scored {} lower than fuzzywuzzy".format(name))
+
+    @unittest.skipIf(csl_reader.rapidfuzz is None, 'rapidfuzz is not installed')
+    def test_vectorized_parity(self):
+        """
+        Test that the rapidfuzz engine finds the same top match and score as fuzzywuzzy on listed names.
+        The engines differ on names only partly aligned with a listed name, where rapidfuzz finds better alignments.
+        """
+        index = csl_reader.CSLIndex(SCREENING_ROWS, 0)
+        for name in (
+                'osama', 'bin laden, Usama', 'usama bin laden', 'osama Tallal', 'MAZIOTIS, Nikos', 'sison, Jose Maria',
+                'sisson, Jose Maria', 'Jose naria', 'vekselberg Victor', 'ANAYA MARTINEZ', 'Sherlock Holmes'):
+            with self.subTest(name=name):
+                vectorized_score, vectorized_programs = index.top_match(
+                    name, *csl_reader.NAME_ROWS, engine='rapidfuzz')
+                score, programs = index.top_match(name, *csl_reader.NAME_ROWS, engine='fuzzywuzzy')
+                self.assertAlmostEqual(vectorized_score, score, msg="different score for {}".format(name))
+                self.assertEqual(vectorized_programs, programs, "different match for {}".format(name))
+        vectorized_score, _ = index.top_match('sison al', *csl_reader.NAME_ROWS, engine='rapidfuzz')
+        score, _ = index.top_match('sison al', *csl_reader.NAME_ROWS, engine='fuzzywuzzy')
+        self.assertGreater(vectorized_score, csl_reader.VALIDATION_SCORE_THRESHOLD, 'better alignment not found')
+        self.assertLess(score, csl_reader.VALIDATION_SCORE_THRESHOLD, 'fuzzywuzzy tried every alignment')
+
 
 class CslTesterTest(unittest.TestCase):
     """Test CSL tests."""
@@ -83,3 +148,183 @@ class CslTesterTest(unittest.TestCase):
         """Test kyc on a valid user person's data"""
         name = 'Sherlock Holmes'
         self.assertEqual(csl_reader.CSLListChecker().basic_test(name), 1, 'valid user does not pass kyc')
+
+    def test_batch(self):
+        """Test batch kyc gives the same results as testing one by one"""
+        names = ['Youssef Ben Abdul Baki', 'Sherlock Holmes', 'usama bin laden', 'Kapitoshka Vodyanovych']
+        self.assertEqual(
+            csl_reader.batch_basic_test(names, processes=2),
+            [csl_reader.CSLListChecker().basic_test(name) for name in names],
+            'batch kyc results differ from single name results')
+
+
+class CslIndexTest(unittest.TestCase):
+    """Test the shared CSL index."""
+
+    def test_shared_index(self):
+        """Test that checkers share one index and reloading an unchanged file does not rebuild it"""
+        index = csl_reader.CSLListChecker().index
+        self.assertIs(csl_reader.CSLListChecker().index, index, 'index rebuilt for new checker')
+        self.assertIs(csl_reader.CSLListChecker.load_file(), index, 'index rebuilt for unchanged file')
+        self.assertFalse(hasattr(index.rows, 'append'), 'index rows are mutable')
+
+    def test_candidates(self):
+        """Test that rows sharing too few n-grams with a query are not scored, and the top match is still found"""
+        syllables = ['ka', 'ro', 'mi', 'sel', 'dan', 'tu', 'vok', 'lie', 'par', 'gon']
+        index = csl_reader.CSLIndex([
+            {'name': "{}{} {}".format(*name_syllables), 'alt_names': '', 'programs': str(row_index)}
+            for row_index, name_syllables in enumerate(itertools.product(syllables, repeat=3))], 0)
+        self.assertEqual(index.candidates('sherlock holmes'), [], 'rows sharing no n-grams kept')
+        self.assertLess(len(index.candidates('karo selmi')), len(index.rows) / 2, 'too few rows skipped')
+        self.assertIsNone(index.candidates('karo'), 'short query not searched with a full scan')
+        for name in ('karo sel', 'kar0 sell', 'Sherlock Holmes', 'partu gondan', 'vokl liedan'):
+            with self.subTest(name=name):
+                assert_same_screening(self, index, name)
+
+    def test_screening_cache(self):
+        """Test that screening an unchanged name again is served from the cache"""
+        checker = csl_reader.CSLListChecker()
+        checker.screening_cache.clear()
+        hits = checker.screening_cache.stats()['hits']
+        score = checker.score_name('Sherlock Holmes')
+        self.assertEqual(checker.score_name('sherlock HOLMES'), score, 'cached score differs')
+        self.assertEqual(checker.screening_cache.stats()['hits'], hits + 1, 'repeated name was not served from cache')
+
+    def test_screening_cache_eviction(self):
+        """Test LRU eviction and version keys of the screening cache"""
+        cache = csl_reader.ScreeningCache(2)
+        cache.put((1, 'fuzzywuzzy', 'a'), (.7, 'A'))
+        cache.put((1, 'fuzzywuzzy', 'b'), (.8, 'B'))
+        self.assertEqual(cache.get((1, 'fuzzywuzzy', 'a')), (.7, 'A'), 'cached match not found')
+        cache.put((1, 'fuzzywuzzy', 'c'), (.9, 'C'))
+        self.assertIsNone(cache.get((1, 'fuzzywuzzy', 'b')), 'least recently used match not evicted')
+        self.assertIsNone(cache.get((2, 'fuzzywuzzy', 'a')), 'match of an older version was hit')
+        self.assertEqual(cache.stats()['hits'], 1, 'wrong hit count')
+
+    def test_snapshot(self):
+        """Test that a compiled snapshot matches the index it was compiled from"""
+        index = csl_reader.CSLIndex.from_file(csl_reader.CSLListChecker.filename)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'CSL.snapshot')
+            index.save_snapshot(filename)
+            self.assertEqual(csl_reader.CSLIndex.snapshot_version(filename), index.version, 'wrong snapshot version')
+            snapshot = csl_reader.CSLIndex.from_snapshot(filename)
+            self.assertEqual(list(snapshot.rows), list(index.rows), 'snapshot rows differ')
+            for name in ['Youssef Ben Abdul Baki', 'Sherlock Holmes', 'usama bin laden']:
+                self.assertEqual(
+                    snapshot.top_match(name, *csl_reader.NAME_ROWS), index.top_match(name, *csl_reader.NAME_ROWS),
+                    "snapshot search for {} differs".format(name))
+
+
+class StubCSLHandler(http.server.BaseHTTPRequestHandler):
+    """Serve a CSL file with an ETag, like the real list server."""
+    body = b''
+    etag = ''
+    requests = []
+
+    def do_GET(self):
+        """Serve the file, or 304 if the client already has it."""
+        self.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        """Keep the test output clean."""
+
+
+class CslRefreshTest(unittest.TestCase):
+    """Test refreshing the CSL from a local stub server."""
+
+    @staticmethod
+    def serve(body, etag):
+        """Set the file served by the stub server."""
+        StubCSLHandler.body = body.encode('utf-8')
+        StubCSLHandler.etag = etag
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), StubCSLHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        StubCSLHandler.requests = []
+
+        class StubChecker(csl_reader.CSLListChecker):
+            """Checker using the stub server and temporary files."""
+            index = None
+            filename = os.path.join(self.directory.name, 'CSL.CSV')
+            snapshot_filename = os.path.join(self.directory.name, 'CSL.snapshot')
+            metadata_filename = os.path.join(self.directory.name, 'CSL.json')
+            screened_filename = os.path.join(self.directory.name, 'CSL.screened.json')
+            url = "http://127.0.0.1:{}/csl.csv".format(self.server.server_port)
+        self.checker = StubChecker
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def test_conditional_refresh(self):
+        """Test that an unchanged list is not downloaded again and a changed one replaces the index"""
+        header = 'type,name,alt_names,programs\n'
+        self.serve(header + 'Individual,"BIN LADIN, Usama",usama bin laden,SDGT\n', '"v1"')
+        self.assertTrue(self.checker.refresh(force=True), 'new list not loaded')
+        index = self.checker.index
+        self.assertEqual(len(index.rows), 1, 'wrong number of rows loaded')
+
+        self.assertFalse(self.checker.refresh(), 'list refreshed before the refresh interval')
+        self.assertFalse(self.checker.refresh(force=True), 'unchanged list loaded again')
+        self.assertEqual(StubCSLHandler.requests[-1].get('If-None-Match'), '"v1"', 'request was not conditional')
+        self.assertIs(self.checker.index, index, 'index replaced with unchanged list')
+
+        self.serve(header + 'Individual,"BIN LADIN, Usama",usama bin laden,SDGT\nIndividual,Other,,SDGT\n', '"v2"')
+        self.assertTrue(self.checker.refresh(force=True), 'changed list not loaded')
+        self.assertEqual(len(self.checker.index.rows), 2, 'changed list not swapped in')
+        self.assertEqual(len(StubCSLHandler.requests), 3, 'wrong number of downloads')
+
+    def test_snapshot_before_file(self):
+        """Test that a downloaded list is compiled before it replaces the local file, and never on the request path"""
+        header = 'type,name,alt_names,programs\n'
+        self.serve(header + 'Individual,"BIN LADIN, Usama",usama bin laden,SDGT\n', '"v1"')
+        self.assertTrue(self.checker.refresh(force=True), 'new list not loaded')
+        self.assertEqual(
+            csl_reader.CSLIndex.snapshot_version(self.checker.snapshot_filename),
+            os.path.getmtime(self.checker.filename), 'snapshot does not match the file')
+        index = self.checker.index
+        # a file newer than the snapshot keeps the current index serving
+        with open(self.checker.filename, 'a', encoding='utf-8') as csl_file:
+            csl_file.write('Individual,Other,,SDGT\n')
+        os.utime(self.checker.filename, (index.version + 10, index.version + 10))
+        self.assertIs(self.checker.get_index(), index, 'stale snapshot compiled on the request path')
+
+    def test_snapshot_header_read_once(self):
+        """Test that the snapshot header is only read again when the snapshot file changes"""
+        header = 'type,name,alt_names,programs\n'
+        self.serve(header + 'Individual,"BIN LADIN, Usama",usama bin laden,SDGT\n', '"v1"')
+        self.assertTrue(self.checker.refresh(force=True), 'new list not loaded')
+        index = self.checker.index
+        original_function = csl_reader.CSLIndex.snapshot_version
+        versions_read = []
+        csl_reader.CSLIndex.snapshot_version = staticmethod(
+            lambda filename: versions_read.append(filename) or original_function(filename))
+        try:
+            for _ in range(3):
+                self.assertIs(self.checker.get_index(), index)
+            self.assertEqual(versions_read, [], 'snapshot header read for an unchanged snapshot')
+            self.serve(header + 'Individual,"BIN LADIN, Usama",usama bin laden,SDGT\nIndividual,Other,,SDGT\n', '"v2"')
+            self.assertTrue(self.checker.refresh(force=True), 'changed list not loaded')
+            self.assertEqual(len(self.checker.get_index().rows), 2, 'changed snapshot not loaded')
+        finally:
+            csl_reader.CSLIndex.snapshot_version = original_function
+        self.assertTrue(versions_read, 'changed snapshot header not read')
+
+    def test_screened_version(self):
+        """Test storing the list version users were screened against"""
+        self.assertIsNone(self.checker.load_screened_version())
+        self.checker.save_screened_version(12.5)
+        self.assertEqual(self.checker.load_screened_version(), 12.5)
@@ -0,0 +1,159 @@
+"""Tests for db_pool module"""
+import threading
+import time
+import unittest
+
+import util.logger
+
+import db_pool
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.test')
+
+
+class FakeCursor:
+    """Cursor of a fake connection."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query):
+        """Fail on the query 'fail'."""
+        if query == 'fail':
+            raise RuntimeError('query failed')
+        self.connection.queries.append(query)
+
+    def close(self):
+        """Nothing to close."""
+
+
+class FakeConnection:
+    """Fake database connection, recording what was done with it."""
+
+    def __init__(self):
+        self.queries = []
+        self.commits = self.rollbacks = 0
+        self.alive = True
+        self.closed = False
+
+    def cursor(self, dictionary=False):
+        """Get a cursor."""
+        assert dictionary, 'db module expects dictionary cursors'
+        return FakeCursor(self)
+
+    def commit(self):
+        """Count commits."""
+        self.commits += 1
+
+    def rollback(self):
+        """Count rollbacks."""
+        self.rollbacks += 1
+
+    def is_connected(self):
+        """Check if the server is still there."""
+        return self.alive
+
+    def close(self):
+        """Mark as closed."""
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Test the connection pool against fake connections."""
+
+    def setUp(self):
+        self.now = 0
+        self.connections = []
+
+    def connect(self):
+        """Open a fake connection."""
+        self.connections.append(FakeConnection())
+        return self.connections[-1]
+
+    def tick(self):
+        """Move the fake clock on a bit every time it is read."""
+        self.now += .03
+        return self.now
+
+    def pool(self, **kwargs):
+        """Get a pool of fake connections on a fake clock."""
+        return db_pool.ConnectionPool(self.connect, clock=lambda: self.now, **kwargs)
+
+    def test_reuse(self):
+        """Test that sequential queries share one connection"""
+        pool = self.pool(size=2, overflow=0)
+        for _ in range(10):
+            with pool.connection() as sql:
+                sql.execute('select')
+        self.assertEqual(len(self.connections), 1, 'connection not reused')
+        self.assertEqual(self.connections[0].commits, 10, 'queries not committed')
+        stats = pool.stats()
+        self.assertEqual((stats['checkouts'], stats['in_use'], stats['idle']), (10, 0, 1), 'wrong stats')
+
+    def test_rollback(self):
+        """Test that a failed query is rolled back and its connection kept"""
+        pool = self.pool(size=1, overflow=0)
+        with self.assertRaises(RuntimeError):
+            with pool.connection() as sql:
+                sql.execute('fail')
+        self.assertEqual((self.connections[0].commits, self.connections[0].rollbacks), (0, 1))
+        with pool.connection() as sql:
+            sql.execute('select')
+        self.assertEqual(len(self.connections), 1, 'connection not reused after rollback')
+
+    def test_bounded(self):
+        """Test that concurrent callers wait for a connection instead of opening more"""
+        pool = self.pool(size=2, overflow=1)
+        release = threading.Event()
+
+        def query():
+            """Hold a connection until released."""
+            with pool.connection() as sql:
+                sql.execute('select')
+                release.wait()
+
+        threads = [threading.Thread(target=query) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        time.sleep(.1)
+        stats = pool.stats()
+        self.assertEqual(stats['in_use'], 3, 'pool overflow not bounded')
+        self.assertEqual(stats['waits'], 3, 'waiting callers not counted')
+        release.set()
+        for thread in threads:
+            thread.join()
+        stats = pool.stats()
+        self.assertEqual(stats['checkouts'], 6)
+        self.assertEqual(len(self.connections), 3, 'more connections than size and overflow')
+        self.assertEqual(stats['idle'], 2, 'overflow connection kept')
+        self.assertEqual(sum(connection.closed for connection in self.connections), 1)
+
+    def test_timeout(self):
+        """Test that waiting for a connection is limited"""
+        pool = db_pool.ConnectionPool(self.connect, size=1, overflow=0, timeout=.05, clock=self.tick)
+        with pool.connection():
+            with self.assertRaises(db_pool.PoolExhausted):
+                with pool.connection():
+                    pass
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_recycle_and_health_check(self):
+        """Test that old and dead connections are replaced"""
+        pool = self.pool(size=1, overflow=0, recycle=100, ping_after=10)
+        with pool.connection():
+            pass
+        self.connections[0].alive = False
+        self.now = 5
+        with pool.connection():
+            pass
+        self.assertEqual(len(self.connections), 1, 'recently used connection checked')
+        self.now = 20
+        with pool.connection():
+            pass
+        self.assertEqual(len(self.connections), 2, 'dead connection used')
+        self.assertTrue(self.connections[0].closed, 'dead connection not closed')
+        self.now = 200
+        with pool.connection():
+            pass
+        self.assertEqual(len(self.connections), 3, 'old connection not recycled')
+        stats = pool.stats()
+        self.assertEqual((stats['dead'], stats['recycled'], stats['open']), (1, 1, 1))
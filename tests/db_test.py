@@ -1,4 +1,6 @@
 """Tests for db module"""
+import contextlib
+import threading
 import unittest
 
 import util.logger
@@ -9,6 +11,22 @@ import tests
 LOGGER = util.logger.logging.getLogger('pkt.funder.test')
 
 
+class QueryRecorder:
+    """Cursor wrapper recording the queries executed through it."""
+
+    def __init__(self, cursor, queries):
+        self.cursor = cursor
+        self.queries = queries
+
+    def execute(self, query, args=None):
+        """Record a query and execute it."""
+        self.queries.append((query, args))
+        return self.cursor.execute(query, args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
 class DBTest(unittest.TestCase):
     """Testing the database module."""
 
@@ -70,6 +88,103 @@ class DBTest(unittest.TestCase):
         test_result = db.get_test_result(pubkey, 'basic')
         self.assertEqual(test_result, 1, 'reading test results does not return actual result')
 
+    def test_update_tests(self):
+        """Test updating a test for many users at once"""
+        users = {'pubkey_a': 'call_sign_a', 'pubkey_b': 'call_sign_b'}
+        for pubkey, call_sign in users.items():
+            self.internal_test_create_user(pubkey, call_sign)
+        db.update_tests('basic', {'pubkey_a': 1, 'pubkey_b': -1})
+        self.assertEqual(db.get_test_result('pubkey_a', 'basic'), 1, 'bulk update sets wrong result')
+        self.assertEqual(db.get_test_result('pubkey_b', 'basic'), -1, 'bulk update sets wrong result')
+        with self.assertRaises(db.UnknownUser):
+            db.update_tests('basic', {'unknown_pubkey': 1})
+
+    def test_full_names(self):
+        """Test getting full names of users ready for screening"""
+        self.internal_test_create_user('pubkey_a', 'call_sign_a')
+        self.internal_test_create_user('pubkey_b', 'call_sign_b')
+        db.set_internal_user_info('pubkey_a', full_name='Old Name', phone_number='+380982348561', address='asdf')
+        db.set_internal_user_info('pubkey_a', full_name='New Name')
+        db.set_internal_user_info('pubkey_b', full_name='Other Name')
+        self.assertEqual(db.get_full_names(), {'pubkey_a': 'New Name'}, 'wrong users ready for screening')
+
+    def test_migrate(self):
+        """Test that migrations bring the schema to the latest version and can be applied again"""
+        self.assertEqual(db.get_schema_version(), len(db.MIGRATIONS), 'database not migrated')
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('DELETE FROM schema_migrations')
+        with self.assertRaises(db.SchemaOutdated):
+            db.check_schema()
+        db.migrate()
+        self.assertEqual(db.get_schema_version(), len(db.MIGRATIONS), 'migrations not applied again')
+        db.check_schema()
+
+    def record_queries(self, function, *args):
+        """Call a db function and get the queries it executed, with their arguments."""
+        queries = []
+        connection = db.SQL_CONNECTION
+
+        @contextlib.contextmanager
+        def recording_connection():
+            """Connection whose cursor records the queries executed through it."""
+            with connection() as sql:
+                yield QueryRecorder(sql, queries)
+        db.SQL_CONNECTION = recording_connection
+        try:
+            function(*args)
+        finally:
+            db.SQL_CONNECTION = connection
+        return queries
+
+    def test_hot_queries_use_indexes(self):
+        """Test that the queries issued by the hot functions look up their tables by index"""
+        for index in range(20):
+            pubkey, call_sign = "pubkey_{}".format(index), "call_sign_{}".format(index)
+            db.create_user(pubkey, call_sign)
+            db.update_test(pubkey, 'basic', 1)
+            db.set_internal_user_info(pubkey, full_name="Name {}".format(index))
+            for status in (db.PURCHASE_UNPAID, db.PURCHASE_PAID, db.PURCHASE_FUNDED)[:index % 3 + 1]:
+                db.set_purchase(pubkey, "address_{}".format(index), 'ETH', 500, 'BUL', status)
+        with db.SQL_CONNECTION() as sql:
+            for table in ('users', 'test_results', 'internal_user_infos', 'purchases', 'current_purchases'):
+                sql.execute("ANALYZE TABLE {}".format(table))
+                sql.fetchall()
+        # tables each function must look up by index, the tables they list whole are not checked
+        hot_calls = [
+            (db.get_users, (), {'infos', 'internal_user_infos', 'test_results', 'purchases'}),
+            (db.get_users, ('call_sign_1', 5), {'infos', 'internal_user_infos', 'test_results', 'purchases'}),
+            (db.get_full_names, (), {'internal_user_infos'}),
+            (db.get_purchases, (db.PURCHASE_FUNDED,), {'current_purchases'}),
+            (db.get_completed_purchases, (), {'current_purchases'}),
+            (db.get_purchases_since, (db.PURCHASE_UNPAID, '2018-01-01'), {'current_purchases'}),
+            (db.get_callsings, ('call_sign_1',), {'users'})]
+        for function, args, tables in hot_calls:
+            queries = self.record_queries(function, *args)
+            self.assertTrue(queries, "{} issued no queries".format(function.__name__))
+            checked = set()
+            with db.SQL_CONNECTION() as sql:
+                for query, query_args in queries:
+                    sql.execute("EXPLAIN {}".format(query), query_args)
+                    for row in sql.fetchall():
+                        row = {key.decode() if isinstance(key, bytes) else key: value for key, value in row.items()}
+                        if row['table'] not in tables:
+                            continue
+                        checked.add(row['table'])
+                        with self.subTest(function=function.__name__, args=args, table=row['table']):
+                            self.assertNotEqual(row['type'], 'ALL', 'full table scan')
+                            self.assertIsNotNone(row['key'], 'no index used')
+            self.assertEqual(checked, tables, "{} did not read all the expected tables".format(function.__name__))
+
+    def test_starting_balances(self):
+        """Test that starting balances follow the price"""
+        self.assertEqual(
+            db.xlm_starting_balance('0.5'), 2 * db.xlm_starting_balance('1'),
+            'starting XLM balance does not follow the price')
+        self.assertEqual(
+            db.bul_starting_balance(),
+            db.util.conversion.euro_cents_to_bul_stroops(db.EUR_BUL_STARTING_BALANCE, db.prices.bul_price()),
+            'wrong starting BUL balance')
+
     def test_monthly_allowance(self):
         """Test monthly allowance logic"""
         pubkey, call_sign = 'pubkey', 'call_sign'
@@ -148,3 +263,197 @@ class DBTest(unittest.TestCase):
         db.set_purchase(pubkey, address, 'BTC', 700, 'XLM', 1)
         purchase = db.get_paid_purchases()[0]
         self.assertEqual(purchase['paid'], 1, 'purchase does not updated')
+
+    def test_current_purchases(self):
+        """Test that purchases are listed once by their latest status, keeping the whole history."""
+        pubkey, call_sign = 'pubkey', 'call_sign'
+        self.internal_test_create_user(pubkey, call_sign)
+        db.update_test(pubkey, 'basic', 1)
+        address = db.get_payment_address(pubkey, 700, 'BTC', 'XLM')
+        db.set_purchase(pubkey, address, 'BTC', 700, 'XLM', db.PURCHASE_PAID)
+        db.set_purchase(pubkey, address, 'BTC', 600, 'XLM', db.PURCHASE_PARTIALLY_FUNDED)
+        self.assertEqual(db.get_unpaid_purchases(), [], 'purchase listed by old status')
+        self.assertEqual(db.get_paid_purchases(), [], 'purchase listed by old status')
+        completed = db.get_completed_purchases()
+        self.assertEqual(len(completed), 1, 'purchase not listed by current status')
+        self.assertEqual(completed[0]['euro_cents'], 600, 'current status has wrong euro_cents value')
+        self.assertEqual(len(db.get_current_purchases()), 1, 'purchase listed more than once')
+        self.assertEqual(len(db.get_purchases()), 3, 'purchase history not kept')
+
+    def test_purchases_since(self):
+        """Test picking up purchases by the time of their last status change"""
+        pubkey, call_sign = 'pubkey', 'call_sign'
+        self.internal_test_create_user(pubkey, call_sign)
+        db.update_test(pubkey, 'basic', 1)
+        first_address = db.get_payment_address(pubkey, 700, 'BTC', 'XLM')
+        purchases = db.get_purchases_since(db.PURCHASE_UNPAID, '1970-01-02')
+        self.assertEqual([purchase['payment_pubkey'] for purchase in purchases], [first_address])
+        second_address = db.get_payment_address(pubkey, 700, 'ETH', 'BUL')
+        purchases = db.get_purchases_since(db.PURCHASE_UNPAID, purchases[-1]['timestamp'])
+        self.assertEqual(
+            [purchase['payment_pubkey'] for purchase in purchases], [second_address], 'seen purchase listed')
+        db.set_purchase(pubkey, second_address, 'ETH', 700, 'BUL', db.PURCHASE_PAID)
+        self.assertEqual(db.get_purchases_since(db.PURCHASE_UNPAID, '1970-01-02'), [], 'paid purchase listed')
+
+    def test_get_users(self):
+        """Test listing users with their details, a page at a time"""
+        for index in range(3):
+            self.internal_test_create_user("pubkey_{}".format(index), "call_sign_{}".format(index))
+        db.set_internal_user_info('pubkey_1', full_name='Old Name')
+        db.set_internal_user_info('pubkey_1', full_name='New Name')
+        db.update_test('pubkey_1', 'basic', 1)
+        users = db.get_users()
+        self.assertEqual(list(users), ['call_sign_0', 'call_sign_1', 'call_sign_2'], 'wrong users listed')
+        self.assertEqual(users['call_sign_0'], {'monthly_allowance': 0, 'monthly_expenses': 0})
+        self.assertEqual(users['call_sign_1']['full_name'], 'New Name', 'old infos listed')
+        self.assertEqual(users['call_sign_1']['monthly_allowance'], db.get_monthly_allowance('pubkey_1'))
+        first_page = db.get_users(limit=2)
+        self.assertEqual(list(first_page), ['call_sign_0', 'call_sign_1'], 'wrong first page')
+        self.assertEqual(list(db.get_users('call_sign_1', 2)), ['call_sign_2'], 'wrong next page')
+
+    def test_callsigns(self):
+        """Test searching call signs by prefix, a page at a time"""
+        for index, call_sign in enumerate(['a_b', 'abc', 'abd', 'b']):
+            self.internal_test_create_user("pubkey_{}".format(index), call_sign)
+        call_signs = [user['call_sign'] for user in db.get_callsings('A')]
+        self.assertEqual(call_signs, ['a_b', 'abc', 'abd'], 'wrong call signs found')
+        call_signs = [user['call_sign'] for user in db.get_callsings('a_')]
+        self.assertEqual(call_signs, ['a_b'], 'wildcard in prefix not escaped')
+        call_signs = [user['call_sign'] for user in db.get_callsings('a', 'a_b', 1)]
+        self.assertEqual(call_signs, ['abc'], 'wrong page')
+        call_signs = [user['call_sign'] for user in db.iter_callsigns('ab', page_size=1)]
+        self.assertEqual(call_signs, ['abc', 'abd'], 'wrong call signs iterated')
+        pages = [[user['call_sign'] for user in page] for page in db.iter_callsign_pages('a', page_size=2)]
+        self.assertEqual(pages, [['a_b', 'abc'], ['abd']], 'wrong pages iterated')
+
+    def test_user_cache(self):
+        """Test that user lookups are served from cache, and that creating a user invalidates it"""
+        with self.assertRaises(db.UnknownUser):
+            db.get_user(call_sign='cached_user')
+        db.create_user('cached_pubkey', 'Cached_User')
+        self.assertEqual(db.get_user(call_sign='cached_user')['pubkey'], 'cached_pubkey', 'unknown user cached')
+        hits = db.USER_CACHE.stats().get('hits', 0)
+        self.assertEqual(db.get_user(pubkey='cached_pubkey')['call_sign'], 'cached_user')
+        self.assertEqual(db.USER_CACHE.stats()['hits'], hits + 1, 'user not served from cache')
+
+    def test_spent_euro(self):
+        """Test that spend counters cover the last hour and day, and match the fundings when reconciled"""
+        self.internal_test_create_user('pubkey', 'call_sign')
+        self.assertEqual((db.get_hourly_spent_euro(), db.get_daily_spent_euro()), (0, 0))
+        db.commit_reservation(db.reserve_funds('pubkey', 100), 'BUL', 1000)
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('''
+                INSERT INTO fundings (timestamp, user_pubkey, currency, currency_amount, euro_cents)
+                VALUES (NOW() - INTERVAL 2 HOUR, %s, %s, %s, %s)''', ('pubkey', 'XLM', 1000, 50))
+        self.assertEqual((db.get_hourly_spent_euro(), db.get_daily_spent_euro()), (100, 100))
+        db.reconcile_spend_buckets()
+        self.assertEqual(db.get_hourly_spent_euro(), 100, 'old funding counted in last hour')
+        self.assertEqual(db.get_daily_spent_euro(), 150, 'funding not counted after reconciliation')
+
+    def test_fund_reservations(self):
+        """Test that reservations count against the fund limits until released"""
+        self.internal_test_create_user('pubkey', 'call_sign')
+        reservation_id = db.reserve_funds('pubkey', db.HOURLY_FUND_LIMIT)
+        self.assertEqual(db.get_hourly_spent_euro(), db.HOURLY_FUND_LIMIT, 'reservation not counted as spent')
+        with self.assertRaises(db.FundLimitReached):
+            db.reserve_funds('pubkey', 1)
+        db.release_reservation(reservation_id)
+        self.assertEqual(db.get_hourly_spent_euro(), 0, 'released reservation counted as spent')
+        with self.assertRaises(RuntimeError):
+            with db.reserved_funds('pubkey', 100):
+                raise RuntimeError('transaction failed')
+        self.assertEqual(db.get_hourly_spent_euro(), 0, 'reservation of failed funding not released')
+        with db.reserved_funds('pubkey', 100) as reservation:
+            reservation.mark_sent()
+            reservation.commit('BUL', 1000, euro_cents=90)
+        self.assertEqual(db.get_hourly_spent_euro(), 90, 'committed funding not counted as spent')
+        db.reconcile_spend_buckets()
+        self.assertEqual(db.get_hourly_spent_euro(), 90, 'committed funding not reconciled')
+
+    def test_sent_reservation_kept(self):
+        """Test that sent funds stay reserved when recording them fails, even after the reservation timeout"""
+        self.internal_test_create_user('pubkey', 'call_sign')
+        with self.assertRaises(RuntimeError):
+            with db.reserved_funds('pubkey', 100) as reservation:
+                reservation.mark_sent()
+                raise RuntimeError('recording the funding failed')
+        self.assertEqual(db.get_hourly_spent_euro(), 100, 'sent funds released')
+        with db.SQL_CONNECTION() as sql:
+            sql.execute('UPDATE fund_reservations SET timestamp = NOW() - INTERVAL %s SECOND', (
+                db.RESERVATION_TIMEOUT + 60,))
+        db.reconcile_spend_buckets()
+        self.assertEqual(db.get_daily_spent_euro(), 100, 'sent funds released on reconciliation')
+
+    def test_fund_reservations_concurrency(self):
+        """Test that concurrent workers can not reserve more than the fund limits"""
+        self.internal_test_create_user('pubkey', 'call_sign')
+        amount, workers, attempts = 7, 16, 20
+        reserved = []
+
+        def worker():
+            """Keep reserving until the limit is reached."""
+            for _ in range(attempts):
+                try:
+                    db.reserve_funds('pubkey', amount)
+                    reserved.append(amount)
+                except db.FundLimitReached:
+                    return
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        limit = min(db.HOURLY_FUND_LIMIT, db.DAILY_FUND_LIMIT, amount * workers * attempts)
+        self.assertLessEqual(sum(reserved), limit, 'concurrent workers overspent')
+        self.assertGreater(sum(reserved), limit - amount, 'concurrent workers underspent')
+        self.assertEqual(db.get_hourly_spent_euro(), sum(reserved), 'spend counters lost reservations')
+
+    def test_purchase_writer(self):
+        """Test that purchase writes are accumulated and written together"""
+        pubkey, call_sign = 'pubkey', 'call_sign'
+        self.internal_test_create_user(pubkey, call_sign)
+        with db.PurchaseWriter(flush_size=3) as purchase_writer:
+            for address in ['address_a', 'address_b']:
+                purchase_writer.set_purchase(pubkey, address, 'BTC', 700, 'XLM', db.PURCHASE_UNPAID)
+            self.assertEqual(db.get_purchases(), [], 'purchases written before flush size reached')
+            purchase_writer.set_purchase(pubkey, 'address_a', 'BTC', 700, 'XLM', db.PURCHASE_PAID)
+            self.assertEqual(len(db.get_purchases()), 3, 'purchases not written when flush size reached')
+            purchase_writer.set_purchase(pubkey, 'address_b', 'BTC', 700, 'XLM', db.PURCHASE_FAILED)
+        self.assertEqual(len(db.get_purchases()), 4, 'remaining purchases not written on exit')
+        self.assertEqual(
+            [purchase['payment_pubkey'] for purchase in db.get_paid_purchases()], ['address_a'],
+            'wrong current status after batched writes')
+        self.assertEqual(db.get_unpaid_purchases(), [], 'old status of batched purchase is current')
+
+
+class UserCacheTest(unittest.TestCase):
+    """Test the user cache on a fake clock."""
+
+    def setUp(self):
+        self.now = 0
+        self.cache = db.UserCache(size=4, ttl=60, negative_ttl=5, clock=lambda: self.now)
+
+    def test_ttl(self):
+        """Test that users and unknown users expire"""
+        self.cache.put(('pubkey', 'a'), {'pubkey': 'a', 'call_sign': 'Call_A'})
+        self.cache.put(('pubkey', 'b'), None)
+        self.assertEqual(self.cache.get(('call_sign', 'call_a')), (True, {'pubkey': 'a', 'call_sign': 'Call_A'}))
+        self.assertEqual(self.cache.get(('pubkey', 'b')), (True, None), 'unknown user not cached')
+        self.now = 10
+        self.assertEqual(self.cache.get(('pubkey', 'b')), (False, None), 'unknown user cached too long')
+        self.assertTrue(self.cache.get(('pubkey', 'a'))[0], 'user expired too soon')
+        self.now = 60
+        self.assertEqual(self.cache.get(('pubkey', 'a')), (False, None), 'user cached too long')
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['negative_hits'], stats['misses']), (2, 1, 2))
+
+    def test_eviction(self):
+        """Test that the least recently used users are evicted"""
+        for name in 'abc':
+            self.cache.put(('pubkey', name), {'pubkey': name, 'call_sign': name})
+        self.assertEqual(len(self.cache.entries), 4, 'cache size not bounded')
+        self.assertFalse(self.cache.get(('pubkey', 'a'))[0], 'least recently used user kept')
+        self.assertTrue(self.cache.get(('call_sign', 'c'))[0], 'recently used user evicted')
+        self.cache.invalidate(('call_sign', 'c'))
+        self.assertFalse(self.cache.get(('call_sign', 'c'))[0], 'invalidated user kept')
@@ -0,0 +1,116 @@
+"""Tests for monitor module"""
+import unittest
+
+import util.logger
+
+import db
+import monitor
+import routines
+import tests
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.test')
+
+
+class Clock:
+    """Clock moved by hand."""
+
+    def __init__(self):
+        self.now = 1000
+
+    def __call__(self):
+        return self.now
+
+
+class WatchListTest(unittest.TestCase):
+    """Test scheduling of watched addresses."""
+
+    def test_backoff(self):
+        """Test that unchanged addresses are checked less and less often, and changed ones often again"""
+        watch_list = monitor.WatchList(min_interval=10, max_interval=35, backoff=2)
+        self.assertTrue(watch_list.add({'payment_pubkey': 'address'}, 0))
+        self.assertFalse(watch_list.add({'payment_pubkey': 'address'}, 0), 'address watched twice')
+        self.assertEqual([watched.purchase['payment_pubkey'] for watched in watch_list.due(0)], ['address'])
+        self.assertEqual(watch_list.due(0), [], 'address due twice')
+        self.assertFalse(watch_list.checked('address', 0, 0))
+        self.assertEqual(watch_list.next_check(), 10)
+        self.assertFalse(watch_list.checked('address', 0, 10))
+        self.assertEqual(watch_list.next_check(), 30, 'unchanged address not backed off')
+        self.assertFalse(watch_list.checked('address', 0, 30))
+        self.assertEqual(watch_list.next_check(), 65, 'interval not bounded by max_interval')
+        self.assertTrue(watch_list.checked('address', 5, 65))
+        self.assertEqual(watch_list.next_check(), 75, 'changed address not checked often again')
+        watch_list.failed('address', 75)
+        self.assertEqual(watch_list.next_check(), 85, 'failed check changed the interval')
+
+    def test_remove(self):
+        """Test that removed addresses are no longer scheduled"""
+        watch_list = monitor.WatchList(min_interval=10, max_interval=100)
+        for address in ('first', 'second'):
+            watch_list.add({'payment_pubkey': address}, 0)
+        watch_list.remove('first')
+        self.assertNotIn('first', watch_list)
+        self.assertEqual([watched.purchase['payment_pubkey'] for watched in watch_list.due(100)], ['second'])
+        self.assertIsNone(watch_list.next_check())
+
+
+class PaymentMonitorTest(unittest.TestCase):
+    """Test monitoring payments incrementally."""
+
+    def setUp(self):
+        tests.init_db()
+        self.pubkey = 'pubkey'
+        db.create_user(self.pubkey, 'call_sign')
+        db.update_test(self.pubkey, 'basic', 1)
+        self.balances = {}
+        self.requests = []
+        self.original_function = routines.get_balances
+        routines.get_balances = self.get_balances
+
+    def tearDown(self):
+        routines.get_balances = self.original_function
+
+    def get_balances(self, addresses):
+        """Stub for routines.get_balances, recording the asked addresses."""
+        self.requests.append({address for address, _ in addresses})
+        return {address: self.balances.get(address[0], 0) for address in addresses}, {}
+
+    def test_monitor(self):
+        """Test that new purchases are picked up, unchanged ones backed off and paid ones dropped"""
+        clock = Clock()
+        payment_monitor = monitor.PaymentMonitor(
+            monitor.WatchList(min_interval=10, max_interval=100), clock=clock, resync_interval=1000)
+        first_address = db.get_payment_address(self.pubkey, db.MINIMUM_PAYMENT + 100, 'ETH', 'BUL')
+        self.assertEqual(payment_monitor.poll(), 1)
+        second_address = db.get_payment_address(self.pubkey, db.MINIMUM_PAYMENT + 100, 'ETH', 'BUL')
+        clock.now += 1
+        self.assertEqual(payment_monitor.poll(), 1, 'new purchase not picked up')
+        self.assertEqual(self.requests, [{first_address}, {second_address}], 'addresses not checked once')
+        clock.now += 9
+        self.assertEqual(payment_monitor.poll(), 1, 'address not checked after min_interval')
+        clock.now += 1
+        self.balances[second_address] = db.util.conversion.eth_to_wei(
+            str((db.MINIMUM_PAYMENT + 100) / 100 / float(db.prices.eth_price())))
+        self.assertEqual(payment_monitor.poll(), 1)
+        self.assertEqual(payment_monitor.stats()['paid'], 1)
+        self.assertNotIn(second_address, payment_monitor.watch_list, 'paid address still watched')
+        self.assertEqual(
+            [purchase['payment_pubkey'] for purchase in db.get_paid_purchases()], [second_address])
+        clock.now += 10
+        self.assertEqual(payment_monitor.poll(), 0, 'unchanged address not backed off')
+        stats = payment_monitor.stats()
+        self.assertEqual((stats['added'], stats['checks'], stats['watched']), (2, 4, 1))
+
+    def test_already_funded(self):
+        """Test that purchases whose status changed since they were watched are dropped, not marked as paid"""
+        payment_monitor = monitor.PaymentMonitor(
+            monitor.WatchList(min_interval=10, max_interval=100), clock=Clock(), resync_interval=1000)
+        address = db.get_payment_address(self.pubkey, db.MINIMUM_PAYMENT + 100, 'ETH', 'BUL')
+        payment_monitor.refresh_purchases()
+        db.set_purchase(self.pubkey, address, 'ETH', db.MINIMUM_PAYMENT + 100, 'BUL', db.PURCHASE_FUNDED)
+        self.balances[address] = db.util.conversion.eth_to_wei(
+            str((db.MINIMUM_PAYMENT + 100) / 100 / float(db.prices.eth_price())))
+        self.assertEqual(payment_monitor.check_due(), 1)
+        self.assertNotIn(address, payment_monitor.watch_list, 'funded address still watched')
+        self.assertNotIn('paid', payment_monitor.stats())
+        self.assertEqual(
+            db.get_purchase_statuses([address]), {address: db.PURCHASE_FUNDED}, 'funded purchase written over')
@@ -0,0 +1,185 @@
+"""Tests for payouts module"""
+import threading
+import time
+import unittest
+
+import paket_stellar
+import util.logger
+
+import db
+import payouts
+import tests
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.test')
+SOURCE = 'source'
+
+
+class StubHorizon:
+    """
+    Horizon stub keeping accounts in memory.
+    Envelopes are accepted when their sequence number follows the last accepted one of their source account,
+    and confirmed after a delay.
+    """
+
+    def __init__(self, accounts, delay=.1):
+        self.accounts = accounts
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.submitted = []
+
+    def get_account(self, pubkey, accept_untrusted=False):
+        """Get an account like paket_stellar.get_bul_account."""
+        if pubkey not in self.accounts:
+            raise paket_stellar.StellarAccountNotExists("account {} does not exist".format(pubkey))
+        account = self.accounts[pubkey]
+        if account.get('bul_limit') is None and not accept_untrusted:
+            raise paket_stellar.TrustError("account {} does not trust BUL".format(pubkey))
+        return dict(account)
+
+    @staticmethod
+    def get_address(seed):
+        """Get the address of a seed, seeds of the stub are their addresses."""
+        return seed
+
+    @staticmethod
+    def build_envelope(payout, source, channel, sequence):
+        """Build an envelope the stub understands."""
+        return {
+            'source': channel.pubkey, 'sequence': sequence + 1, 'destination': payout.purchase['user_pubkey'],
+            'asset_code': payout.purchase['requested_currency'], 'amount': payout.amount,
+            'create_account': payout.create_account, 'funder': source}
+
+    def submit_envelope(self, envelope, _):
+        """Accept an envelope following the source sequence number, and confirm it after a delay."""
+        with self.lock:
+            source = self.accounts[envelope['source']]
+            if envelope['sequence'] != source['sequence'] + 1:
+                raise paket_stellar.StellarTransactionFailed("tx_bad_seq: {}".format(envelope['sequence']))
+            source['sequence'] += 1
+            self.submitted.append(envelope)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+            if envelope['create_account']:
+                self.accounts[envelope['destination']] = {'sequence': 0, 'bul_balance': 0, 'bul_limit': None}
+            elif envelope['asset_code'] == 'BUL':
+                self.accounts[envelope['destination']]['bul_balance'] += envelope['amount']
+
+
+class PayoutPipelineTest(unittest.TestCase):
+    """Test paying out purchases through a Horizon stub."""
+
+    def setUp(self):
+        tests.init_db()
+        self.horizon = StubHorizon({
+            SOURCE: {'sequence': 100, 'bul_balance': 0, 'bul_limit': None},
+            'channel_a': {'sequence': 10, 'bul_balance': 0, 'bul_limit': None},
+            'channel_b': {'sequence': 20, 'bul_balance': 0, 'bul_limit': None},
+            'trusted': {'sequence': 1, 'bul_balance': 0, 'bul_limit': 10 ** 15},
+            'untrusted': {'sequence': 1, 'bul_balance': 0, 'bul_limit': None}})
+        self.original_functions = (
+            payouts.get_address, payouts.get_account, payouts.build_envelope, payouts.submit_envelope)
+        payouts.get_address = self.horizon.get_address
+        payouts.get_account = self.horizon.get_account
+        payouts.build_envelope = self.horizon.build_envelope
+        payouts.submit_envelope = self.horizon.submit_envelope
+        self.currency_prices = db.prices.get_prices(funding=True)
+        self.fundings = []
+        for user_pubkey, requested_currency in (
+                ('trusted', 'BUL'), ('trusted', 'XLM'), ('untrusted', 'BUL'), ('new', 'XLM'), ('trusted', 'BUL')):
+            if db.get_user(pubkey=user_pubkey, cached=False) is None:
+                db.create_user(user_pubkey, "call_sign_{}".format(user_pubkey))
+                db.update_test(user_pubkey, 'basic', 1)
+            payment_address = db.get_payment_address(user_pubkey, 1000, 'ETH', requested_currency)
+            purchase = {
+                'user_pubkey': user_pubkey, 'payment_pubkey': payment_address, 'payment_currency': 'ETH',
+                'requested_currency': requested_currency}
+            self.fundings.append((purchase, 1000, db.PURCHASE_FUNDED))
+
+    def tearDown(self):
+        (payouts.get_address, payouts.get_account, payouts.build_envelope,
+         payouts.submit_envelope) = self.original_functions
+
+    def get_statuses(self):
+        """Get current status of the purchases by payment address."""
+        return {purchase['payment_pubkey']: purchase['paid'] for purchase in db.get_current_purchases()}
+
+    def get_sequences(self, source):
+        """Get the sequence numbers of the envelopes submitted from a source account, in submission order."""
+        return [envelope['sequence'] for envelope in self.horizon.submitted if envelope['source'] == source]
+
+    def test_pipeline(self):
+        """Test that payouts are in flight together on channels, in order on each of them, and failures marked"""
+        pipeline = payouts.PayoutPipeline('seed', source=SOURCE, channel_seeds=['channel_a', 'channel_b'])
+        counters = pipeline.run(self.fundings, self.currency_prices)
+        self.assertEqual((counters['confirmed'], counters['failed']), (4, 1))
+        self.assertEqual(self.horizon.max_in_flight, 2, 'payouts not in flight on both channels')
+        sequences_a, sequences_b = self.get_sequences('channel_a'), self.get_sequences('channel_b')
+        self.assertEqual(len(sequences_a) + len(sequences_b), 4)
+        self.assertEqual(sequences_a, list(range(11, 11 + len(sequences_a))), 'sequence numbers not consecutive')
+        self.assertEqual(sequences_b, list(range(21, 21 + len(sequences_b))), 'sequence numbers not consecutive')
+        self.assertTrue(all(envelope['funder'] == SOURCE for envelope in self.horizon.submitted))
+        self.assertTrue([
+            envelope['create_account'] for envelope in self.horizon.submitted if envelope['destination'] == 'new'
+        ] == [True], 'missing account not created')
+        statuses = self.get_statuses()
+        for purchase, _, _ in self.fundings:
+            with self.subTest(user_pubkey=purchase['user_pubkey']):
+                self.assertEqual(statuses[purchase['payment_pubkey']], db.PURCHASE_FAILED if (
+                    purchase['user_pubkey'] == 'untrusted') else db.PURCHASE_FUNDED)
+
+    def test_channels_required(self):
+        """Test that the pipeline refuses to run without channel accounts"""
+        with self.assertRaises(AssertionError):
+            payouts.PayoutPipeline('seed', source=SOURCE, channel_seeds=[])
+
+    def test_bad_sequence(self):
+        """Test that payouts rejected for their sequence number are submitted again with reloaded ones"""
+        pipeline = payouts.PayoutPipeline('seed', source=SOURCE, channel_seeds=['channel_a'])
+        pipeline.channels[0].next_sequence()
+        # a transaction from elsewhere moves the channel sequence after it was loaded
+        self.horizon.accounts['channel_a']['sequence'] += 1
+        counters = pipeline.run(self.fundings, self.currency_prices)
+        self.assertEqual((counters['confirmed'], counters['bad_sequence']), (4, 1))
+        self.assertEqual(self.get_sequences('channel_a'), list(range(12, 16)))
+        self.assertEqual(
+            sorted(self.get_statuses().values()), sorted([db.PURCHASE_FUNDED] * 4 + [db.PURCHASE_FAILED]))
+
+    def test_outcome_unknown(self):
+        """Test that payouts which may have been sent are left sending, and rejected ones are paid out again"""
+        fundings = [funding for funding in self.fundings if funding[0]['user_pubkey'] == 'trusted']
+        timed_out, rejected, unrecorded = (purchase['payment_pubkey'] for purchase, _, _ in fundings)
+        submit_envelope, set_purchase = payouts.submit_envelope, db.set_purchase
+        sequences = {}
+
+        def failing_submit(envelope, seed):
+            """Time out after applying the first payout, reject the second one."""
+            sequences[envelope['sequence']] = len(sequences)
+            if sequences[envelope['sequence']] == 0:
+                submit_envelope(envelope, seed)
+                raise TimeoutError('horizon timed out')
+            if sequences[envelope['sequence']] == 1:
+                raise paket_stellar.StellarTransactionFailed('tx_failed: op_underfunded')
+            return submit_envelope(envelope, seed)
+
+        def failing_set_purchase(user_pubkey, payment_pubkey, *args, paid=db.PURCHASE_UNPAID):
+            """Fail to write the funded status of the third payout."""
+            if payment_pubkey == unrecorded and paid == db.PURCHASE_FUNDED:
+                raise RuntimeError('database gone')
+            return set_purchase(user_pubkey, payment_pubkey, *args, paid=paid)
+
+        payouts.submit_envelope, db.set_purchase = failing_submit, failing_set_purchase
+        try:
+            counters = payouts.PayoutPipeline('seed', source=SOURCE, channel_seeds=['channel_a']).run(
+                fundings, self.currency_prices)
+        finally:
+            db.set_purchase = set_purchase
+        self.assertEqual((counters['unknown'], counters['errors'], counters['confirmed']), (2, 1, 0))
+        statuses = self.get_statuses()
+        self.assertEqual(statuses[timed_out], db.PURCHASE_SENDING, 'timed out payout not left sending')
+        self.assertEqual(statuses[unrecorded], db.PURCHASE_SENDING, 'unrecorded payout not left sending')
+        self.assertEqual(statuses[rejected], db.PURCHASE_PAID, 'rejected payout not paid out again')
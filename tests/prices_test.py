@@ -0,0 +1,101 @@
+"""Tests for prices module"""
+import threading
+import time
+import unittest
+
+import util.logger
+
+import prices
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.test')
+
+
+class PriceCacheTest(unittest.TestCase):
+    """Test the price cache against a fake market."""
+
+    def setUp(self):
+        self.now = 0
+        self.fetches = []
+        self.fail = False
+        self.release = threading.Event()
+        self.release.set()
+
+    def fetch(self, id_, convert):
+        """Fake market, returning the number of fetches so far as price."""
+        self.release.wait()
+        if self.fail:
+            raise ConnectionError('market is down')
+        self.fetches.append((id_, convert))
+        return str(len(self.fetches))
+
+    def fetch_many(self, ids, convert):
+        """Fake market list, returning all prices of one request with the same number."""
+        if self.fail:
+            raise ConnectionError('market is down')
+        self.fetches.append((tuple(ids), convert))
+        return {id_: str(len(self.fetches)) for id_ in ids}
+
+    def cache(self):
+        """Get a price cache on the fake market and clock."""
+        return prices.PriceCache(self.fetch, self.fetch_many, ttl=60, clock=lambda: self.now)
+
+    def test_ttl(self):
+        """Test that fresh prices are served from cache"""
+        cache = self.cache()
+        self.assertEqual(cache.get(prices.BTC_ID, 'EUR'), '1')
+        self.now = 59
+        self.assertEqual(cache.get(prices.BTC_ID, 'EUR'), '1', 'fresh price fetched again')
+        self.assertEqual(cache.get(prices.ETH_ID, 'EUR'), '2', 'prices of different currencies mixed')
+
+    def test_single_flight(self):
+        """Test that concurrent callers share one upstream request"""
+        cache = self.cache()
+        self.release.clear()
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get(prices.XLM_ID, 'EUR'))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        time.sleep(.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.fetches), 1, 'concurrent callers made separate requests')
+        self.assertEqual(results, ['1'] * 10, 'callers got different prices')
+
+    def test_stale_while_revalidate(self):
+        """Test that a stale price is served while refreshing in background"""
+        cache = self.cache()
+        cache.get(prices.BTC_ID, 'EUR')
+        self.now = 120
+        self.assertEqual(cache.get(prices.BTC_ID, 'EUR'), '1', 'stale price not served')
+        for _ in range(50):
+            if len(self.fetches) == 2:
+                break
+            time.sleep(.01)
+        self.assertEqual(cache.get(prices.BTC_ID, 'EUR'), '2', 'stale price not refreshed')
+
+    def test_fail_closed(self):
+        """Test that funding refuses too old prices when the market is down"""
+        cache = self.cache()
+        cache.get(prices.BTC_ID, 'EUR')
+        self.fail = True
+        self.now = 120
+        self.assertEqual(cache.get(prices.BTC_ID, 'EUR', max_staleness=300), '1', 'acceptable price refused')
+        self.now = 600
+        with self.assertRaises(prices.StalePrice):
+            cache.get(prices.BTC_ID, 'EUR', max_staleness=300)
+        self.assertEqual(cache.get(prices.BTC_ID, 'EUR'), '1', 'stale price refused for display')
+
+    def test_get_many(self):
+        """Test that several prices are fetched in one request and cached one by one"""
+        cache = self.cache()
+        ids = [prices.BTC_ID, prices.ETH_ID, prices.XLM_ID]
+        self.assertEqual(cache.get_many(ids, 'EUR'), dict.fromkeys(ids, '1'))
+        self.assertEqual(len(self.fetches), 1, 'prices fetched in separate requests')
+        self.assertEqual(cache.get(prices.ETH_ID, 'EUR'), '1', 'batch fetched price not cached')
+        self.fail = True
+        self.now = 600
+        with self.assertRaises(prices.StalePrice):
+            cache.get_many(ids, 'EUR', max_staleness=300)
+        self.assertEqual(cache.get_many(ids, 'EUR'), dict.fromkeys(ids, '1'), 'stale prices refused for display')
@@ -154,6 +154,33 @@ class GetUserTest(BaseRoutesTests):
             keypair.seed(), call_sign='another call sign')
 
 
+class CallsignsTest(BaseRoutesTests):
+    """Test for callsigns endpoints."""
+
+    def setUp(self):
+        super().setUp()
+        for call_sign in ('test_a', 'test_b', 'test_c', 'other'):
+            db.create_user(paket_stellar.get_keypair().address().decode(), call_sign)
+
+    def test_callsigns(self):
+        """Test getting all callsigns, and paging through them."""
+        response = self.call('callsigns', 200, 'could not get callsigns', call_sign_prefix='test')
+        self.assertEqual([callsign['call_sign'] for callsign in response['callsigns']], ['test_a', 'test_b', 'test_c'])
+        self.assertIsNone(response['next_after_call_sign'], 'got a next page of the full list')
+        response = self.call('callsigns', 200, 'could not get callsigns page', call_sign_prefix='test', limit=2)
+        self.assertEqual([callsign['call_sign'] for callsign in response['callsigns']], ['test_a', 'test_b'])
+        response = self.call(
+            'callsigns', 200, 'could not get next callsigns page', call_sign_prefix='test', limit=2,
+            after_call_sign=response['next_after_call_sign'])
+        self.assertEqual([callsign['call_sign'] for callsign in response['callsigns']], ['test_c'])
+        self.assertIsNone(response['next_after_call_sign'], 'got a next page after the last one')
+
+    def test_callsigns_stream(self):
+        """Test getting all callsigns from the stream endpoint."""
+        response = self.call('callsigns/stream', 200, 'could not get callsigns', call_sign_prefix='test')
+        self.assertEqual([callsign['call_sign'] for callsign in response['callsigns']], ['test_a', 'test_b', 'test_c'])
+
+
 class UserInfosTest(BaseRoutesTests):
     """Test for user_infos endpoint."""
 
@@ -1,4 +1,7 @@
 """Tests for routines module"""
+import os
+import tempfile
+import types
 import unittest
 
 import paket_stellar
@@ -61,9 +64,10 @@ class RoutinesTest(unittest.TestCase):
             db.get_payment_address(users['callsign_3']['pubkey'], self.purchase_amount, 'ETH', 'XLM')
         ]
 
-        original_function = routines.get_balance
-        routines.get_balance = lambda address, _: \
-            self.eth_full_payment if address in full_paid_addresses else self.eth_half_payment
+        original_function = routines.get_balances
+        routines.get_balances = lambda addresses: ({
+            address: self.eth_full_payment if address[0] in full_paid_addresses else self.eth_half_payment
+            for address in addresses}, {})
 
         routines.check_purchases_addresses()
         purchases = db.get_unpaid_purchases()
@@ -77,7 +81,7 @@ class RoutinesTest(unittest.TestCase):
                 self.assertEqual(purchase['paid'], 0,
                                  "purchase without full funded address %s"
                                  "has wrong paid status: %s" % (purchase['payment_pubkey'], purchase['paid']))
-        routines.get_balance = original_function
+        routines.get_balances = original_function
 
     def test_send_requested_currency(self):
         """Test for send_requested_currency"""
@@ -96,11 +100,14 @@ class RoutinesTest(unittest.TestCase):
         set_trust(users['callsign_5']['pubkey'], self.actual_keypairs[users['callsign_5']['pubkey']], 1000000)
         set_trust(users['callsign_2']['pubkey'], self.actual_keypairs[users['callsign_2']['pubkey']])
 
-        original_function = routines.get_balance
-        routines.get_balance = lambda address, _: self.eth_full_payment
+        original_function = routines.get_balances
+        routines.get_balances = lambda addresses: ({address: self.eth_full_payment for address in addresses}, {})
+        # the test network has no channel accounts for the payout pipeline
+        original_pipeline, routines.PAYOUT_PIPELINE = routines.PAYOUT_PIPELINE, False
 
         routines.check_purchases_addresses()
         routines.send_requested_currency()
+        routines.PAYOUT_PIPELINE = original_pipeline
         purchases = db.get_paid_purchases()
         self.assertEqual(len(purchases), 0)
         for purchase in db.get_current_purchases():
@@ -110,7 +117,7 @@ class RoutinesTest(unittest.TestCase):
             if purchase['payment_pubkey'] in failed_address:
                 self.assertEqual(purchase['paid'], -1, "purchase with address: {} has paid status: {} but expected: -1".
                                  format(purchase['payment_pubkey'], purchase['paid']))
-        routines.get_balance = original_function
+        routines.get_balances = original_function
 
 
 class BalanceTest(unittest.TestCase):
@@ -137,3 +144,33 @@ class BalanceTest(unittest.TestCase):
         with self.assertRaises(routines.BalanceError):
             routines.get_eth_balance('invalid_address')
 # pylint: enable=no-self-use
+
+
+class RefreshScreeningListTest(unittest.TestCase):
+    """Test re-screening users after the screening list changed."""
+
+    def setUp(self):
+        self.screened = []
+        self.directory = tempfile.TemporaryDirectory()
+        checker = routines.csl_reader.CSLListChecker
+        self.original = (
+            vars(checker)['refresh'], vars(checker)['get_index'], checker.screened_filename, routines.screen_users)
+        self.version = 1.0
+        checker.refresh = classmethod(lambda cls, force=False: False)
+        checker.get_index = classmethod(lambda cls: types.SimpleNamespace(version=self.version))
+        checker.screened_filename = os.path.join(self.directory.name, 'CSL.screened.json')
+        routines.screen_users = lambda: self.screened.append(self.version)
+
+    def tearDown(self):
+        checker = routines.csl_reader.CSLListChecker
+        checker.refresh, checker.get_index, checker.screened_filename, routines.screen_users = self.original
+        self.directory.cleanup()
+
+    def test_rescreen_new_version(self):
+        """Test that users are screened against every new list version once, whoever downloaded it"""
+        routines.refresh_screening_list()
+        routines.refresh_screening_list()
+        self.assertEqual(self.screened, [1.0], 'users not screened once')
+        self.version = 2.0
+        routines.refresh_screening_list()
+        self.assertEqual(self.screened, [1.0, 2.0], 'list downloaded elsewhere not screened')
@@ -0,0 +1,47 @@
+"""Tests for telemetry module"""
+import threading
+import time
+import unittest
+
+import util.logger
+
+import telemetry
+
+LOGGER = util.logger.logging.getLogger('pkt.funder.test')
+
+
+class DispatcherTest(unittest.TestCase):
+    """Test the buffered telemetry dispatcher."""
+
+    def setUp(self):
+        self.sent = []
+        self.release = threading.Event()
+
+    def slow_send(self, *args, **kwargs):
+        """Send function which blocks until released, like an unreachable analytics server."""
+        self.release.wait()
+        self.sent.append((args, kwargs))
+
+    def test_send_does_not_block(self):
+        """Test that queueing events does not wait for the server, and overflow is dropped and counted"""
+        dispatcher = telemetry.Dispatcher(self.slow_send, queue_size=5, batch_size=2, flush_interval=.01)
+        start = time.time()
+        for number in range(20):
+            dispatcher.send_event('event', number)
+        self.assertLess(time.time() - start, 1, 'queueing events waited for the server')
+        self.assertGreater(dispatcher.stats()['dropped'], 0, 'overflowing events were not counted')
+        self.release.set()
+        dispatcher.flush(timeout=5)
+        stats = dispatcher.stats()
+        self.assertEqual(stats['queued'] + stats['dropped'], 20, 'events lost without being counted')
+        self.assertEqual(stats['queued_now'], 0, 'events left in queue after flush')
+
+    def test_batch(self):
+        """Test that a batch is collected up to its size"""
+        self.release.set()
+        dispatcher = telemetry.Dispatcher(self.slow_send, batch_size=3, flush_interval=1)
+        for number in range(5):
+            dispatcher.events.put_nowait((('event', number), {}))
+        self.assertEqual(len(dispatcher.next_batch(timeout=0)), 3, 'wrong batch size')
+        self.assertEqual(len(dispatcher.next_batch(timeout=0)), 2, 'partial batch not sent after flush interval')
+        self.assertEqual(dispatcher.next_batch(timeout=0), [], 'batch returned from empty queue')
@@ -3,3 +3,10 @@
 from tests.db_test import *
 from tests.csl_test import *
 from tests.routines_test import *
+from tests.telemetry_test import *
+from tests.prices_test import *
+from tests.db_pool_test import *
+from tests.balances_test import *
+from tests.monitor_test import *
+from tests.blocks_test import *
+from tests.payouts_test import *